@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+import os
+import sys
+import random
+import contextlib
+from argparse import ArgumentParser
+from xml.sax.saxutils import quoteattr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from git_reqs import yamlio
+from git_reqs.requirementmodule import init_module, MODULE_FILE
+
+# Default size of a generated project, a root module with 2 + 4 modules of 1000 reqs each
+DEFAULT_PARAMS = {'depth': 2,
+                  'modules': 2,
+                  'reqs': 1000,
+                  'testcase_ratio': 0.3,
+                  'fanout': 2,
+                  'partly_ratio': 0.1,
+                  'junit_files': 2,
+                  'fail_ratio': 0.1,
+                  'req_storage': 'files',
+                  'seed': 0}
+
+
+# Creates the modules of the project, depth levels below the root module with the given number of submodules each.
+# Returns the module paths and prefixes, parents first.
+def create_modules(project_path, params):
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        init_module(os.path.dirname(project_path), os.path.basename(project_path), 'P', req_numbering='numbers',
+                    root_module=True)
+        modules = [(project_path, 'P', 0)]
+        for module_path, prefix, level in modules:
+            if level == params['depth']:
+                continue
+            for i in range(params['modules']):
+                name = 'M%d' % (i + 1)
+                init_module(module_path, name, name, req_numbering='numbers', req_storage=params['req_storage'])
+                modules.append((module_path + '/' + name, prefix + '_' + name, level + 1))
+    return [(module_path, prefix) for module_path, prefix, level in modules if level > 0]
+
+
+# Writes the reqs of all modules. The requirements of a module refine requirements of its submodules, the
+# requirements of the leaf modules are verified, or partly verified, by the testcases of their module.
+def create_reqs(modules, params, rng):
+    testcase_count = int(params['reqs'] * params['testcase_ratio'])
+    requirement_count = params['reqs'] - testcase_count
+    children = {prefix: [p for _, p in modules if p.rsplit('_', 1)[0] == prefix] for _, prefix in modules}
+
+    testcases = []
+    for module_path, prefix in modules:
+        reqs = {}
+        for i in range(1, params['reqs'] + 1):
+            if i <= requirement_count:
+                links = []
+                for _ in range(params['fanout']):
+                    if children[prefix]:
+                        links.append('refines:%s_%d' % (rng.choice(children[prefix]), rng.randint(1, requirement_count)))
+                    elif testcase_count:
+                        link_type = 'partly_verifies(1/2)' if rng.random() < params['partly_ratio'] else 'verifies'
+                        links.append('%s:%s_%d' % (link_type, prefix, rng.randint(requirement_count + 1, params['reqs'])))
+                reqs[str(i)] = {'Req-Id': str(i), 'Type': 'Requirement',
+                                'Description': 'Requirement %d of %s' % (i, prefix),
+                                'downward_links': ','.join(dict.fromkeys(links)), 'upward_links': ''}
+            else:
+                reqs[str(i)] = {'Req-Id': str(i), 'Type': 'Testcase', 'Description': 'Testcase %d of %s' % (i, prefix),
+                                'downward_links': '', 'upward_links': ''}
+                testcases.append(prefix + '_' + str(i))
+
+        if params['req_storage'] == 'module_file':
+            with open(module_path + '/' + MODULE_FILE, 'w') as module_file:
+                yamlio.dump(reqs, module_file)
+        else:
+            for req_id, req in reqs.items():
+                with open(module_path + '/' + req_id + '.yaml', 'w') as req_file:
+                    yamlio.dump(req, req_file)
+        for file_name, content in [('reqs.yaml', list(reqs)), ('used-ids.yaml', list(reqs)),
+                                   ('next-id.yaml', params['reqs'] + 1)]:
+            with open(module_path + '/' + file_name, 'w') as module_file:
+                yamlio.dump(content, module_file)
+    return testcases
+
+
+# Writes JUnit files with a result for every testcase, tagged with the testcase they verify
+def create_junit_files(project_path, testcases, params, rng):
+    files = []
+    for n in range(params['junit_files']):
+        file = '%s/results-%d.xml' % (project_path, n + 1)
+        with open(file, 'w') as junit_file:
+            junit_file.write('<?xml version="1.0"?>\n<testsuites><testsuite name="suite%d">\n' % (n + 1))
+            for testcase in testcases:
+                name = quoteattr('git-reqs: %s verifies run%d' % (testcase, n + 1))
+                if rng.random() < params['fail_ratio']:
+                    junit_file.write('<testcase name=%s><failure message="failed">trace</failure></testcase>\n' % name)
+                else:
+                    junit_file.write('<testcase name=%s/>\n' % name)
+            junit_file.write('</testsuite></testsuites>\n')
+        files.append(file)
+
+    if files:
+        with open(project_path + '/test_results.temp.yaml', 'w') as test_results_file:
+            yamlio.dump(files, test_results_file)
+    return files
+
+
+# Generates a synthetic project in project_path, which must not exist. Returns the parameters used.
+def generate_project(project_path, **params):
+    params = dict(DEFAULT_PARAMS, **params)
+    project_path = os.path.abspath(project_path)
+    rng = random.Random(params['seed'])
+    modules = create_modules(project_path, params)
+    testcases = create_reqs(modules, params, rng)
+    create_junit_files(project_path, testcases, params, rng)
+    return params
+
+
+def add_params_arguments(parser):
+    parser.add_argument("--depth", type=int, default=DEFAULT_PARAMS['depth'],
+                        help="Levels of modules below the root module")
+    parser.add_argument("--modules", type=int, default=DEFAULT_PARAMS['modules'], help="Submodules per module")
+    parser.add_argument("--reqs", type=int, default=DEFAULT_PARAMS['reqs'], help="Reqs per module")
+    parser.add_argument("--testcase_ratio", type=float, default=DEFAULT_PARAMS['testcase_ratio'],
+                        help="Share of the reqs of a module that are testcases")
+    parser.add_argument("--fanout", type=int, default=DEFAULT_PARAMS['fanout'], help="Links per requirement")
+    parser.add_argument("--partly_ratio", type=float, default=DEFAULT_PARAMS['partly_ratio'],
+                        help="Share of the verifies links that are partly_verifies(1/2)")
+    parser.add_argument("--junit_files", type=int, default=DEFAULT_PARAMS['junit_files'],
+                        help="JUnit files with a result for every testcase")
+    parser.add_argument("--fail_ratio", type=float, default=DEFAULT_PARAMS['fail_ratio'],
+                        help="Share of the test results that are failures")
+    parser.add_argument("--req_storage", choices=['files', 'module_file'], default=DEFAULT_PARAMS['req_storage'])
+    parser.add_argument("--seed", type=int, default=DEFAULT_PARAMS['seed'])
+
+
+def get_params(args):
+    return {name: getattr(args, name) for name in DEFAULT_PARAMS}
+
+
+if __name__ == "__main__":
+    args_parser = ArgumentParser(description="Generate a synthetic git-reqs project")
+    args_parser.add_argument("project_path", help="Path of the new project")
+    add_params_arguments(args_parser)
+    args = args_parser.parse_args(sys.argv[1:])
+    generate_project(args.project_path, **get_params(args))
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import contextlib
+import shutil
+import platform
+import tempfile
+import statistics
+import subprocess
+import tracemalloc
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from git_reqs import yamlio
+from git_reqs.requirementmodule import requirement_module, MODULE_FILE
+from git_reqs.cache import CACHE_DIR
+from generate import generate_project, add_params_arguments, get_params, DEFAULT_PARAMS
+
+RESULTS_VERSION = 1
+# Changed reqs in the reload_changed stage, per module
+RELOAD_CHANGES = 10
+
+
+# The stages of the pipeline, run in this order on the generated project. Each takes the state of the run, where
+# the project is kept between the stages.
+def read_cold(state):
+    for module_path, _, _ in os.walk(state['project_path']):
+        if os.path.basename(module_path) == CACHE_DIR:
+            shutil.rmtree(module_path)
+    state['project'] = requirement_module(state['project_path'])
+
+
+def read_warm(state):
+    state['project'] = requirement_module(state['project_path'])
+
+
+def update_link_status(state):
+    state['project'].update_link_status()
+
+
+def write_reqs(state):
+    # Writes the submodules too
+    state['project'].write_reqs(write_all=True)
+
+
+def query(state):
+    list(state['project'].query('Type=Requirement and not link verifies and '
+                                'ancestors(Type=Test-Result and result!=Passed)'))
+
+
+def coverage_report(state):
+    from git_reqs import coverage
+    coverage.get_coverage_table(state['project']).write_json(state['project_path'] + '/coverage.json')
+
+
+def md_export(state):
+    from git_reqs import exporttools
+    exporttools.convert_to_markdown(state['project'])
+
+
+def xls_export(state):
+    from git_reqs import exporttools
+    state['xls_file'] = exporttools.convert_to_xls(state['project'])
+
+
+def xls_import(state):
+    from git_reqs import importtools
+    importtools.import_from_xls(state['project'], state['xls_file'])
+    state['project'].write_reqs()
+
+
+def reload_changed(state):
+    paths = []
+    for module in state['project'].get_module_tree():
+        req_ids = [req_name.split('_')[-1] for req_name in module.ordered_req_names[:RELOAD_CHANGES]]
+        if module.uses_module_file() and req_ids:
+            path = module.module_path + '/' + MODULE_FILE
+            with open(path, 'r') as module_file:
+                reqs = yamlio.load(module_file)
+            for req_id in req_ids:
+                reqs[req_id]['Note'] = 'changed'
+            with open(path, 'w') as module_file:
+                yamlio.dump(reqs, module_file)
+            paths.append(path)
+            continue
+        for req_id in req_ids:
+            path = module.module_path + '/' + req_id + '.yaml'
+            with open(path, 'a') as req_file:
+                req_file.write('Note: changed\n')
+            paths.append(path)
+    state['project'].reload_changed(paths)
+
+
+def relations_report(state):
+    from git_reqs import exporttools
+    # The root module has no reqs of its own, the reports are of the modules below it
+    exporttools.create_report(state['project'], None, dont_show_output=True, at_every_level=True)
+
+
+STAGES = [read_cold, read_warm, update_link_status, write_reqs, query, coverage_report, md_export, xls_export,
+          xls_import, reload_changed, relations_report]
+STAGE_NAMES = [stage.__name__ for stage in STAGES]
+
+
+# Runs the stages, repeat times, and returns per stage the wall clock times and the peak of the traced memory.
+# The memory is traced in an extra run after the timed ones, as tracing slows the stages down. Every run starts
+# from a newly generated project, since the stages change it.
+def run_stages(project_path, params, stage_names, repeat=1, trace_memory=True):
+    stages = [stage for stage in STAGES if stage.__name__ in stage_names]
+    results = {stage.__name__: {'seconds': [], 'peak_bytes': None, 'error': None} for stage in stages}
+
+    runs = [False] * repeat + ([True] if trace_memory else [])
+    for traced in runs:
+        if os.path.exists(project_path):
+            shutil.rmtree(project_path)
+        generate_project(project_path, **params)
+        state = {'project_path': project_path}
+        for stage in stages:
+            result = results[stage.__name__]
+            if result['error']:
+                continue
+            if traced:
+                tracemalloc.start()
+            start = time.perf_counter()
+            try:
+                # Keep stdout for the results
+                with contextlib.redirect_stdout(sys.stderr):
+                    stage(state)
+            except Exception as error:
+                # Stages depending on tools missing here, e.g. graphviz for the relations report, are skipped
+                result['error'] = '%s: %s' % (type(error).__name__, error)
+            seconds = time.perf_counter() - start
+            if traced:
+                result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            elif not result['error']:
+                result['seconds'].append(seconds)
+
+    for result in results.values():
+        if result['seconds']:
+            result['min'] = min(result['seconds'])
+            result['median'] = statistics.median(result['seconds'])
+    return results
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              universal_newlines=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_benchmark(params, stage_names=STAGE_NAMES, repeat=1, trace_memory=True, project_path=None):
+    work_dir = None
+    if project_path is None:
+        work_dir = tempfile.mkdtemp()
+        project_path = work_dir + '/project'
+    try:
+        params = dict(DEFAULT_PARAMS, **params)
+        stages = run_stages(project_path, params, stage_names, repeat, trace_memory)
+    finally:
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {'version': RESULTS_VERSION,
+            'commit': get_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'params': params,
+            'repeat': repeat,
+            'stages': stages}
+
+
+# Prints the stage times and peak memory of two result files side by side
+def compare(old_file, new_file):
+    with open(old_file, 'r') as f:
+        old = json.load(f)
+    with open(new_file, 'r') as f:
+        new = json.load(f)
+    if old['params'] != new['params']:
+        print('Warning: the results are of different projects')
+
+    print('%-20s %10s %10s %8s %12s %12s' % ('stage', 'old s', 'new s', 'ratio', 'old MB', 'new MB'))
+    for name in [n for n in STAGE_NAMES if n in old['stages'] or n in new['stages']]:
+        old_stage = old['stages'].get(name, {})
+        new_stage = new['stages'].get(name, {})
+        old_seconds = old_stage.get('min')
+        new_seconds = new_stage.get('min')
+        ratio = '%.2f' % (new_seconds/old_seconds) if old_seconds and new_seconds else '-'
+        print('%-20s %10s %10s %8s %12s %12s' % (
+            name,
+            '%.3f' % old_seconds if old_seconds is not None else '-',
+            '%.3f' % new_seconds if new_seconds is not None else '-',
+            ratio,
+            '%.1f' % (old_stage['peak_bytes']/1e6) if old_stage.get('peak_bytes') else '-',
+            '%.1f' % (new_stage['peak_bytes']/1e6) if new_stage.get('peak_bytes') else '-'))
+
+
+if __name__ == "__main__":
+    args_parser = ArgumentParser(description="Time the git-reqs pipeline on a generated project")
+    add_params_arguments(args_parser)
+    args_parser.add_argument("--stages", default=','.join(STAGE_NAMES),
+                             help="Comma separated stages to run, of %s" % ', '.join(STAGE_NAMES))
+    args_parser.add_argument("--repeat", type=int, default=1, help="Timed runs of the stages")
+    args_parser.add_argument("--no_memory", action='store_true', help="Skip the run tracing the peak memory")
+    args_parser.add_argument("--project_path", help="Generate the project here and keep it, instead of in a "
+                                                    "temporary directory. An existing directory is replaced")
+    args_parser.add_argument("--output", help="Json file for the results, printed if not given")
+    args_parser.add_argument("--compare", nargs=2, metavar=('OLD', 'NEW'), help="Compare two result files")
+    args = args_parser.parse_args(sys.argv[1:])
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+
+    stage_names = args.stages.split(',')
+    for name in stage_names:
+        assert name in STAGE_NAMES, "Invalid stage %s, use one of %s" % (name, ', '.join(STAGE_NAMES))
+    results = run_benchmark(get_params(args), stage_names, args.repeat, not args.no_memory, args.project_path)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    for name, stage in results['stages'].items():
+        if stage['error']:
+            print('%s failed: %s' % (name, stage['error']), file=sys.stderr)
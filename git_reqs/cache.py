@@ -0,0 +1,153 @@
+import os
+import json
+import time
+
+CACHE_DIR = '.git-reqs-cache'
+SNAPSHOT_VERSION = 2
+LAYOUT_VERSION = 2
+# Layouts not used for this long are removed, and only the most recently used are kept
+LAYOUT_MAX_AGE = 30 * 24 * 3600
+LAYOUT_MAX_ENTRIES = 5000
+# Files modified this close to the snapshot might change again without a new mtime, don't trust them.
+RACY_INTERVAL_NS = 2 * 10**9
+
+
+def get_cache_dir(module_path):
+    cache_dir = module_path + '/' + CACHE_DIR
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+        # Keep the cache out of git without touching the projects own .gitignore
+        with open(cache_dir + '/.gitignore', 'w') as gitignore_file:
+            gitignore_file.write('*\n')
+    return cache_dir
+
+
+# The caches are plain json, loading them can't run code even if the files come from an untrusted checkout
+def load_json(path, version):
+    try:
+        with open(path, 'r') as json_file:
+            content = json.load(json_file)
+        if content['version'] == version and isinstance(content['entries'], dict):
+            return content['entries']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return {}
+
+
+def save_json(module_path, path, version, entries):
+    try:
+        get_cache_dir(module_path)
+        with open(path + '_tmp', 'w') as json_file:
+            json.dump({'version': version, 'entries': entries}, json_file, separators=(',', ':'))
+        os.replace(path + '_tmp', path)
+        return True
+    except OSError as e:
+        # The cache is only an optimization, a read-only checkout must still be usable
+        print('Could not write cache %s: %s' % (path, e))
+        return False
+
+
+# True if the content is the same after a round trip through json, e.g. no dates and no int keys
+def is_json_content(content):
+    try:
+        return json.loads(json.dumps(content)) == content
+    except (TypeError, ValueError):
+        return False
+
+
+# Persistent cache of parsed module files, stored under <module>/.git-reqs-cache.
+# Each entry is validated with the mtime and size of its file, so only changed files are parsed again
+# while the rest of the module is loaded in one read of the snapshot.
+class snapshot_cache:
+    def __init__(self, module_path, enabled=True):
+        self.module_path = module_path
+        self.enabled = enabled
+        self.entries = {}
+        self.changed = False
+        if enabled:
+            self.entries = load_json(self.get_snapshot_path(), SNAPSHOT_VERSION)
+
+    def get_snapshot_path(self):
+        return self.module_path + '/' + CACHE_DIR + '/snapshot.json'
+
+    # Returns the cached content of the file, or None if the file has to be parsed, and the files stamp
+    def lookup(self, file_name):
+        stat = os.stat(self.module_path + '/' + file_name)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        entry = self.entries.get(file_name) if self.enabled else None
+        if entry is not None and tuple(entry[0]) == stamp:
+            return entry[1], stamp
+        return None, stamp
+
+    def store(self, file_name, stamp, content):
+        if not self.enabled:
+            return
+        # Content json can't represent is parsed again on every load
+        if time.time_ns() - stamp[0] > RACY_INTERVAL_NS and is_json_content(content):
+            self.entries[file_name] = (stamp, content)
+            self.changed = True
+        else:
+            self.forget(file_name)
+
+    def load(self, file_name, loader):
+        content, stamp = self.lookup(file_name)
+        if content is None:
+            with open(self.module_path + '/' + file_name, 'r') as f:
+                content = loader(f)
+            self.store(file_name, stamp, content)
+        return content
+
+    def forget(self, file_name):
+        if self.entries.pop(file_name, None) is not None:
+            self.changed = True
+
+    def save(self):
+        if not self.enabled or not self.changed:
+            return
+        if save_json(self.module_path, self.get_snapshot_path(), SNAPSHOT_VERSION, self.entries):
+            self.changed = False
+
+
+# Graph layouts of the relations report, stored under <module>/.git-reqs-cache.
+# The layouts are keyed by a hash of the nodes and edges of the laid out graph, so any change of the graph
+# structure gives a new entry. Entries are evicted by age and by count, the least recently used first, but never
+# the entries used since the cache was loaded.
+class layout_cache:
+    def __init__(self, module_path):
+        self.module_path = module_path
+        self.entries = load_json(self.get_layout_path(), LAYOUT_VERSION)
+        self.used = set()
+        self.changed = False
+
+    def get_layout_path(self):
+        return self.module_path + '/' + CACHE_DIR + '/layouts.json'
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries[key] = (time.time(), entry[1])
+        self.used.add(key)
+        self.changed = True
+        return entry[1]
+
+    # Returns the positions as they are stored, by node name and as [x, y] lists
+    def store(self, key, positions):
+        self.entries[key] = (time.time(), {str(node): [float(x), float(y)] for node, (x, y) in positions.items()})
+        self.used.add(key)
+        self.changed = True
+        return self.entries[key][1]
+
+    def evict(self):
+        oldest = time.time() - LAYOUT_MAX_AGE
+        entries = sorted(((used, key) for key, (used, _) in self.entries.items() if key not in self.used),
+                         reverse=True)
+        for i, (used, key) in enumerate(entries):
+            if i + len(self.used) >= LAYOUT_MAX_ENTRIES or used < oldest:
+                self.entries.pop(key)
+                self.changed = True
+
+    def save(self):
+        self.evict()
+        if self.changed and save_json(self.module_path, self.get_layout_path(), LAYOUT_VERSION, self.entries):
+            self.changed = False
@@ -0,0 +1,174 @@
+import csv
+import json
+import networkx as nx
+import numpy as np
+
+COVERAGE_TYPES = ['Requirement', 'Testcase', 'Test-Result']
+COVERAGE_GROUPS = ['passed', 'failed', 'fully_tested', 'partly_tested', 'untested']
+
+
+# Leaves reachable from each node of G, the node itself included if it has no children.
+# Calculated in one pass over the graph in reverse topological order, cycles are condensed.
+def get_reachable_leaves(G):
+    condensed = nx.condensation(G)
+    component_leaves = {}
+    for component in reversed(list(nx.topological_sort(condensed))):
+        members = condensed.nodes[component]['members']
+        children = list(condensed.successors(component))
+        if len(children) == 1:
+            # Share the set with the only child instead of copying it
+            leaves = component_leaves[children[0]]
+        else:
+            leaves = set()
+            for child in children:
+                leaves |= component_leaves[child]
+        own_leaves = [m for m in members if G.out_degree(m) == 0]
+        if own_leaves:
+            leaves = leaves | set(own_leaves)
+        component_leaves[component] = leaves
+    return {node: component_leaves[component] for node, component in condensed.graph['mapping'].items()}
+
+
+# Test coverage of all requirements of the graph, in columns with one row per requirement.
+#
+# A requirement is fully or partly linked to tests by its verifies_link_status, and the leaves of its
+# traceability tree of requirements, testcases and test results give the test outcome:
+#   passed: fully linked and all leaves are passed test results
+#   failed: any leaf is a failed test result
+#   fully_tested, partly_tested, untested: the rest, by link status
+class coverage_table:
+    def __init__(self, reqs):
+        self.reqs = reqs
+        graph = reqs.subgraph([n for n, d in reqs.nodes.items() if d.get('Type') in COVERAGE_TYPES])
+        # The leaf sets are shared between reqs, they are only listed for the rows of the html report
+        self.reachable_leaves = get_reachable_leaves(graph)
+        self.leaf_order = None
+
+        self.req_ids = []
+        self.descriptions = []
+        link_status = []
+        passed = []
+        failed = []
+        leaf_count = []
+        for req, data in reqs.nodes.items():
+            if data.get('Type') != 'Requirement':
+                continue
+            leaves = self.reachable_leaves[req]
+            results = [reqs.nodes[leaf].get('result') for leaf in leaves
+                       if reqs.nodes[leaf].get('Type') == 'Test-Result']
+            self.req_ids.append(req)
+            self.descriptions.append(data['Description'])
+            link_status.append(data.get('non_stored_fields', {}).get('verifies_link_status', np.nan))
+            passed.append(results.count('Passed'))
+            failed.append(len(results) - results.count('Passed'))
+            leaf_count.append(len(leaves))
+
+        self.link_status = np.array(link_status, dtype=float)
+        self.passed = np.array(passed, dtype=int)
+        self.failed = np.array(failed, dtype=int)
+        self.leaf_count = np.array(leaf_count, dtype=int)
+
+        partly = (self.link_status > 0) & (self.link_status < 1)
+        fully = self.link_status >= 1
+        # Partly, fully or not linked to tests, the rows of a group are sorted in this order
+        self.category = np.where(partly, 0, np.where(fully, 1, 2))
+
+        passed_mask = fully & (self.passed == self.leaf_count)
+        failed_mask = ~passed_mask & (self.failed > 0)
+        rest = ~passed_mask & ~failed_mask
+        self.masks = {'passed': passed_mask,
+                      'failed': failed_mask,
+                      'fully_tested': rest & fully,
+                      'partly_tested': rest & partly,
+                      'untested': rest & ~fully & ~partly}
+
+    def __len__(self):
+        return len(self.req_ids)
+
+    def count(self, group):
+        return int(np.count_nonzero(self.masks[group]))
+
+    def get_rows(self, group):
+        rows = np.flatnonzero(self.masks[group])
+        return rows[np.argsort(self.category[rows], kind='stable')]
+
+    # Leaves of a req in the order of the graph
+    def get_leaves(self, row):
+        if self.leaf_order is None:
+            self.leaf_order = {node: i for i, node in enumerate(self.reqs.nodes)}
+        return sorted(self.reachable_leaves[self.req_ids[row]], key=self.leaf_order.get)
+
+    # Rows of a group as columns, in the format used by the report tables
+    def get_group(self, group):
+        columns = {'Req-Ids': [], 'result': [], 'leaves': [], 'fully-tested': [], 'Description': []}
+        for row in self.get_rows(group):
+            if group == 'passed':
+                result = 'passed'
+            elif group == 'failed':
+                result = 'failed'
+            else:
+                result = 'partly tested' if self.passed[row] > 0 else 'untested'
+            columns['Req-Ids'].append(self.req_ids[row])
+            columns['result'].append(result)
+            columns['leaves'].append(self.get_leaves(row))
+            columns['fully-tested'].append(group == 'passed' or bool(self.category[row] == 1))
+            columns['Description'].append(self.descriptions[row])
+        return columns
+
+    def get_group_names(self):
+        group_names = np.empty(len(self), dtype=object)
+        for group, mask in self.masks.items():
+            group_names[mask] = group
+        return group_names
+
+    def get_percent(self, group):
+        return 100.0*self.count(group)/len(self) if len(self) else 0.0
+
+    def get_summary(self):
+        return {'total': len(self),
+                'counts': {group: self.count(group) for group in COVERAGE_GROUPS},
+                'percent': {group: round(self.get_percent(group), 2) for group in COVERAGE_GROUPS}}
+
+    def write_json(self, file):
+        report = self.get_summary()
+        group_names = self.get_group_names()
+        report['reqs'] = [{'Req-Id': req, 'group': str(group), 'passed': int(passed), 'failed': int(failed),
+                           'leaves': int(leaves)}
+                          for req, group, passed, failed, leaves in
+                          zip(self.req_ids, group_names, self.passed, self.failed, self.leaf_count)]
+        with open(file, 'w') as json_file:
+            json.dump(report, json_file, separators=(',', ':'))
+
+    def write_csv(self, file):
+        with open(file, 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(['Req-Id', 'group', 'passed', 'failed', 'leaves'])
+            writer.writerows(zip(self.req_ids, self.get_group_names(), self.passed, self.failed, self.leaf_count))
+
+    # Returns a message for each threshold that is not met. The thresholds are given per group in percent
+    # of all requirements, e.g. {'passed': 80} as minimum and {'failed': 0} as maximum.
+    def check_thresholds(self, minimums=None, maximums=None):
+        minimums = minimums or {}
+        maximums = maximums or {}
+        failures = []
+        for group, limit in minimums.items():
+            if self.get_percent(group) < limit:
+                failures.append('%s is %.2f%%, below the minimum %.2f%%' % (group, self.get_percent(group), limit))
+        for group, limit in maximums.items():
+            if self.get_percent(group) > limit:
+                failures.append('%s is %.2f%%, above the maximum %.2f%%' % (group, self.get_percent(group), limit))
+        return failures
+
+
+def get_coverage_table(reqmodule):
+    return coverage_table(reqmodule.reqs)
+
+
+# Parses GROUP=PERCENT threshold arguments
+def parse_thresholds(thresholds):
+    parsed = {}
+    for threshold in thresholds or []:
+        group, _, limit = threshold.partition('=')
+        assert group in COVERAGE_GROUPS, "Invalid coverage group %s, use one of %s" % (group, ', '.join(COVERAGE_GROUPS))
+        parsed[group] = float(limit)
+    return parsed
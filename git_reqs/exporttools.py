@@ -1,21 +1,21 @@
 import os.path
-from openpyxl import load_workbook, Workbook
 import networkx as nx
-from networkx.drawing.nx_pydot import to_pydot, graphviz_layout
-
-from bokeh.models import (BoxZoomTool, ResetTool, Circle, HoverTool,
-                          MultiLine, StaticLayoutProvider, ColumnDataSource)
-from bokeh.models.widgets import DataTable, DateFormatter, TableColumn, Div
-from bokeh.io import output_file, show, save, curdoc
-from bokeh.layouts import column
-from bokeh.palettes import Spectral4, RdGy6, Pastel2
-from bokeh.plotting import figure, from_networkx
-from bokeh.models import ColumnDataSource, LabelSet
-from bokeh.embed import json_item
 import math
 import json
+import copy
+import hashlib
 
-def convert_to_xls(reqmodule, existing_workbook=None):
+# openpyxl, bokeh and pydot are slow to import, so they are imported in the functions using them.
+
+# Space between the separately laid out parts of a graph
+LAYOUT_COMPONENT_SPACING = 100
+
+
+def convert_to_xls(reqmodule, existing_workbook=None, write_only=False):
+    if write_only:
+        return convert_to_xls_write_only(reqmodule)
+
+    from openpyxl import load_workbook, Workbook
     if not existing_workbook:
         if 'xls-template' in reqmodule.config.keys() \
                 and os.path.exists(reqmodule.module_path + '/' + reqmodule.config['xls-template']):
@@ -25,8 +25,7 @@ def convert_to_xls(reqmodule, existing_workbook=None):
     else:
         workbook = existing_workbook
 
-    if len(reqmodule.ordered_req_names) > 0 or \
-            ('root_module' in reqmodule.config.keys() and not reqmodule.config['root_module']):
+    if is_exported(reqmodule):
         sheet = workbook.copy_worksheet(workbook[workbook.sheetnames[0]])
         sheet.title = reqmodule.module_prefix
 
@@ -61,84 +60,163 @@ def convert_to_xls(reqmodule, existing_workbook=None):
         return ""
 
 
-def convert_to_markdown(reqmodule, hugo=False):
-    if len(reqmodule.ordered_req_names) > 0 or \
-            ('root_module' in reqmodule.config.keys() and not reqmodule.config['root_module']):
-
-        if hugo:
-            if not os.path.exists(reqmodule.module_path + "/Requirements/"):
-                os.makedirs(reqmodule.module_path + "/Requirements/")
-            md_file = open(reqmodule.module_path + "/Requirements/" + "index.md", 'w')
-            md_file.write('---\n'
-                          'title: ' + os.path.basename(reqmodule.module_path) + '\n' 
-                          'weight: 1\n'
-                          'markup: mmark\n'
-                           '---\n')
+def is_exported(reqmodule):
+    return len(reqmodule.ordered_req_names) > 0 or \
+        ('root_module' in reqmodule.config.keys() and not reqmodule.config['root_module'])
+
+
+# Same export as convert_to_xls, but the rows are streamed to a write-only workbook one req at a time,
+# so the memory use does not grow with the number of exported reqs.
+# Only the header styles, the styles of the first data row and the column widths are taken from the template.
+def convert_to_xls_write_only(reqmodule):
+    from openpyxl import load_workbook, Workbook
+    from openpyxl.cell import WriteOnlyCell
+
+    header_styles = []
+    row_styles = []
+    column_widths = {}
+    if 'xls-template' in reqmodule.config.keys() \
+            and os.path.exists(reqmodule.module_path + '/' + reqmodule.config['xls-template']):
+        template = load_workbook(reqmodule.module_path + '/' + reqmodule.config['xls-template'])
+        template_sheet = template[template.sheetnames[0]]
+        for row, styles in [(1, header_styles), (2, row_styles)]:
+            for col in range(1, template_sheet.max_column + 1):
+                cell = template_sheet.cell(row, col)
+                styles.append(get_xls_cell_style(cell) if cell.has_style else None)
+        for column, dimension in template_sheet.column_dimensions.items():
+            if dimension.width:
+                column_widths[column] = dimension.width
+        template.close()
+
+    def get_cell(sheet, value, styles, col):
+        if col >= len(styles) or styles[col] is None:
+            return value
+        cell = WriteOnlyCell(sheet, value)
+        for attr, style in styles[col].items():
+            setattr(cell, attr, style)
+        return cell
+
+    workbook = Workbook(write_only=True)
+    for module in reqmodule.get_module_tree():
+        if not is_exported(module):
+            continue
+        sheet = workbook.create_sheet(module.module_prefix)
+        for column, width in column_widths.items():
+            sheet.column_dimensions[column].width = width
+
+        fields = module.fields
+        sheet.append([get_cell(sheet, field, header_styles, col) for col, field in enumerate(fields)])
+        for req in module.ordered_req_names:
+            node = module.reqs.nodes[req]
+            row = [req if field == 'Req-Id' else node.get(field) for field in fields]
+            if row_styles:
+                row = [get_cell(sheet, value, row_styles, col) for col, value in enumerate(row)]
+            sheet.append(row)
+
+    file = reqmodule.module_path + "/" + reqmodule.module_prefix + ".xlsx"
+    workbook.save(file)
+    return file
+
+
+def get_xls_cell_style(cell):
+    return {'font': copy.copy(cell.font), 'fill': copy.copy(cell.fill), 'border': copy.copy(cell.border),
+            'alignment': copy.copy(cell.alignment), 'number_format': cell.number_format}
+
+
+# Markdown text of one req, per formatting. The formatting strings are parsed once into a render function.
+def compile_markdown_formatting(formatting):
+    if formatting.startswith('Heading'):
+        if '_' in formatting:
+            heading_level = int(formatting.split('_')[1])
         else:
-            md_file = open(reqmodule.module_path + "/" + reqmodule.module_prefix + ".md", 'w')
+            heading_level = 1
+        preformatting = '#'*heading_level
+
+        def render(req, description):
+            return preformatting, ' ' + description, '*[' + req + ']*', '\n\n'
+    elif 'Table' in formatting:
+        table_heading = 'Heading' in formatting
+
+        def render(req, description):
+            # Handle both |a|b|c| and a|b|c
+            description = '|'.join([x for x in description.split('|') if x])
+            if table_heading:
+                description = ' Req-Id |' + description
+                description += '\n' + '|' + '|'.join(['-'*len(x) for x in description.split('|') if x])
+            return '|', description, '*' + req + '* |', ' |\n'
+    elif 'BulletList' in formatting:
+        if '_' in formatting:
+            bullet_level = int(formatting.split('_')[1])
+        else:
+            bullet_level = 1
+        preformatting = '  '*bullet_level + '- '
+
+        def render(req, description):
+            return preformatting, description, '*[' + req + ']*', '\n\n'
+    elif 'Italic' in formatting:
+        def render(req, description):
+            return '', '*' + description + '*', '*[' + req + ']*', '\n\n'
+    else:
+        def render(req, description):
+            return '', description, '*[' + req + ']*', '\n\n'
+    return render
 
-        for req in reqmodule.ordered_req_names:
 
+markdown_formatters = {}
 
-            if 'Formatting' in reqmodule.reqs.nodes[req].keys():
-                formatting = reqmodule.reqs.nodes[req]['Formatting']
-            else:
-                formatting = ''
-
-            if formatting.startswith('Heading'):
-                if '_' in formatting:
-                    heading_level = int(formatting.split('_')[1])
-                else:
-                    heading_level = 1
-                preformatting = '#'*heading_level
-                description = ' ' + reqmodule.reqs.nodes[req]['Description']
-                req_nr_format = '*[' + req + ']*'
-                line_ending = '\n\n'
-            elif 'Table' in formatting:
-                preformatting = '|'
-                # Handle both |a|b|c| and a|b|c
-                description = '|'.join([x for x in reqmodule.reqs.nodes[req]['Description'].split('|') if x])
-                if 'Heading' in formatting:
-                    description = ' Req-Id |' + description
-                    description += '\n' + '|' + '|'.join(['-'*len(x) for x in description.split('|') if x])
-                req_nr_format = '*' + req + '* |'
-                line_ending = ' |\n'
-            elif 'BulletList' in formatting:
-                if '_' in formatting:
-                    bullet_level = int(formatting.split('_')[1])
-                else:
-                    bullet_level = 1
-                preformatting = '  '*bullet_level + '- '
-                description = reqmodule.reqs.nodes[req]['Description']
-                req_nr_format = '*[' + req + ']*'
-                line_ending = '\n\n'
-            elif 'Italic' in formatting:
-                preformatting = ''
-                description = '*' + reqmodule.reqs.nodes[req]['Description'] + '*'
-                req_nr_format = '*[' + req + ']*'
-                line_ending = '\n\n'
-            else:
-                preformatting = ''
-                description = reqmodule.reqs.nodes[req]['Description']
-                req_nr_format = '*[' + req + ']*'
-                line_ending = '\n\n'
 
-            if reqmodule.reqs.nodes[req]['Type'] == 'Requirement' or \
-               reqmodule.reqs.nodes[req]['Type'] == 'Testcase':
-                description = req_nr_format + ' ' + description
-            md_text = preformatting + description
+def get_markdown_formatter(formatting):
+    if formatting not in markdown_formatters:
+        markdown_formatters[formatting] = compile_markdown_formatting(formatting)
+    return markdown_formatters[formatting]
 
-            md_text += line_ending
 
-            md_file.write(md_text)
-        md_file.close()
+# Renders a module from (req, formatting, description, type) rows
+def render_markdown(header, rows):
+    md_text = [header]
+    for req, formatting, description, req_type in rows:
+        preformatting, description, req_nr_format, line_ending = get_markdown_formatter(formatting)(req, description)
+        if req_type == 'Requirement' or req_type == 'Testcase':
+            description = req_nr_format + ' ' + description
+        md_text.append(preformatting + description + line_ending)
+    return ''.join(md_text)
 
-    # Export all submodules recursivly
-    for submodule in reqmodule.modules.values():
-        convert_to_markdown(submodule, hugo=hugo)
+
+def convert_to_markdown(reqmodule, hugo=False):
+    paths = []
+    jobs = []
+    for module in reqmodule.get_module_tree():
+        if not is_exported(module):
+            continue
+
+        if hugo:
+            if not os.path.exists(module.module_path + "/Requirements/"):
+                os.makedirs(module.module_path + "/Requirements/")
+            paths.append(module.module_path + "/Requirements/" + "index.md")
+            header = ('---\n'
+                      'title: ' + os.path.basename(module.module_path) + '\n'
+                      'weight: 1\n'
+                      'markup: mmark\n'
+                      '---\n')
+        else:
+            paths.append(module.module_path + "/" + module.module_prefix + ".md")
+            header = ''
+
+        rows = []
+        for req in module.ordered_req_names:
+            node = module.reqs.nodes[req]
+            rows.append((req, node.get('Formatting', ''), node['Description'], node['Type']))
+        jobs.append((header, rows))
+
+    for path, (header, rows) in zip(paths, jobs):
+        with open(path, 'w') as md_file:
+            md_file.write(render_markdown(header, rows))
 
 
 def create_report(project, reqmodule_name, dont_show_output=False, at_every_level=False, hugo=False):
+    from bokeh.io import output_file, show, save
+    from bokeh.layouts import column
+    from bokeh.embed import json_item
 
     graphs = column()
     if reqmodule_name:
@@ -149,9 +227,17 @@ def create_report(project, reqmodule_name, dont_show_output=False, at_every_leve
     if not hugo:
         output_file(reqmodule.module_path + "/" + reqmodule.module_prefix + "_relations_report.html")
 
+    # One layout of all reqs related to the module, each req plot shows its part of it
+    subgraphs = {}
+    related = set()
     for req in reqmodule.ordered_req_names:
-        tree = get_tree_graph(reqmodule, req)
-        subgraph, _, _ = reqmodule.get_related_reqs(req, reqmodule.reqs)
+        subgraphs[req], _, _ = reqmodule.get_related_reqs(req, reqmodule.reqs)
+        related.update(subgraphs[req].nodes)
+    pos = get_graph_layout(reqmodule.reqs.subgraph(related), reqmodule.module_path) if related else {}
+
+    for req in reqmodule.ordered_req_names:
+        tree = get_tree_graph(reqmodule, req, pos)
+        subgraph = subgraphs[req]
         table = get_table_of_subgraph_reqs(subgraph, reqmodule.fields)
         graphs.children.append(tree)
         graphs.children.append(table)
@@ -187,74 +273,21 @@ def create_report(project, reqmodule_name, dont_show_output=False, at_every_leve
 
 
 
-def get_empty_struct():
-    req_group_fields = ['Req-Ids', 'result', 'leaves', 'fully-tested', 'Description']
-    return {k: [] for k in req_group_fields}
-
-def get_test_result(reqs, reqmodule, req_graph, passed_reqs, failed_reqs, fully_tested_reqs):
-    result = get_empty_struct()
-    for req in reqs['Req-Ids']:
-        subgraph, ancestors, descendants = reqmodule.get_related_reqs(req, req_graph)
-        leaves = [v for v, d in subgraph.out_degree() if d == 0]
-        passed = 0
-        failed = 0
-
-
-        for leaf in leaves:
-            if 'Type' in subgraph.nodes[leaf].keys() and subgraph.nodes[leaf]['Type'] == 'Test-Result':
-                if subgraph.nodes[leaf]['result'] == 'Passed':
-                    passed += 1
-                else:
-                    failed += 1
-        if passed == len(leaves) and fully_tested_reqs:
-            passed_reqs['Req-Ids'].append(req)
-            passed_reqs['leaves'].append(leaves)
-            passed_reqs['result'].append('passed')
-            passed_reqs['fully-tested'].append(True)
-            passed_reqs['Description'].append(reqmodule.reqs.nodes[req]['Description'])
-
-        elif failed > 0:
-            failed_reqs['Req-Ids'].append(req)
-            failed_reqs['leaves'].append(leaves)
-            failed_reqs['result'].append('failed')
-            failed_reqs['fully-tested'].append(fully_tested_reqs)
-            failed_reqs['Description'].append(reqmodule.reqs.nodes[req]['Description'])
-        else:
-            result['Req-Ids'].append(req)
-            result['leaves'].append(leaves)
-            result['result'].append('failed' if failed > 0 else ('partly tested' if passed > 0 else 'untested'))
-            result['fully-tested'].append(fully_tested_reqs)
-            result['Description'].append(reqmodule.reqs.nodes[req]['Description'])
-
-    return result
-
 def draw_coverage_diagrams(reqmodule, dont_show_output=False):
-    only_reqs_subgraph = reqmodule.get_reqs_with_attr(('Type', 'Requirement'))
-    reqs_test_testresult_subgraph = reqmodule.get_reqs_with_attr([('Type', 'Requirement'), ('Type', 'Testcase'), ('Type', 'Test-Result')])
-    total_reqs = len(only_reqs_subgraph.nodes)
-
-    req_group_fields = ['Req-Ids', 'result', 'leaves', 'fully-tested', 'Description']
-
-    passed_reqs = get_empty_struct()
-    failed_reqs = get_empty_struct()
-    partly_tested_reqs = get_empty_struct()
-    fully_tested_reqs = get_empty_struct()
-    untested_reqs = get_empty_struct()
-
-    partly_tested_reqs['Req-Ids'] = [n for n, r in only_reqs_subgraph.nodes.items()
-                   if 'non_stored_fields' in r.keys()
-                    and 'verifies_link_status' in r['non_stored_fields'].keys()
-                    and 0 < r['non_stored_fields']['verifies_link_status'] < 1]
-    fully_tested_reqs['Req-Ids'] = [n for n, r in only_reqs_subgraph.nodes.items()
-                   if 'non_stored_fields' in r.keys()
-                    and 'verifies_link_status' in r['non_stored_fields'].keys()
-                    and r['non_stored_fields']['verifies_link_status'] >= 1]
-    untested_reqs['Req-Ids'] = [n for n, r in only_reqs_subgraph.nodes.items()
-                   if n not in partly_tested_reqs['Req-Ids'] and n not in fully_tested_reqs['Req-Ids']]
-
-    partly_tested_reqs = get_test_result(partly_tested_reqs, reqmodule, reqs_test_testresult_subgraph, passed_reqs, failed_reqs, False)
-    fully_tested_reqs = get_test_result(fully_tested_reqs, reqmodule, reqs_test_testresult_subgraph, passed_reqs, failed_reqs, True)
-    untested_reqs = get_test_result(untested_reqs, reqmodule, reqs_test_testresult_subgraph, passed_reqs, failed_reqs, False)
+    from bokeh.models import ColumnDataSource
+    from bokeh.models.widgets import DataTable, TableColumn, Div
+    from bokeh.io import output_file, show, save
+    from bokeh.layouts import column
+    from bokeh.plotting import figure
+    from git_reqs.coverage import get_coverage_table
+    coverage = get_coverage_table(reqmodule)
+    total_reqs = len(coverage)
+
+    passed_reqs = coverage.get_group('passed')
+    failed_reqs = coverage.get_group('failed')
+    partly_tested_reqs = coverage.get_group('partly_tested')
+    fully_tested_reqs = coverage.get_group('fully_tested')
+    untested_reqs = coverage.get_group('untested')
 
     # file to save the model
     output_file(reqmodule.module_path + "/" + reqmodule.module_prefix + "_TestCoverage.html")
@@ -342,6 +375,8 @@ def draw_coverage_diagrams(reqmodule, dont_show_output=False):
         show(graphs)
 
 def get_table_of_subgraph_reqs(subgraph, fields):
+    from bokeh.models import ColumnDataSource
+    from bokeh.models.widgets import DataTable, TableColumn
     table = {k: [] for k in fields}
     columns = []
     for c in fields:
@@ -358,7 +393,67 @@ def get_table_of_subgraph_reqs(subgraph, fields):
     return DataTable(source=source, columns=columns, autosize_mode='fit_columns', width=1600,
                             height=len(table['Req-Id']) * 35 + 35)
 
-def get_tree_graph(reqmodule, req):
+# Positions of the nodes of G. With a module_path, the layouts of the weakly connected components are cached in the
+# module, and only the components that are not in the cache are laid out, in one graphviz dot run.
+def get_graph_layout(G, module_path=None):
+    if module_path is None:
+        return run_graph_layout(G)
+
+    from git_reqs.cache import layout_cache
+    cache = layout_cache(module_path)
+    components = []
+    uncached = []
+    for nodes in nx.weakly_connected_components(G):
+        component = G.subgraph(nodes)
+        key = get_layout_key(component)
+        positions = cache.get(key)
+        if positions is None:
+            uncached.append((len(components), component, key))
+        components.append((min(str(node) for node in nodes), positions))
+
+    if uncached:
+        pos = run_graph_layout(G.subgraph(set().union(*[component.nodes for _, component, _ in uncached])))
+        for i, component, key in uncached:
+            # Store the component with its top left corner in origo
+            x0 = min(pos[node][0] for node in component)
+            y0 = max(pos[node][1] for node in component)
+            positions = cache.store(key, {node: (pos[node][0] - x0, pos[node][1] - y0) for node in component})
+            components[i] = (components[i][0], positions)
+
+    # Put the components next to each other
+    pos = {}
+    x_offset = 0
+    for _, positions in sorted(components, key=lambda c: c[0]):
+        for node, (x, y) in positions.items():
+            pos[node] = (x + x_offset, y)
+        x_offset += max(x for x, _ in positions.values()) + LAYOUT_COMPONENT_SPACING
+    cache.save()
+    # The cache keeps the node names as strings
+    return {node: pos[str(node)] for node in G.nodes}
+
+
+def get_layout_key(G):
+    structure = (sorted(str(node) for node in G.nodes), sorted((str(u), str(v)) for u, v in G.edges))
+    return hashlib.sha1(repr(structure).encode('utf-8')).hexdigest()
+
+
+def run_graph_layout(G):
+    from networkx.drawing.nx_pydot import graphviz_layout
+    posG = nx.DiGraph()
+    for node, node_data in G.nodes.items():
+        # Keep only description and color when generating the position
+        posG.add_node(node, **{key: value for key, value in node_data.items() if key in ['Description', 'color']})
+    posG.add_edges_from(G.edges)
+    return graphviz_layout(posG, prog='dot')
+
+
+# Plot of the reqs related to req, or of the whole graph if req is None.
+# pos can be given with the positions of a graph containing all the plotted nodes, to avoid a layout per plot.
+def get_tree_graph(reqmodule, req, pos=None):
+    from bokeh.models import (BoxZoomTool, ResetTool, Circle, HoverTool,
+                              MultiLine, StaticLayoutProvider, ColumnDataSource, LabelSet)
+    from bokeh.palettes import Spectral4, RdGy6
+    from bokeh.plotting import figure, from_networkx
     color_mapper = {'black': RdGy6[1], 'gray': RdGy6[2], 'red': Spectral4[3], 'green': Spectral4[1]}
     colors = []
     special_pos = {}
@@ -377,8 +472,7 @@ def get_tree_graph(reqmodule, req):
 
     fields = [("Req-Id", "@index")]
     drawG = G.copy()
-    posG = G.copy()
-    for node, node_data in posG.nodes.items():
+    for node, node_data in G.nodes.items():
         for key in list(node_data.keys()):
             # Get all fields from all nodes to generate the tooltip
             if not "Req-Id" in key and not isinstance(node_data[key], dict):
@@ -388,10 +482,6 @@ def get_tree_graph(reqmodule, req):
                     drawG.nodes[node][sub_key] = str(node_data[key][sub_key])
                     fields.append(("\"" + sub_key + "\"", "\"@" + sub_key + "\""))
 
-            # Pop all all but description and color when generating the position
-            if key not in ['Description', 'color']:
-                node_data.pop(key)
-
         # Get color info for the nodes
         if req and node is req:
             colors.append(Spectral4[2])
@@ -403,9 +493,12 @@ def get_tree_graph(reqmodule, req):
     fields = list(set(fields))
 
 
-    pos = graphviz_layout(posG, prog='dot')
-    for spn, spp in special_pos.items():
-        pos[spn] = (pos[spn][0] + spp[0], pos[spn][1] + spp[1])
+    if pos is None:
+        pos = get_graph_layout(G, reqmodule.module_path)
+        for spn, spp in special_pos.items():
+            pos[spn] = (pos[spn][0] + spp[0], pos[spn][1] + spp[1])
+    else:
+        pos = {node: pos[node] for node in G.nodes}
     x, y = zip(*pos.values())
 
 
@@ -441,6 +534,7 @@ def get_tree_graph(reqmodule, req):
     return plot
 
 def draw_bokeh(reqmodule, req=None):
+    from bokeh.io import output_file, show
     plot = get_tree_graph(reqmodule, req)
     output_file(reqmodule.module_path + "/" + reqmodule.module_prefix + "_networkx_graph.html")
     show(plot)
@@ -0,0 +1,56 @@
+import hashlib
+import itertools
+import time
+
+TIME_HASH_LENGTH = 5
+
+
+# Keeps track of the used req ids of a module and hands out new ones.
+# The ids are kept both in a list, in the order of used-ids.yaml, and in a set for the lookups.
+class id_allocator:
+    def __init__(self, used_ids=(), number_format='numbers', next_id=0):
+        self.number_format = number_format
+        self.next_id = next_id
+        self.ids = []
+        self.id_set = set()
+        self.counter = itertools.count()
+        for id in used_ids:
+            self.add(id)
+
+    def __contains__(self, id):
+        return id in self.id_set
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, id):
+        if id not in self.id_set:
+            self.id_set.add(id)
+            self.ids.append(id)
+
+    # Returns n new ids, which are marked as used
+    def allocate(self, n=1):
+        new_ids = []
+        for _ in range(n):
+            if self.number_format == 'time_hash':
+                id = self.get_time_hash()
+            else:
+                id = str(self.next_id)
+                self.next_id += 1
+                while id in self.id_set:
+                    id = str(self.next_id)
+                    self.next_id += 1
+            self.add(id)
+            new_ids.append(id)
+        return new_ids
+
+    def get_time_hash(self):
+        while True:
+            # The counter makes every attempt unique, also within the resolution of the clock
+            seed = '%s-%d' % (time.time(), next(self.counter))
+            id = hashlib.sha1(seed.encode('utf-8')).hexdigest()[:TIME_HASH_LENGTH]
+            if id not in self.id_set:
+                return id
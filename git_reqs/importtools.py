@@ -1,13 +1,26 @@
-from openpyxl import load_workbook
 import os
-import yaml
-from pathlib import Path
+from git_reqs import yamlio
 import re
+import time
+import mmap
+import itertools
+import concurrent.futures
 import networkx as nx
 
+# Number of imported rows added to the module at a time
+IMPORT_BATCH_SIZE = 1000
+# Source files without this are not searched for req links
+SOURCE_LINK_MARKER = b'git-reqs:'
+# Links found in each source file and the commit of the last scan
+SOURCE_LINKS_FILE = 'source-links.yaml'
+
+
 def import_from_xls(reqmodule, req_xls, wb=None):
+    close_wb = not wb
     if not wb:
-        wb = load_workbook(req_xls)
+        from openpyxl import load_workbook
+        # Read-only workbooks are streamed from the file, rows are not kept in memory
+        wb = load_workbook(req_xls, read_only=True)
 
     if reqmodule.module_prefix in wb.sheetnames:
         sheet = wb[reqmodule.module_prefix]
@@ -18,25 +31,49 @@ def import_from_xls(reqmodule, req_xls, wb=None):
         print(reqmodule.module_prefix)
         reqmodule.clear_ordered_req_list()
 
-        fields = [field.value for field in list(sheet.iter_rows(1, 1))[0]]
-        req = {}
-        for row in range(2, sheet.max_row+1):
+        start_time = time.time()
+        rows = sheet.iter_rows(values_only=True)
+        fields = list(next(rows, []))
+        row_count = 0
+        batch = []
+        for row in rows:
+            row_count += 1
+            req = {}
             for col, field in enumerate(fields):
                 # Don't consider columns with empty field name,
                 # empty fields
                 # nor the 'non_stored_fields' columns
                 if field and field != 'non_stored_fields':
-                    req[field] = sheet.cell(row, col+1).value
+                    req[field] = row[col] if col < len(row) else None
                     if not req[field] or req[field] == 'None':
                         req[field] = ''
 
             # Check that the requirement is not empty before adding
             if [f for f in req.values() if f]:
-                reqmodule.add_req(req)
+                batch.append(req)
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    add_req_batch(reqmodule, batch)
+                    batch = []
+        add_req_batch(reqmodule, batch)
+
+        duration = max(time.time() - start_time, 1e-6)
+        print('%d rows in %.2f s, %.0f rows/s' % (row_count, duration, row_count/duration))
 
     for submodule in reqmodule.modules.values():
         import_from_xls(submodule, req_xls, wb=wb)
 
+    if close_wb:
+        wb.close()
+
+
+# Adds imported reqs in order, the new reqs get their ids in one allocation
+def add_req_batch(reqmodule, batch):
+    new_reqs = [req for req in batch if not req.get('Req-Id')]
+    for req, req_name in zip(new_reqs, reqmodule.allocate_req_names(len(new_reqs))):
+        req['Req-Id'] = req_name
+    for req in batch:
+        reqmodule.add_req(req)
+
 
 def import_from_markdown(reqmodule, req_md):
     req = {}
@@ -59,12 +96,14 @@ def import_from_markdown(reqmodule, req_md):
                 req['Description'] = req['Description'] + md_line
             md_line = md_file.readline()
 
-def check_for_req_links_and_update(reqmodule, string, string_changed):
+# Adds the req link of a source line, if any, to the downward_links of the linked req. The links found are
+# appended to found_links as (req, link) if given, and the ones not already in downward_links to added_links.
+def check_for_req_links_and_update(reqmodule, string, string_changed, found_links=None, added_links=None):
     pattern = reqmodule.get_link_regex()
     res = re.search(pattern, string)
     if res:
         dest_req_id = reqmodule.module_prefix + '_' + res.groups()[2].replace("\"", "")
-        dest_req = reqmodule.reqs.nodes[dest_req_id]
+        assert dest_req_id in reqmodule.reqs, "Linked req %s not found" % dest_req_id
 
         link_name = res.groups()[0].split(':')
         # Create a new req/test if required
@@ -82,35 +121,195 @@ def check_for_req_links_and_update(reqmodule, string, string_changed):
             name = res.groups()[0].split(':')[0]
 
         link = ':'.join([res.groups()[1], name])
-        if not link in dest_req['downward_links']:
-            if not dest_req['downward_links'] == "":
-                dest_req['downward_links'] += ','
-            dest_req['downward_links'] += link
+        if found_links is not None:
+            found_links.append((dest_req_id, link))
+        if reqmodule.req_links.add(dest_req_id, link) and added_links is not None:
+            added_links.add((dest_req_id, link))
 
     return string, string_changed
 
 
+def remove_downward_link(reqmodule, req_id, link):
+    if req_id in reqmodule.reqs:
+        reqmodule.req_links.remove(req_id, link)
+
+
+# Returns the source files under the source paths having any of the extensions, found in one walk per path
+def find_source_files(source_root, source_paths, source_extensions):
+    suffixes = get_source_suffixes(source_extensions)
+    files = []
+    found = set()
+    for src_pth in source_paths:
+        for root, dirs, names in os.walk(source_root + '/' + src_pth):
+            for name in names:
+                if name.endswith(suffixes):
+                    path = os.path.abspath(os.path.join(root, name))
+                    if path not in found:
+                        found.add(path)
+                        files.append(path)
+    return files
+
+
+# Returns the paths that are source files, by their source path and extension, also for deleted files
+def find_source_files_in(paths, source_root, source_paths, source_extensions):
+    suffixes = get_source_suffixes(source_extensions)
+    roots = [os.path.abspath(source_root + '/' + src_pth) + os.sep for src_pth in source_paths]
+    return [path for path in paths if path.endswith(suffixes) and any(path.startswith(root) for root in roots)]
+
+
+def get_source_suffixes(source_extensions):
+    return tuple('.' + ext for ext in source_extensions)
+
+
+# Returns the lines of a source file with req links, as (line number, line). The file is first searched for
+# the link marker through mmap, and only read as text when it is found.
+def scan_source_file(path, pattern):
+    with open(path, 'rb') as src_file:
+        if os.fstat(src_file.fileno()).st_size == 0:
+            return []
+        with mmap.mmap(src_file.fileno(), 0, access=mmap.ACCESS_READ) as src_map:
+            if src_map.find(SOURCE_LINK_MARKER) < 0:
+                return []
+
+    with open(path, 'r', newline='') as src_file:
+        return [(line_nr, line) for line_nr, line in enumerate(src_file) if pattern.search(line)]
+
+
+def load_source_link_state(reqmodule):
+    state_path = reqmodule.module_path + '/' + SOURCE_LINKS_FILE
+    if os.path.exists(state_path):
+        with open(state_path, 'r') as state_file:
+            state = yamlio.load(state_file)
+    else:
+        state = {}
+    state.setdefault('commit', None)
+    state.setdefault('links', {})
+    # The links added to downward_links by the scans. Older states did not keep them, then all links found were.
+    state.setdefault('added', [l for links in state['links'].values() for l in links])
+    # The source files that differed from the commit when they were scanned. They may have been reverted since,
+    # and then no longer differ from it, so they are always scanned again.
+    state.setdefault('dirty', [])
+    return state
 
-def parse_requirement_links(reqmodule, source_root):
+
+# Returns the absolute paths changed since the commit of the last scan, in commits or in the working tree,
+# or None if the changes can't be found and everything has to be scanned.
+def get_changed_files(reqmodule, state):
+    import git
+    git_repo = reqmodule.git_repo
+    if not git_repo or not state['commit']:
+        return None
+    try:
+        changed = git_repo.git.diff('--name-only', '--no-renames', state['commit']).splitlines()
+    except git.GitCommandError:
+        return None
+    changed += git_repo.untracked_files
+    changed = [os.path.abspath(os.path.join(git_repo.working_tree_dir, path)) for path in changed]
+    changed += [os.path.abspath(os.path.join(reqmodule.module_path, path)) for path in state['dirty']]
+    return list(dict.fromkeys(changed))
+
+
+# Returns the absolute paths that differ from HEAD in the working tree, or are untracked
+def get_working_tree_changes(git_repo):
+    changed = git_repo.git.diff('--name-only', '--no-renames', 'HEAD').splitlines() + git_repo.untracked_files
+    return [os.path.abspath(os.path.join(git_repo.working_tree_dir, path)) for path in changed]
+
+
+def scan_source_files(reqmodule, files, file_links, workers=None, added_links=None):
+    pattern = reqmodule.get_link_regex()
+
+    # Files are scanned in worker threads, the links are added to the reqs here, in file order
+    linked_files = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for path, link_lines in zip(files, executor.map(scan_source_file, files, itertools.repeat(pattern))):
+            if not link_lines:
+                continue
+            linked_files += 1
+            file_changed = False
+            changed_lines = {}
+            found_links = []
+            for line_nr, line in link_lines:
+                new_line, file_changed = check_for_req_links_and_update(reqmodule, line, file_changed, found_links,
+                                                                        added_links)
+                if new_line != line:
+                    changed_lines[line_nr] = new_line
+            if found_links:
+                file_links[os.path.relpath(path, reqmodule.module_path)] = [list(l) for l in found_links]
+
+            # Only files with new reqs from ? annotations are written
+            if changed_lines:
+                with open(path, 'r', newline='') as src_file:
+                    lines = src_file.readlines()
+                for line_nr, line in changed_lines.items():
+                    lines[line_nr] = line
+                with open(path + "_tmp", 'w', newline='') as new_src_file:
+                    new_src_file.writelines(lines)
+                os.replace(path + "_tmp", path)
+                print('Updated source file: %s' % path)
+    return linked_files
+
+
+# Adds req links from source comments to the reqs. The links found in each file are kept in source-links.yaml
+# next to the module config, so the links of changed or deleted files can be retracted when they are scanned again.
+# With incremental, only the files changed since the last scanned commit and in the working tree are scanned.
+def parse_requirement_links(reqmodule, source_root, workers=None, incremental=False):
     if reqmodule.config['req_version'] >= 0.3:
-        for src_pth in reqmodule.config['source_paths']:
-            for ext in reqmodule.config['source_extensions']:
-                files = Path(source_root + '/' + src_pth).rglob('*.' + ext)
-                for f in files:
-                    print('Checking source file: %s' % f.name)
-                    with open(f.absolute(), 'r') as src_file:
-                        with open(str(f.absolute()) + "_tmp", 'w') as new_src_file:
-                            file_changed = False
-                            for line_nr, line in enumerate(src_file):
-                                line, file_changed = check_for_req_links_and_update(reqmodule, line, file_changed)
-                                new_src_file.write(line)
-
-                    if file_changed:
-                        os.remove(f.absolute())
-                        os.rename(str(f.absolute()) + "_tmp", f.absolute())
-                    else:
-                        os.remove(str(f.absolute()) + "_tmp")
-        reqmodule.write_reqs()
+        from git_reqs.requirementmodule import git_stage
+        start_time = time.time()
+        state = load_source_link_state(reqmodule)
+        file_links = state['links']
+        added_links = set(tuple(l) for l in state['added'])
+
+        changed = get_changed_files(reqmodule, state) if incremental else None
+        if changed is None:
+            if incremental:
+                print('No previous scan commit found, scanning all source files')
+            files = find_source_files(source_root, reqmodule.config['source_paths'],
+                                      reqmodule.config['source_extensions'])
+            scanned = set(os.path.relpath(path, reqmodule.module_path) for path in files)
+            # Files that are gone are scanned as empty
+            scanned |= set(file_links.keys())
+        else:
+            source_files = find_source_files_in(changed, source_root, reqmodule.config['source_paths'],
+                                                reqmodule.config['source_extensions'])
+            files = [path for path in source_files if os.path.isfile(path)]
+            scanned = set(os.path.relpath(path, reqmodule.module_path) for path in source_files)
+
+        # Retract the links of the scanned files, unless they are found again. Links that were in downward_links
+        # before a scan found them were written by hand, and are kept.
+        retracted = set()
+        for path in scanned:
+            for req_id, link in file_links.pop(path, []):
+                retracted.add((req_id, link))
+
+        linked_files = scan_source_files(reqmodule, files, file_links, workers, added_links)
+
+        kept = set((req_id, link) for links in file_links.values() for req_id, link in links)
+        for req_id, link in (retracted - kept) & added_links:
+            remove_downward_link(reqmodule, req_id, link)
+        added_links &= kept
+
+        print('Checked %d source files, %d with req links, in %.2f s' % (len(files), linked_files,
+                                                                        time.time() - start_time))
+
+        stage = git_stage()
+        reqmodule.write_reqs(stage)
+        if reqmodule.git_repo:
+            try:
+                state['commit'] = reqmodule.git_repo.head.commit.hexsha
+                dirty = find_source_files_in(get_working_tree_changes(reqmodule.git_repo), source_root,
+                                             reqmodule.config['source_paths'], reqmodule.config['source_extensions'])
+                state['dirty'] = sorted(os.path.relpath(path, reqmodule.module_path) for path in dirty)
+            except ValueError:
+                # No commits yet
+                state['commit'] = None
+                state['dirty'] = []
+        state['links'] = file_links
+        state['added'] = [list(l) for l in sorted(added_links)]
+        with open(reqmodule.module_path + '/' + SOURCE_LINKS_FILE, 'w') as state_file:
+            yamlio.dump(state, state_file)
+        stage.add(reqmodule.git_repo, reqmodule.module_path + '/' + SOURCE_LINKS_FILE)
+        stage.flush()
 
     else:
         print('Requirement link parsing is only available from req version 0.3 and up')
@@ -119,10 +318,10 @@ def parse_requirement_links(reqmodule, source_root):
 def add_test_results(module_path, test_results_file):
     if os.path.exists(module_path + '/test_results.temp.yaml'):
         with open(module_path + '/test_results.temp.yaml', 'r') as testlist_file:
-            test_result_files = yaml.safe_load(testlist_file)
+            test_result_files = yamlio.load(testlist_file)
             test_result_files.append(test_results_file)
     else:
         test_result_files = [test_results_file]
 
     with open(module_path + '/test_results.temp.yaml', 'w') as testlist_file:
-        yaml.dump(test_result_files, testlist_file)
+        yamlio.dump(test_result_files, testlist_file)
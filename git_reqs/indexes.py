@@ -0,0 +1,218 @@
+from git_reqs.linkstatus import LINK_FIELDS, parse_links
+
+# Node attributes kept in the attr_index, stored fields and fields in non_stored_fields
+INDEXED_FIELDS = ['Type', 'Status', 'Formatting']
+INDEXED_NON_STORED_FIELDS = ['color', 'Internal']
+
+
+# Resolves requirement names written without the full module prefix.
+#
+# A link to Y_z from the module A_B_C is searched for as A_B_C_Y_z, A_B_Y_z, A_Y_z and Y_z, and the first existing
+# name is used. Instead of trying every prefix, each name is indexed by all its endings, so the lookup only has to
+# check the few names ending with Y_z.
+class req_name_index:
+    def __init__(self, names=()):
+        self.by_suffix = {}
+        self.prefixes = {}
+        for name in names:
+            self.add(name)
+
+    def __contains__(self, name):
+        return name in self.prefixes
+
+    def __len__(self):
+        return len(self.prefixes)
+
+    def add(self, name):
+        if name in self.prefixes:
+            return
+        parts = tuple(str(name).split('_'))
+        self.prefixes[name] = parts[:-1]
+        for i in range(len(parts)):
+            self.by_suffix.setdefault('_'.join(parts[i:]), {})[name] = parts[:i]
+
+    def remove(self, name):
+        parts = self.prefixes.pop(name, None)
+        if parts is None:
+            return
+        parts = parts + (str(name).split('_')[-1],)
+        for i in range(len(parts)):
+            suffix = '_'.join(parts[i:])
+            names = self.by_suffix[suffix]
+            names.pop(name, None)
+            if not names:
+                self.by_suffix.pop(suffix)
+
+    def get_prefix(self, name):
+        if name in self.prefixes:
+            return self.prefixes[name]
+        return tuple(str(name).split('_')[:-1])
+
+    # Returns the name matching the longest part of the module prefix, or the name itself if nothing matches
+    def resolve(self, name, prefix):
+        found = name
+        found_depth = -1
+        for candidate, head in self.by_suffix.get(name, {}).items():
+            depth = len(head)
+            if found_depth < depth <= len(prefix) and prefix[:depth] == head:
+                found = candidate
+                found_depth = depth
+        return found
+
+
+# Links of the reqs, per req and link field, as ordered sets of 'type:id' keys with the parsed (type, id) as values.
+# The link fields of the nodes are still the comma separated strings that are stored, each field is parsed when it
+# is first used and written back when the links change. A field that is changed directly in the node is parsed again.
+class link_index:
+    def __init__(self, reqs):
+        self.reqs = reqs
+        self.links = {}
+
+    def get(self, req, field='downward_links'):
+        value = self.reqs.nodes[req].get(field, '') if req in self.reqs else ''
+        entry = self.links.get((req, field))
+        if entry is None or (entry[0] is not value and entry[0] != value):
+            links = {}
+            for link_type, linked_req in parse_links(str(value) if value else ''):
+                links[link_type + ':' + linked_req] = (link_type, linked_req)
+            entry = (value, links)
+            self.links[(req, field)] = entry
+        return entry[1]
+
+    def has(self, req, link, field='downward_links'):
+        return link in self.get(req, field)
+
+    # Returns True if the link was added
+    def add(self, req, link, field='downward_links'):
+        links = self.get(req, field)
+        link_type, linked_req = [part.strip() for part in link.split(':', 1)]
+        link = link_type + ':' + linked_req
+        if link in links:
+            return False
+        links[link] = (link_type, linked_req)
+        self.store(req, field, links)
+        return True
+
+    # Returns True if the link was removed
+    def remove(self, req, link, field='downward_links'):
+        links = self.get(req, field)
+        if links.pop(link, None) is None:
+            return False
+        self.store(req, field, links)
+        return True
+
+    def store(self, req, field, links):
+        value = ','.join(links)
+        self.reqs.nodes[req][field] = value
+        self.links[(req, field)] = (value, links)
+
+    def forget(self, req):
+        for field in LINK_FIELDS:
+            self.links.pop((req, field), None)
+
+
+# Finds which of a set of words occur in a text, in one pass over the text (Aho-Corasick).
+# Each state of the automaton is a dict of the following characters, the fail link to the longest proper suffix
+# state, and the words ending in the state, including those of the suffix states.
+class substring_index:
+    def __init__(self, words):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for word in words:
+            self.add(word)
+        self.build()
+
+    def add(self, word):
+        if not word:
+            return
+        state = 0
+        for char in word:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][char] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+            state = next_state
+        self.output[state].append(word)
+
+    def build(self):
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, next_state in self.goto[state].items():
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+                queue.append(next_state)
+
+    # Returns the set of words found in text
+    def search(self, text):
+        found = set()
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found.update(output[state])
+        return found
+
+
+# Reqs per value of the commonly queried node attributes, so that filtering on them does not scan the whole graph.
+# Nodes added to the graph without the index knowing are indexed on the next lookup. Changes to the attributes
+# of an indexed node must be given to update().
+class attr_index:
+    def __init__(self, reqs):
+        self.reqs = reqs
+        self.nodes = {field: {} for field in INDEXED_FIELDS + INDEXED_NON_STORED_FIELDS}
+        self.node_values = {}
+        for node in reqs.nodes:
+            self.update(node)
+
+    def __contains__(self, field):
+        return field in self.nodes
+
+    def update(self, node):
+        self.remove(node)
+        data = self.reqs.nodes[node]
+        non_stored_fields = data.get('non_stored_fields') or {}
+        values = {}
+        for field in INDEXED_FIELDS + INDEXED_NON_STORED_FIELDS:
+            source = data if field in INDEXED_FIELDS else non_stored_fields
+            if field in source:
+                try:
+                    self.nodes[field].setdefault(source[field], {})[node] = True
+                    values[field] = source[field]
+                except TypeError:
+                    # Unhashable values can't be looked up
+                    pass
+        self.node_values[node] = values
+
+    def remove(self, node):
+        for field, value in self.node_values.pop(node, {}).items():
+            nodes = self.nodes[field][value]
+            nodes.pop(node, None)
+            if not nodes:
+                self.nodes[field].pop(value)
+
+    def sync(self):
+        if len(self.node_values) != len(self.reqs):
+            for node in [n for n in self.node_values if n not in self.reqs]:
+                self.remove(node)
+            for node in [n for n in self.reqs.nodes if n not in self.node_values]:
+                self.update(node)
+
+    # Returns the reqs having the value of the field, in the order they were indexed
+    def get(self, field, value):
+        self.sync()
+        try:
+            return list(self.nodes[field].get(value, {}))
+        except TypeError:
+            return []
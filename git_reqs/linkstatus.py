@@ -0,0 +1,206 @@
+import re
+import networkx as nx
+
+LINK_FIELDS = ['upward_links', 'downward_links']
+PARTLY_LINK_PATTERN = re.compile(r'partly_(.+)\((\d+(?:\.\d+)?)/(\d+(?:\.\d+)?)\)$')
+
+
+def get_link_fulfillment(link_type):
+    # partly_verifies(1/2) counts as half a verifies link
+    match = PARTLY_LINK_PATTERN.match(link_type)
+    if match:
+        return match.group(1) + '_link_status', float(match.group(2))/float(match.group(3))
+    return link_type + '_link_status', 1
+
+
+def parse_links(links):
+    parsed = []
+    for link in links.split(','):
+        if ':' in link:
+            link_type, linked_req = link.split(':', 1)
+            parsed.append((link_type.strip(), linked_req.strip()))
+    return parsed
+
+
+# Computes the *_link_status values of the requirement graph.
+#
+# A requirements status for a link type is the sum of the fulfillment of its own outgoing links of that type,
+# limited by the mean status of all its descendants having that link type.
+# The statuses are calculated in one pass over the graph in reverse topological order (cycles are condensed),
+# and the per type (sum, count) of the descendants are added up from the children as long as no relevant
+# requirement can be reached through two paths. Only then the descendants are collected explicitly.
+#
+# update() recalculates only the given requirements and their ancestors.
+class link_status_engine:
+    def __init__(self, reqs, req_names, req_links=None):
+        from git_reqs.indexes import link_index
+        self.reqs = reqs
+        # Index used to find the full name of linked reqs
+        self.req_names = req_names
+        self.req_links = req_links if req_links is not None else link_index(reqs)
+        # Edges created from the link fields of each requirement, and how many requirements declare them
+        self.created_edges = {}
+        self.edge_refs = {}
+        # Per node: own status, (sum, count) of the descendants statuses, and the shape of the graph below
+        self.status = {}
+        self.sub_status = {}
+        self.relevant = {}
+        self.join_below = {}
+
+    def link_req(self, req):
+        touched = self.unlink_req(req)
+        created = []
+        for field in LINK_FIELDS:
+            # Create links between linked nodes
+            for link_type, linked_req in list(self.req_links.get(req, field).values()):
+                # Don't add project prefix to extern links
+                if 'extern' not in link_type:
+                    linked_req = self.req_names.resolve(linked_req, self.req_names.get_prefix(req))
+
+                # Verify that the requirement is not linked two ways.
+                uptest = self.reqs.has_edge(linked_req, req) and \
+                    self.reqs.edges[(linked_req, req)].get('type') == link_type
+                downtest = self.reqs.has_edge(req, linked_req) and \
+                    self.reqs.edges[(req, linked_req)].get('type') == link_type
+                assert (not (uptest and downtest))
+
+                if linked_req not in self.reqs:
+                    self.reqs.add_node(linked_req, non_stored_fields={'Internal': False,
+                                                                      'color': 'gray',
+                                                                      'link_status_updated': False})
+                    self.req_names.add(linked_req)
+                if "upward" in field:
+                    edge = (linked_req, req)
+                else:
+                    edge = (req, linked_req)
+                self.reqs.add_edge(edge[0], edge[1], type=link_type)
+                self.edge_refs[edge] = self.edge_refs.get(edge, 0) + 1
+                created.append(edge)
+                touched.add(linked_req)
+
+        if created:
+            self.created_edges[req] = created
+        touched.add(req)
+        return touched
+
+    def unlink_req(self, req):
+        touched = set()
+        for edge in self.created_edges.pop(req, []):
+            self.edge_refs[edge] -= 1
+            if self.edge_refs[edge] == 0:
+                self.edge_refs.pop(edge)
+                if self.reqs.has_edge(*edge):
+                    self.reqs.remove_edge(*edge)
+            touched.update(edge)
+        return touched
+
+    def update_all(self):
+        for req in list(self.reqs.nodes):
+            self.link_req(req)
+        self.status = {}
+        self.sub_status = {}
+        self.compute(set(self.reqs.nodes))
+
+    def update(self, reqs):
+        touched = set()
+        for req in reqs:
+            touched |= self.link_req(req)
+        self.compute(self.get_affected(touched))
+
+    def forget(self, req):
+        for d in [self.status, self.sub_status, self.relevant, self.join_below]:
+            d.pop(req, None)
+
+    def get_affected(self, touched):
+        affected = set(t for t in touched if t in self.reqs)
+        for req in list(affected):
+            affected |= nx.ancestors(self.reqs, req)
+
+        # Descendants that never got a status must be calculated first
+        stack = list(affected)
+        while stack:
+            for child in self.reqs.successors(stack.pop()):
+                if child not in affected and child not in self.status:
+                    affected.add(child)
+                    stack.append(child)
+        return affected
+
+    def compute(self, nodes):
+        condensed = nx.condensation(self.reqs.subgraph(nodes))
+        for component in reversed(list(nx.topological_sort(condensed))):
+            members = condensed.nodes[component]['members']
+            if len(members) == 1:
+                req = next(iter(members))
+                if not self.reqs.has_edge(req, req):
+                    self.compute_req(req)
+                    continue
+            self.compute_cycle(members)
+
+    def get_own_status(self, req):
+        own = {}
+        for _, _, link_type in self.reqs.out_edges(req, data='type'):
+            if link_type:
+                status_type, fulfillment = get_link_fulfillment(link_type)
+                own[status_type] = own.get(status_type, 0) + fulfillment
+        return own
+
+    def compute_req(self, req):
+        own = self.get_own_status(req)
+        children = list(self.reqs.successors(req))
+        join_below = any(self.join_below[c] or (self.relevant[c] and self.reqs.in_degree(c) > 1)
+                         for c in children)
+
+        if join_below:
+            sub_status = self.sum_status(nx.descendants(self.reqs, req))
+        else:
+            # Every relevant descendant is reached through exactly one child, so the sums can be added up
+            sub_status = {}
+            for child in children:
+                for status_type, value in self.status[child].items():
+                    s, n = sub_status.get(status_type, (0, 0))
+                    sub_status[status_type] = (s + value, n + 1)
+                for status_type, (value, count) in self.sub_status[child].items():
+                    s, n = sub_status.get(status_type, (0, 0))
+                    sub_status[status_type] = (s + value, n + count)
+
+        self.store(req, own, sub_status)
+        self.relevant[req] = bool(self.status[req]) or any(self.relevant[c] for c in children)
+        self.join_below[req] = join_below
+
+    def compute_cycle(self, members):
+        # Requirements in a cycle are all descendants of each other, use their own statuses for each other
+        for req in members:
+            self.status[req] = self.get_own_status(req)
+        for req in members:
+            self.store(req, self.status[req], self.sum_status(nx.descendants(self.reqs, req)))
+            self.relevant[req] = True
+            self.join_below[req] = True
+
+    def sum_status(self, descendants):
+        sub_status = {}
+        for descendant in descendants:
+            for status_type, value in self.status[descendant].items():
+                s, n = sub_status.get(status_type, (0, 0))
+                sub_status[status_type] = (s + value, n + 1)
+        return sub_status
+
+    def store(self, req, own, sub_status):
+        status = dict(own)
+        # If the sub requirement is not fully fulfilled for a certain link type, inherit the mean fulfillment.
+        for status_type, (value, count) in sub_status.items():
+            if status_type in status:
+                status[status_type] = min(status[status_type], value/count)
+            else:
+                status[status_type] = value/count
+
+        self.status[req] = status
+        self.sub_status[req] = sub_status
+
+        node = self.reqs.nodes[req]
+        if 'non_stored_fields' not in node:
+            node['non_stored_fields'] = {}
+        non_stored_fields = node['non_stored_fields']
+        for key in [k for k in non_stored_fields if '_link_status' in k]:
+            non_stored_fields.pop(key)
+        non_stored_fields.update(status)
+        non_stored_fields['link_status_updated'] = True
@@ -0,0 +1,307 @@
+import re
+from git_reqs.linkstatus import get_link_fulfillment
+
+# Query language over the requirement graph, e.g.
+#
+#   Type=Requirement and module SRS and not link verifies and ancestors(Type=Test-Result and result!=Passed)
+#
+# Terms:
+#   FIELD=VALUE, FIELD!=VALUE   the field of the req equals or differs from VALUE (a missing field differs)
+#   FIELD~REGEX                 the field of the req matches the regular expression
+#   module NAME                 the req belongs to the module NAME, or one of its submodules
+#   link TYPE                   the req has a downward link of TYPE, partly links of the type included
+#   descendants(QUERY)          the reqs reachable from the reqs matching QUERY
+#   ancestors(QUERY)            the reqs from which the reqs matching QUERY can be reached
+# combined with not, and, or (in that order of precedence) and parentheses. Values containing spaces or
+# special characters are written in quotes. Fields not stored in the req files, e.g. color or Internal, are
+# looked for in the non stored fields.
+#
+# The query is planned so that each and-term that can list its matching reqs cheaply, from the attribute index,
+# a module or a traversal, gives the candidates, the term with the fewest candidates is chosen and the other terms
+# only filter them. Only when no term can list its reqs, all reqs of the graph are tested.
+
+TOKEN_PATTERN = re.compile(r'\s*(?:(\(|\)|!=|=|~)|"((?:[^"\\]|\\.)*)"|\'((?:[^\'\\]|\\.)*)\'|([^\s()=!~"\']+))')
+
+
+def tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = TOKEN_PATTERN.match(expression, position)
+        assert match, "Invalid query at position %d: %s" % (position, expression[position:])
+        symbol, double_quoted, single_quoted, word = match.groups()
+        if symbol is not None:
+            tokens.append(('symbol', symbol))
+        elif word is not None:
+            tokens.append(('word', word))
+        else:
+            quoted = double_quoted if double_quoted is not None else single_quoted
+            tokens.append(('string', re.sub(r'\\(.)', r'\1', quoted)))
+        position = match.end()
+    return tokens
+
+
+class query_parser:
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = tokenize(expression)
+        self.position = 0
+
+    def peek(self, offset=0):
+        if self.position + offset < len(self.tokens):
+            return self.tokens[self.position + offset]
+        return (None, None)
+
+    def next(self):
+        token = self.peek()
+        assert token[0] is not None, "Unexpected end of query: %s" % self.expression
+        self.position += 1
+        return token
+
+    def expect(self, symbol):
+        token = self.next()
+        assert token == ('symbol', symbol), "Expected %s but got %s in query: %s" % (symbol, token[1], self.expression)
+
+    def is_keyword(self, keyword):
+        return self.peek() == ('word', keyword)
+
+    def parse(self):
+        term = self.parse_or()
+        assert self.peek()[0] is None, "Unexpected %s in query: %s" % (self.peek()[1], self.expression)
+        return term
+
+    def parse_or(self):
+        terms = [self.parse_and()]
+        while self.is_keyword('or'):
+            self.next()
+            terms.append(self.parse_and())
+        return terms[0] if len(terms) == 1 else or_term(terms)
+
+    def parse_and(self):
+        terms = [self.parse_not()]
+        while self.is_keyword('and'):
+            self.next()
+            terms.append(self.parse_not())
+        return terms[0] if len(terms) == 1 else and_term(terms)
+
+    def parse_not(self):
+        if self.is_keyword('not'):
+            self.next()
+            return not_term(self.parse_not())
+        return self.parse_atom()
+
+    def parse_value(self):
+        kind, value = self.next()
+        assert kind in ['word', 'string'], "Expected a value but got %s in query: %s" % (value, self.expression)
+        return value
+
+    def parse_atom(self):
+        kind, value = self.peek()
+        if (kind, value) == ('symbol', '('):
+            self.next()
+            term = self.parse_or()
+            self.expect(')')
+            return term
+        if kind == 'word' and value in ['descendants', 'ancestors'] and self.peek(1) == ('symbol', '('):
+            self.next()
+            self.expect('(')
+            term = self.parse_or()
+            self.expect(')')
+            return traversal_term(value, term)
+        if kind == 'word' and value in ['module', 'link'] and self.peek(1)[0] in ['word', 'string']:
+            self.next()
+            if value == 'module':
+                return module_term(self.parse_value())
+            return link_term(self.parse_value())
+
+        field = self.parse_value()
+        kind, operator = self.next()
+        assert kind == 'symbol' and operator in ['=', '!=', '~'], \
+            "Expected =, != or ~ after %s in query: %s" % (field, self.expression)
+        return field_term(field, operator, self.parse_value())
+
+
+# The state of one evaluation of a query, the req sets of the terms are calculated at most once
+class query_context:
+    def __init__(self, reqmodule):
+        self.reqmodule = reqmodule
+        self.reqs = reqmodule.reqs
+        self.req_attrs = reqmodule.req_attrs
+        self.req_sets = {}
+
+    def get_req_set(self, term):
+        if term not in self.req_sets:
+            self.req_sets[term] = term.get_reqs(self)
+        return self.req_sets[term]
+
+
+# Terms give the reqs they match with get_reqs() when it is cheap, else None, and test single reqs with match()
+class field_term:
+    def __init__(self, field, operator, value):
+        self.field = field
+        self.operator = operator
+        self.value = value
+        if operator == '~':
+            self.pattern = re.compile(value)
+
+    def get_value(self, data):
+        if self.field in data:
+            return data[self.field]
+        return data.get('non_stored_fields', {}).get(self.field, None)
+
+    def get_reqs(self, context):
+        if self.operator != '=' or context.req_attrs is None or self.field not in context.req_attrs:
+            return None
+        context.req_attrs.sync()
+        reqs = {}
+        # Compare as strings, for values that are not strings, like Internal
+        for value in list(context.req_attrs.nodes[self.field]):
+            if str(value) == self.value:
+                reqs.update(dict.fromkeys(context.req_attrs.get(self.field, value)))
+        return reqs
+
+    def match(self, context, req):
+        value = self.get_value(context.reqs.nodes[req])
+        if self.operator == '~':
+            return value is not None and self.pattern.search(str(value)) is not None
+        equal = value is not None and str(value) == self.value
+        return equal if self.operator == '=' else not equal
+
+
+class module_term:
+    def __init__(self, name):
+        self.name = name
+
+    def find_module(self, reqmodule):
+        module = reqmodule
+        for name in self.name.split('/'):
+            if name not in module.modules:
+                module = None
+                break
+            module = module.modules[name]
+        if module is None:
+            # Also accept the module prefix
+            for candidate in reqmodule.get_module_tree():
+                if self.name in [candidate.module_prefix, candidate.config['module_prefix']]:
+                    return candidate
+        assert module is not None, "No module %s" % self.name
+        return module
+
+    def get_reqs(self, context):
+        reqs = {}
+        for module in self.find_module(context.reqmodule).get_module_tree():
+            reqs.update(dict.fromkeys(module.ordered_req_names))
+        return reqs
+
+    def match(self, context, req):
+        return req in context.get_req_set(self)
+
+
+class link_term:
+    def __init__(self, link_type):
+        self.link_status_field = link_type + '_link_status'
+
+    def get_reqs(self, context):
+        return None
+
+    def match(self, context, req):
+        for _, _, link_type in context.reqs.out_edges(req, data='type'):
+            if link_type and get_link_fulfillment(link_type)[0] == self.link_status_field:
+                return True
+        return False
+
+
+class traversal_term:
+    def __init__(self, direction, term):
+        self.direction = direction
+        self.term = term
+
+    def get_reqs(self, context):
+        neighbors = context.reqs.successors if self.direction == 'descendants' else context.reqs.predecessors
+        reqs = {}
+        # One traversal from all matching reqs at once
+        stack = list(evaluate(context, self.term))
+        while stack:
+            for neighbor in neighbors(stack.pop()):
+                if neighbor not in reqs:
+                    reqs[neighbor] = True
+                    stack.append(neighbor)
+        return reqs
+
+    def match(self, context, req):
+        return req in context.get_req_set(self)
+
+
+class not_term:
+    def __init__(self, term):
+        self.term = term
+
+    def get_reqs(self, context):
+        return None
+
+    def match(self, context, req):
+        return not self.term.match(context, req)
+
+
+class and_term:
+    def __init__(self, terms):
+        self.terms = terms
+
+    # The smallest of the candidate sets of the terms, and the other terms that filter it
+    def plan(self, context):
+        candidates = [(term, context.get_req_set(term)) for term in self.terms]
+        candidates = [(term, reqs) for term, reqs in candidates if reqs is not None]
+        if not candidates:
+            return None, self.terms
+        chosen, reqs = min(candidates, key=lambda candidate: len(candidate[1]))
+        return reqs, [term for term in self.terms if term is not chosen]
+
+    def get_reqs(self, context):
+        reqs, others = self.plan(context)
+        if reqs is None:
+            return None
+        return {req: True for req in reqs if all(term.match(context, req) for term in others)}
+
+    def match(self, context, req):
+        return all(term.match(context, req) for term in self.terms)
+
+
+class or_term:
+    def __init__(self, terms):
+        self.terms = terms
+
+    def get_reqs(self, context):
+        reqs = {}
+        for term in self.terms:
+            term_reqs = context.get_req_set(term)
+            if term_reqs is None:
+                return None
+            reqs.update(term_reqs)
+        return reqs
+
+    def match(self, context, req):
+        return any(term.match(context, req) for term in self.terms)
+
+
+def parse_query(expression):
+    return query_parser(expression).parse()
+
+
+# Yields the reqs matching the term, without listing them all first when no term can give its reqs
+def evaluate(context, term):
+    if isinstance(term, and_term):
+        reqs, filters = term.plan(context)
+    else:
+        reqs, filters = context.get_req_set(term), []
+    if reqs is None:
+        reqs, filters = list(context.reqs.nodes), [term]
+
+    for req in reqs:
+        if req in context.reqs and all(t.match(context, req) for t in filters):
+            yield req
+
+
+# Yields the names of the reqs of the graph of reqmodule matching the query expression
+def query(reqmodule, expression):
+    return evaluate(query_context(reqmodule), parse_query(expression))
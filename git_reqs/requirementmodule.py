@@ -1,26 +1,152 @@
 import os
-import yaml
+from git_reqs import yamlio
 import networkx as nx
-import junitparser
-from junitparser import JUnitXml
-import git
 import hashlib
-import time
+import copy
+import concurrent.futures
+import multiprocessing
 FORMAT_VERSION = 0.3
 import re
+from git_reqs.cache import snapshot_cache, CACHE_DIR
+from git_reqs.linkstatus import link_status_engine
+from git_reqs.indexes import req_name_index, link_index, substring_index, attr_index, \
+    INDEXED_FIELDS, INDEXED_NON_STORED_FIELDS
+from git_reqs.ids import id_allocator
+# How the reqs of a module are stored, one file per req or all reqs in one module file
+REQ_STORAGE_FILES = 'files'
+REQ_STORAGE_MODULE_FILE = 'module_file'
+REQ_STORAGES = [REQ_STORAGE_FILES, REQ_STORAGE_MODULE_FILE]
+MODULE_FILE = 'all-reqs.yaml'
+# Max number of paths given to one git add command
+STAGE_CHUNK_SIZE = 500
+# Elements of a JUnit test case that make it not passed
+JUNIT_RESULTS = ['failure', 'error', 'skipped']
+# Min number of req files to parse before using worker processes. Starting a worker takes about 0.25 s, and libyaml
+# parses a req file in 50-90 us, so with 4 workers the pool is faster from about 5000 files.
+PARALLEL_PARSE_THRESHOLD = 5000
+# More workers take longer to start than they save
+PARALLEL_PARSE_MAX_WORKERS = 4
+
+
+# GitPython is imported when needed since it takes a while to import, and requires git to be installed.
+# Returns False if the path is not in a git repo.
+def find_git_repo(path):
+    import git
+    try:
+        return git.Repo(path, search_parent_directories=True)
+    except (git.InvalidGitRepositoryError, git.NoSuchPathError):
+        return False
+
+
+# Parses req files with a pool of worker processes, defaults to one worker per cpu up to PARALLEL_PARSE_MAX_WORKERS.
+# Smaller sets of files are parsed directly since starting the workers would take longer. The workers are spawned,
+# not forked, since forking a process with other threads running, like git-reqs serve, can deadlock the workers.
+# They only import yamlio to start faster.
+def parse_req_files(file_paths, workers=None):
+    if workers is None:
+        workers = min(os.cpu_count() or 1, PARALLEL_PARSE_MAX_WORKERS)
+    if workers <= 1 or len(file_paths) < PARALLEL_PARSE_THRESHOLD:
+        return yamlio.load_files(file_paths)
+
+    chunk_size = max(1, len(file_paths) // (workers * 4))
+    chunks = [file_paths[i:i + chunk_size] for i in range(0, len(file_paths), chunk_size)]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                mp_context=multiprocessing.get_context('spawn')) as pool:
+        parsed = pool.map(yamlio.load_files, chunks, [yamlio.backend] * len(chunks))
+        return [req for chunk in parsed for req in chunk]
+
+
+# Yields (name, result) of the test cases of a JUnit xml file, which is parsed incrementally. The result is 'Passed',
+# or the failure, error or skip of the case with its message.
+def read_junit_cases(test_result_file):
+    import xml.etree.ElementTree as ElementTree
+    for _, element in ElementTree.iterparse(test_result_file):
+        if element.tag == 'testcase':
+            result = 'Passed'
+            for child in element:
+                if child.tag in JUNIT_RESULTS:
+                    result = child.tag + (': ' + child.get('message') if child.get('message') else '')
+                    break
+            yield element.get('name'), result
+            element.clear()
+        elif element.tag == 'testsuite':
+            element.clear()
+
+
+# Hash of the stored content of a req, used to find the reqs that have to be written
+def get_req_hash(req):
+    stored = sorted((field, value) for field, value in req.items() if field != 'non_stored_fields')
+    return hashlib.sha1(repr(stored).encode('utf-8')).hexdigest()
+
+
+# Collects the paths touched during a write, so that they can be staged with a few git commands
+# instead of one git process per file.
+class git_stage:
+    def __init__(self):
+        self.repos = {}
+        self.paths = {}
+        self.removed_paths = {}
+
+    def add(self, git_repo, *paths):
+        self.add_paths(self.paths, git_repo, paths)
+
+    # Stages the removal of paths which are already deleted from the working tree
+    def remove(self, git_repo, *paths):
+        self.add_paths(self.removed_paths, git_repo, paths)
+
+    def add_paths(self, staged_paths, git_repo, paths):
+        if not git_repo:
+            return
+        repo_key = git_repo.working_tree_dir
+        self.repos[repo_key] = git_repo
+        repo_paths = staged_paths.setdefault(repo_key, {})
+        for path in paths:
+            # The cache is local to the checkout and is never staged
+            if '/' + CACHE_DIR + '/' in path.replace(os.sep, '/'):
+                continue
+            repo_paths[path] = True
+
+    def flush(self):
+        failed = {}
+        self.run(self.removed_paths, 'rm', ['--cached', '--quiet', '--ignore-unmatch'], failed)
+        self.run(self.paths, 'add', [], failed)
+        self.paths = {}
+        self.removed_paths = {}
+
+        for path, error in failed.items():
+            print('Failed to stage %s: %s' % (path, error))
+        return failed
+
+    def run(self, staged_paths, command, options, failed):
+        import git
+        for repo_key, repo_paths in staged_paths.items():
+            git_repo = self.repos[repo_key]
+            repo_paths = list(repo_paths)
+            for i in range(0, len(repo_paths), STAGE_CHUNK_SIZE):
+                chunk = repo_paths[i:i + STAGE_CHUNK_SIZE]
+                try:
+                    getattr(git_repo.git, command)(*options, '--', *chunk)
+                except git.GitCommandError:
+                    # Find out which paths that failed
+                    for path in chunk:
+                        try:
+                            getattr(git_repo.git, command)(*options, '--', path)
+                        except git.GitCommandError as e:
+                            failed[path] = e.stderr.strip() if e.stderr else str(e)
+
 
 class requirement_module:
-    def __init__(self, module_path="", parent_prefix="", root_module=True):
+    def __init__(self, module_path="", parent_prefix="", root_module=True, use_cache=True, workers=None,
+                 root_reqs=None):
         self.parent_prefix = parent_prefix
         self.module_path = os.path.abspath(module_path)
-        try:
-            self.git_repo = git.Repo(self.module_path, search_parent_directories=True)
-        except:
-            self.git_repo = None
+        self.cache = snapshot_cache(self.module_path, enabled=use_cache)
+        # The git repo is first looked up when it is needed
+        self._git_repo = None
 
         if os.path.exists(module_path + '/config.yaml'):
             with open(module_path + '/config.yaml', 'r') as config_file:
-                self.config = yaml.safe_load(config_file)
+                self.config = yamlio.load(config_file)
         else:
             self.config = {}
             self.config['req_version'] = 0.1
@@ -29,30 +155,41 @@ class requirement_module:
         if self.config['req_version'] < 0.2:
             if os.path.exists(module_path + '/module-prefix.yaml'):
                 with open(module_path + '/module-prefix.yaml', 'r') as proj_pref_file:
-                    self.config['module_prefix'] = yaml.safe_load(proj_pref_file)
+                    self.config['module_prefix'] = yamlio.load(proj_pref_file)
             else:
                 self.config['module_prefix'] = ""
 
             if os.path.exists(module_path + '/modules.yaml'):
                 with open(module_path + '/modules.yaml', 'r') as modules_file:
-                    self.config['modules'] = yaml.safe_load(modules_file)
+                    self.config['modules'] = yamlio.load(modules_file)
             else:
                 self.config['modules'] = []
 
             self.config['req_number_format'] = 'numbers'
-            self.used_ids = []
+            used_ids = []
 
         elif os.path.exists(module_path + '/used-ids.yaml'):
-            with open(module_path + '/used-ids.yaml', 'r') as used_ids_file:
-                self.used_ids = yaml.safe_load(used_ids_file)
+            used_ids = self.cache.load('used-ids.yaml', yamlio.load)
         else:
-            self.used_ids = []
+            used_ids = []
 
         if os.path.exists(module_path + '/next-id.yaml'):
             with open(module_path + '/next-id.yaml', 'r') as next_id_file:
-                self.next_id = yaml.safe_load(next_id_file)
+                next_id = yamlio.load(next_id_file)
         else:
-            self.next_id = 0
+            next_id = 0
+        self.used_ids = id_allocator(used_ids, self.config['req_number_format'], next_id)
+
+        # Content of the module files as they are on disk, only changes are written
+        self.stored_files = {}
+        if os.path.exists(module_path + '/used-ids.yaml'):
+            self.stored_files['used-ids.yaml'] = list(self.used_ids)
+        if os.path.exists(module_path + '/next-id.yaml'):
+            self.stored_files['next-id.yaml'] = next_id
+        self.stored_hashes = {}
+        # Content of the module file when all reqs are stored in one file, id -> req
+        self.module_file_reqs = None
+        self.module_file_changed = False
 
         if parent_prefix != "":
             self.module_prefix = parent_prefix + \
@@ -60,164 +197,385 @@ class requirement_module:
         else:
             self.module_prefix = self.config['module_prefix']
 
-        self.reqs = nx.DiGraph()
-        self.fields, self.ordered_req_names = self.read_reqs()
+        self.req_names = None
+        self.req_links = None
+        self.req_attrs = None
+        self.link_status = None
+        self.fields = []
+        self.ordered_req_names = []
+        # The nodes added by the imported test results, which are removed when they are imported again
+        self.test_result_nodes = []
 
+        # All modules of the tree add their reqs to the same graph
+        self.reqs = nx.DiGraph() if root_reqs is None else root_reqs
         self.modules = {}
         for module in self.config['modules']:
             self.modules[module] = requirement_module(
-                module_path + '/' + module, parent_prefix=self.module_prefix, root_module=False)
-            self.reqs = nx.compose(self.reqs, self.modules[module].reqs)
-
-        # Propagate the full graph upwards to all modules
-        if root_module:
-            self.update_to_root_graph(self.reqs)
-
-
-        if os.path.exists(module_path + '/test_results.temp.yaml'):
-            with open(module_path + '/test_results.temp.yaml', 'r') as test_results_file:
-                test_result_files = yaml.safe_load(test_results_file)
+                module_path + '/' + module, parent_prefix=self.module_prefix, root_module=False,
+                use_cache=use_cache, root_reqs=self.reqs)
+
+        if root_reqs is None:
+            # Read the reqs of all modules at once, when the whole module tree is known
+            self.load_module_tree(workers)
+
+            # Propagate the full graph upwards to all modules
+            self.req_names = req_name_index(self.reqs.nodes)
+            self.req_links = link_index(self.reqs)
+            self.req_attrs = attr_index(self.reqs)
+            if root_module:
+                self.link_status = link_status_engine(self.reqs, self.req_names, self.req_links)
+            self.update_to_root_graph(self)
+
+            self.import_stored_test_results()
+            if root_module:
+                self.update_link_status()
+
+    @property
+    def git_repo(self):
+        if self._git_repo is None:
+            self._git_repo = find_git_repo(self.module_path)
+        return self._git_repo or None
+
+    def get_module_tree(self):
+        modules = [self]
+        for module in self.modules.values():
+            modules.extend(module.get_module_tree())
+        return modules
+
+    def load_module_tree(self, workers=None):
+        modules = self.get_module_tree()
+
+        # Find the req files that are not in the snapshot cache of their module
+        req_lists = {}
+        contents = {}
+        to_parse = []
+        for module in modules:
+            req_lists[module] = module.read_req_list()
+            if module.uses_module_file():
+                module_file_reqs = module.get_module_file_reqs()
+                for req_id in req_lists[module]:
+                    contents[(module, req_id)] = module_file_reqs[req_id]
+                continue
+            for req_id in req_lists[module]:
+                content, stamp = module.cache.lookup(req_id + '.yaml')
+                if content is None:
+                    to_parse.append((module, req_id, stamp))
+                else:
+                    contents[(module, req_id)] = content
+
+        parsed = parse_req_files([module.module_path + '/' + req_id + '.yaml' for module, req_id, _ in to_parse],
+                                 workers)
+        for (module, req_id, stamp), content in zip(to_parse, parsed):
+            module.cache.store(req_id + '.yaml', stamp, content)
+            contents[(module, req_id)] = content
+
+        for module in modules:
+            module.fields, module.ordered_req_names = module.read_reqs(
+                [contents[(module, req_id)] for req_id in req_lists[module]])
+            module.cache.save()
+
+    def import_stored_test_results(self, changed=None, removed=None):
+        for module in self.modules.values():
+            module.import_stored_test_results(changed, removed)
+
+        for req_name in self.test_result_nodes:
+            self.remove_req_node(req_name, set() if changed is None else changed, {} if removed is None else removed)
+        self.test_result_nodes = []
+
+        if os.path.exists(self.module_path + '/test_results.temp.yaml'):
+            with open(self.module_path + '/test_results.temp.yaml', 'r') as test_results_file:
+                test_result_files = yamlio.load(test_results_file)
                 for test_file in test_result_files:
                     self.import_test_results(test_file)
-        if root_module:
-            for req in self.reqs.copy():
-                self.update_link_status(req)
 
-    def read_reqs(self):
+    def read_req_list(self):
         if os.path.exists(self.module_path + '/reqs.yaml'):
-            with open(self.module_path + '/reqs.yaml', 'r') as req_list_file:
-                req_list = yaml.safe_load(req_list_file)
+            req_list = self.cache.load('reqs.yaml', yamlio.load)
+            self.stored_files['reqs.yaml'] = list(req_list)
         else:
             req_list = []
+        return req_list
+
+    def uses_module_file(self):
+        return self.config.get('req_storage', REQ_STORAGE_FILES) == REQ_STORAGE_MODULE_FILE
+
+    def get_module_file_reqs(self):
+        if self.module_file_reqs is None:
+            if os.path.exists(self.module_path + '/' + MODULE_FILE):
+                self.module_file_reqs = dict(self.cache.load(MODULE_FILE, yamlio.load) or {})
+            else:
+                self.module_file_reqs = {}
+        return self.module_file_reqs
+
+    # Returns the stored content of a req, as it is on disk, or None if it is not stored
+    def load_stored_req(self, req_id):
+        if self.uses_module_file():
+            return self.get_module_file_reqs().get(req_id)
+        if os.path.exists(self.module_path + '/' + req_id + '.yaml'):
+            return self.cache.load(req_id + '.yaml', yamlio.load)
+        return None
+
+    def store_req(self, req_id, req, stage):
+        if self.uses_module_file():
+            self.get_module_file_reqs()[req_id] = req
+            self.module_file_changed = True
+        else:
+            with open(self.module_path + '/' + req_id + '.yaml', 'w') as req_file:
+                yamlio.dump(req, req_file)
+            stage.add(self.git_repo, self.module_path + '/' + req_id + '.yaml')
+
+    # Adds the reqs of the module to the graph. The contents of the req files can be given when they are already read.
+    def read_reqs(self, req_contents=None):
+        req_list = self.read_req_list()
+        if req_contents is None:
+            # Unchanged files are taken from the snapshot cache instead of being parsed again
+            req_contents = [self.load_stored_req(req_id) for req_id in req_list]
 
         fields = ['Req-Id', 'Type', 'Description',
                   'downward_links', 'upward_links']
         ordered_req_names = []
-        for req_id in req_list:
-            with open(self.module_path + '/' + req_id + '.yaml', 'r') as r:
-                req = yaml.safe_load(r)
+        nodes = []
+        for req_id, req in zip(req_list, req_contents):
             # Add prefixes recursivly
             req_name = self.module_prefix + '_' + req_id
+            self.stored_hashes[req_name] = get_req_hash(req)
 
-            # Create graph node for each req
-            self.reqs.add_node(req_name)
             for field in req.keys():
-
                 if not field in fields:
                     fields.append(field)
 
-                # Add fields to node
-                self.reqs.nodes[req_name][field] = req[field]
-
-            self.reqs.nodes[req_name]['non_stored_fields'] = {}
-            self.reqs.nodes[req_name]['non_stored_fields']['Internal'] = True
-            self.reqs.nodes[req_name]['non_stored_fields']['color'] = 'black'
-            self.reqs.nodes[req_name]['non_stored_fields']['link_status_updated'] = False
+            # Create graph node for each req, with the fields of the req
+            node = dict(req)
+            node['non_stored_fields'] = {'Internal': True, 'color': 'black', 'link_status_updated': False}
+            nodes.append((req_name, node))
             if not req_name in ordered_req_names:
                 ordered_req_names.append(req_name)
 
+        self.reqs.add_nodes_from(nodes)
+        if self.req_attrs is not None:
+            for req_name, _ in nodes:
+                self.req_attrs.update(req_name)
         return fields, ordered_req_names
 
-    def update_link_status(self, req, subgraph=None):
-        if not self.reqs.nodes[req]['non_stored_fields']['link_status_updated']:
-            for field in ['upward_links', 'downward_links']:
-                # Create links between linked nodes
-                if field in self.reqs.nodes[req].keys():
-                    links = self.reqs.nodes[req][field].split(',')
-                    for link in links:
-                        if ':' in link:
-                            link_type, linked_req = link.split(':')
-                            link_type = link_type.strip()
-                            linked_req = linked_req.strip()
-                            # Don't add project prefix to extern links
-                            if 'extern' not in link_type:
-                                # Search if req is existing on any level
-                                for d in range(1, len(req.split('_'))+1):
-                                    linked_req_full = '_'.join(req.split('_')[:-d] + [linked_req])
-                                    if linked_req_full in self.reqs.nodes.keys():
-                                        break
-
-                                linked_req = linked_req_full
-
-                            # Verify that the requirement is not linked two ways.
-                            uptest = (linked_req, req) in self.reqs.edges.keys(
-                            ) and self.reqs.edges[(linked_req, req)]['type'] == link_type
-                            downtest = (req, linked_req) in self.reqs.edges.keys(
-                            ) and self.reqs.edges[(req, linked_req)]['type'] == link_type
-                            assert (not (uptest and downtest))
-
-                            if "upward" in field:
-                                self.reqs.add_edge(
-                                    linked_req, req, type=link_type)
-                            else:
-                                self.reqs.add_edge(
-                                    req, linked_req, type=link_type)
-                            self.reqs.nodes[linked_req]['non_stored_fields'] = {}
-                            self.reqs.nodes[linked_req]['non_stored_fields']['Internal'] = False
-                            self.reqs.nodes[linked_req]['non_stored_fields']['color'] = 'gray'
-                            self.reqs.nodes[linked_req]['non_stored_fields']['link_status_updated'] = False
-
-            if subgraph is None:
-                subgraph = self.reqs
-
-            # Recurse down in the tree
-            subgraph, _, descendants = self.get_related_reqs(req, subgraph)
-            descendants_status = {}
-            for descendant in descendants:
-                self.update_link_status(descendant, subgraph)
-
-                # Store the childrens status, so it can be propagated upwards
-                desc_info = self.reqs.nodes[descendant]['non_stored_fields']
-                desc_link_types = [key for key in desc_info if '_link_status' in key]
-
-                for desc_link_type in desc_link_types:
-                    if not desc_link_type in descendants_status.keys():
-                        descendants_status[desc_link_type] = []
-
-                    descendants_status[desc_link_type].append(desc_info[desc_link_type])
-
-            # Check all outgoing links
-            for descendant_link in self.reqs.out_edges(req):
-                edge_data = self.reqs.get_edge_data(descendant_link[0], descendant_link[1])
-                # Calculate the quota for partly links
-                if 'partly_' in edge_data['type']:
-                    link_type = edge_data['type'][len('partly_'):-5] + '_link_status'
-                    quota = [float(n) for n in edge_data['type'][-4:-1].split('/')]
-                    fulfillment = quota[0]/quota[1]
-                else:
-                    link_type = edge_data['type'] + '_link_status'
-                    fulfillment = 1
-
-                # Add link status for current req
-                if not link_type in self.reqs.nodes[req]['non_stored_fields'].keys():
-                    self.reqs.nodes[req]['non_stored_fields'][link_type] = 0
-                self.reqs.nodes[req]['non_stored_fields'][link_type] += fulfillment
+    # Get the full name of a req written without (the full) module prefix, as seen from context_req or this module.
+    # The req is searched for on all levels of the module prefix, starting from the deepest.
+    def resolve_req_name(self, name, context_req=None):
+        if context_req is None:
+            prefix = tuple(self.module_prefix.split('_'))
+        else:
+            prefix = self.req_names.get_prefix(context_req)
+        return self.req_names.resolve(name, prefix)
 
-            # If the sub requirement is not fully fulfilled for a certain link type, inherit the min fulfillment.
-            for link_type in descendants_status.keys():
-                if len(descendants_status[link_type]) > 0:
-                    sub_fullf = sum([f/len(descendants_status[link_type]) for f in descendants_status[link_type]])
-                    if link_type in self.reqs.nodes[req]['non_stored_fields'].keys():
-                        self.reqs.nodes[req]['non_stored_fields'][link_type] = min(self.reqs.nodes[req]['non_stored_fields'][link_type], sub_fullf)
-                    else:
-                        self.reqs.nodes[req]['non_stored_fields'][link_type] = sub_fullf
+    def update_link_status(self, reqs=None):
+        if self.link_status is None:
+            self.link_status = link_status_engine(self.reqs, self.req_names, self.req_links)
 
-            self.reqs.nodes[req]['non_stored_fields']['link_status_updated'] = True
+        if reqs is None:
+            self.link_status.update_all()
+        elif isinstance(reqs, str):
+            self.link_status.update([reqs])
+        else:
+            self.link_status.update(reqs)
 
     # Propagates the reference of the full project graph to all modules
     # This is so that changes can be done on any level, and all requirements shall only exist once.
-    def update_to_root_graph(self, root_reqs):
-        self.reqs = root_reqs
+    def update_to_root_graph(self, root_module):
+        self.reqs = root_module.reqs
+        self.req_names = root_module.req_names
+        self.req_links = root_module.req_links
+        self.req_attrs = root_module.req_attrs
+        self.link_status = root_module.link_status
         for module in self.config['modules']:
-            self.modules[module].update_to_root_graph(root_reqs)
+            self.modules[module].update_to_root_graph(root_module)
+
+    # Updates the graph to the changed module files, without reading the whole project again. Req files, reqs.yaml,
+    # all-reqs.yaml, used-ids.yaml and next-id.yaml patch the reqs, order and ids of their module, and the test
+    # results of test_results.temp.yaml are imported again. A changed config.yaml reads its module and submodules
+    # again. The link statuses of the changed reqs and their ancestors are recalculated.
+    # Returns the names of the reqs that were added, changed or removed.
+    def reload_changed(self, paths):
+        modules = {module.module_path: module for module in self.get_module_tree()}
+        changed_files = {}
+        for path in paths:
+            module_path, file_name = os.path.split(os.path.abspath(path))
+            if module_path in modules:
+                changed_files.setdefault(modules[module_path], set()).add(file_name)
+
+        changed = set()
+        # The removed reqs, with the reqs they were linked with
+        removed = {}
+        # Reload from the top, a reloaded subtree includes the changes below it
+        reloaded_paths = []
+        for module in sorted(changed_files, key=lambda m: m.module_path):
+            if 'config.yaml' in changed_files[module] or 'modules.yaml' in changed_files[module]:
+                if not any(module.module_path.startswith(path + '/') for path in reloaded_paths):
+                    reloaded_paths.append(module.module_path)
+                    self.reload_module(module, changed, removed)
+
+        for module, file_names in changed_files.items():
+            if any(module.module_path == path or module.module_path.startswith(path + '/') for path in reloaded_paths):
+                continue
+            if 'used-ids.yaml' in file_names or 'next-id.yaml' in file_names:
+                module.reload_ids()
+            if 'reqs.yaml' in file_names or MODULE_FILE in file_names:
+                module.module_file_reqs = None
+                module.reload_reqs(None, changed, removed)
+            else:
+                req_ids = [os.path.splitext(f)[0] for f in file_names if f.endswith('.yaml')]
+                module.reload_reqs(req_ids, changed, removed)
+            if 'test_results.temp.yaml' in file_names:
+                module.import_stored_test_results(changed, removed)
+                for test_module in module.get_module_tree():
+                    for req_name in test_module.test_result_nodes:
+                        removed.pop(req_name, None)
+                changed.update(self.req_attrs.get('Type', 'Test-Result') if self.req_attrs is not None else [])
+            module.cache.save()
+
+        if self.link_status is not None and (changed or removed):
+            relinked = changed.union(*removed.values())
+            # Links written with a shorter name may now resolve to an added req
+            for req in changed:
+                parts = str(req).split('_')
+                for i in range(1, len(parts)):
+                    if '_'.join(parts[i:]) in self.reqs:
+                        relinked.update(nx.all_neighbors(self.reqs, '_'.join(parts[i:])))
+            relinked = [req for req in relinked if req in self.reqs]
+            linked = set(relinked).union(*[nx.all_neighbors(self.reqs, req) for req in relinked])
+            external = [req for req in linked
+                        if not self.reqs.nodes[req].get('non_stored_fields', {}).get('Internal', True)]
+            self.link_status.update(relinked)
+            # External reqs no longer linked to are not in a project read again
+            for req in external:
+                if req in self.reqs and self.reqs.degree(req) == 0:
+                    self.link_status.forget(req)
+                    self.reqs.remove_node(req)
+                    self.req_names.remove(req)
+                    self.req_attrs.remove(req)
+        return changed | set(removed)
+
+    def reload_ids(self):
+        if os.path.exists(self.module_path + '/used-ids.yaml'):
+            used_ids = self.cache.load('used-ids.yaml', yamlio.load)
+            self.stored_files['used-ids.yaml'] = list(used_ids)
+        else:
+            used_ids = []
+        next_id = self.used_ids.next_id
+        if os.path.exists(self.module_path + '/next-id.yaml'):
+            with open(self.module_path + '/next-id.yaml', 'r') as next_id_file:
+                next_id = yamlio.load(next_id_file)
+            self.stored_files['next-id.yaml'] = next_id
+        self.used_ids = id_allocator(used_ids, self.config['req_number_format'], next_id)
+
+    # Patches the reqs of the module with the given ids, or all reqs of the module, to their stored content.
+    # Only reqs whose content differs from what was read before are changed in the graph.
+    def reload_reqs(self, req_ids, changed, removed):
+        req_list = self.read_req_list()
+        listed = set(req_list)
+        if req_ids is None:
+            req_ids = req_list
+            req_names = list(dict.fromkeys(self.module_prefix + '_' + req_id for req_id in req_list))
+            kept = set(req_names)
+            for req_name in self.ordered_req_names:
+                if req_name not in kept:
+                    self.remove_req_node(req_name, changed, removed)
+            self.ordered_req_names = req_names
+
+        for req_id in req_ids:
+            req_name = self.module_prefix + '_' + req_id
+            if req_id not in listed:
+                continue
+            req = self.load_stored_req(req_id)
+            if req is None:
+                # Listed but no longer stored
+                self.remove_req_node(req_name, changed, removed)
+                self.ordered_req_names = [name for name in self.ordered_req_names if name != req_name]
+                continue
+            if req_name in self.reqs and self.stored_hashes.get(req_name) == get_req_hash(req):
+                # Also keeps changes not yet written
+                continue
+            self.set_req_node(req_name, req)
+            changed.add(req_name)
+            for field in req.keys():
+                if field not in self.fields:
+                    self.fields.append(field)
+
+    # Replaces the fields of the node of a req with its stored content
+    def set_req_node(self, req_name, req):
+        if req_name not in self.reqs:
+            self.reqs.add_node(req_name)
+        node = self.reqs.nodes[req_name]
+        node.clear()
+        node.update(req)
+        node['non_stored_fields'] = {'Internal': True, 'color': 'black', 'link_status_updated': False}
+        self.stored_hashes[req_name] = get_req_hash(req)
+        if self.req_names is not None:
+            self.req_names.add(req_name)
+        if self.req_links is not None:
+            self.req_links.forget(req_name)
+        if self.req_attrs is not None:
+            self.req_attrs.update(req_name)
+
+    # Removes the node of a req. The reqs linked to it are linked again, which makes it an external req if they
+    # still link to it.
+    def remove_req_node(self, req_name, changed, removed):
+        if req_name not in self.reqs:
+            return
+        neighbors = set(self.reqs.predecessors(req_name)) | set(self.reqs.successors(req_name))
+        if self.link_status is not None:
+            self.link_status.unlink_req(req_name)
+            self.link_status.forget(req_name)
+        self.reqs.remove_node(req_name)
+        if self.req_names is not None:
+            self.req_names.remove(req_name)
+        if self.req_links is not None:
+            self.req_links.forget(req_name)
+        if self.req_attrs is not None:
+            self.req_attrs.remove(req_name)
+        self.stored_hashes.pop(req_name, None)
+        changed.discard(req_name)
+        removed[req_name] = neighbors - {req_name}
+
+    # Reads the config and the reqs of a module and its submodules again
+    def reload_module(self, module, changed, removed):
+        for old_module in module.get_module_tree():
+            for req_name in old_module.ordered_req_names + old_module.test_result_nodes:
+                self.remove_req_node(req_name, changed, removed)
+
+        parent = None
+        for candidate in self.get_module_tree():
+            if module in candidate.modules.values():
+                parent = candidate
+        new_module = requirement_module(module.module_path, parent_prefix=module.parent_prefix, root_module=False,
+                                        use_cache=module.cache.enabled, root_reqs=self.reqs)
+        new_module.update_to_root_graph(self)
+        new_module.load_module_tree()
+        for new_submodule in new_module.get_module_tree():
+            for req_name in new_submodule.ordered_req_names:
+                self.req_names.add(req_name)
+                removed.pop(req_name, None)
+                changed.add(req_name)
+        new_module.import_stored_test_results(changed, removed)
+        for new_submodule in new_module.get_module_tree():
+            for req_name in new_submodule.test_result_nodes:
+                removed.pop(req_name, None)
+                changed.add(req_name)
+
+        if parent is not None:
+            for name, submodule in parent.modules.items():
+                if submodule is module:
+                    parent.modules[name] = new_module
+        else:
+            # The module reloaded is this one, take over the new state
+            self.__dict__.update(new_module.__dict__)
 
     def upgrade_module(self):
         self.config['req_version'] = FORMAT_VERSION
         with open(self.module_path + '/config.yaml', 'w') as config_file:
-            yaml.dump(self.config, config_file)
-        if self.git_repo:
-            self.git_repo.git.add(self.module_path + '/config.yaml')
-        self.write_reqs()
+            yamlio.dump(self.config, config_file)
+        stage = git_stage()
+        stage.add(self.git_repo, self.module_path + '/config.yaml')
+        self.write_reqs(stage, write_all=True)
+        stage.flush()
 
         if self.git_repo and os.path.exists(self.module_path + '/module-prefix.yaml'):
             self.git_repo.git.rm(self.module_path + '/module-prefix.yaml')
@@ -237,20 +595,15 @@ class requirement_module:
         # Remove project prefix
         return '_'.join(name.split('_')[1:])
 
+    # Returns n new req names of this module, the ids are reserved at once so that mass imports don't search for
+    # free ids one req at a time.
+    def allocate_req_names(self, n):
+        return [self.module_prefix + '_' + id for id in self.used_ids.allocate(n)]
+
     def add_req(self, req, position=-1):
         if not req['Req-Id']:
-            if self.config['req_number_format'] == 'time_hash':
-                hash = hashlib.sha1()
-                while True:
-                    hash.update(str(time.time()).encode('utf-8'))
-                    id = hash.hexdigest()[:5]
-                    if id not in self.used_ids:
-                        break
-            else:
-                id = str(self.next_id)
-                self.next_id += 1
+            id = self.used_ids.allocate()[0]
             req['Req-Id'] = self.module_prefix + '_' + id
-            self.reqs.add_node(req['Req-Id'])
 
         else:
             id = req['Req-Id'].split('_')[-1]
@@ -258,8 +611,11 @@ class requirement_module:
                 assert(id.isdigit())
             assert(self.module_prefix in req['Req-Id'])
 
-        if id not in self.used_ids:
-            self.used_ids.append(id)
+        if req['Req-Id'] not in self.reqs:
+            self.reqs.add_node(req['Req-Id'])
+            if self.req_names is not None:
+                self.req_names.add(req['Req-Id'])
+        self.used_ids.add(id)
 
         self.reqs.nodes[req['Req-Id']]['non_stored_fields'] = {}
         self.reqs.nodes[req['Req-Id']]['non_stored_fields']['Internal'] = True
@@ -269,6 +625,8 @@ class requirement_module:
         for field in list(req.keys()):
             self.reqs.nodes[req['Req-Id']][field] = str(req[field]).strip()
         self.reqs.nodes[req['Req-Id']]['Req-Id'] = id
+        if self.req_attrs is not None:
+            self.req_attrs.update(req['Req-Id'])
         if position >= 0:
             self.ordered_req_names.insert(position, req['Req-Id'])
         else:
@@ -278,101 +636,144 @@ class requirement_module:
 
         return req['Req-Id']
 
-    def write_reqs(self):
+    # Writes the changed reqs of the module and all submodules. A req is written if its content differs from the
+    # file, found by comparing its hash with the one of the stored req, or all reqs if write_all is set.
+    # The written files are staged in git when done, or added to stage if this is a part of a larger write.
+    def write_reqs(self, stage=None, write_all=False):
+        if stage is None:
+            stage = git_stage()
+            self.write_reqs(stage, write_all)
+            return stage.flush()
+
         bare_ids = [req.split('_')[-1] for req in self.ordered_req_names]
 
         # Write requirement updates
         for id, req_name in zip(bare_ids, self.ordered_req_names):
-            # pop fields we don't want to store in the files
-            if 'non_stored_fields' in self.reqs.nodes[req_name].keys():
-                self.reqs.nodes[req_name].pop('non_stored_fields')
-
-            with open(self.module_path + '/' + id + '.yaml', 'w') as req_file:
-                yaml.dump(self.reqs.nodes[req_name], req_file)
-            if self.git_repo:
-                self.git_repo.git.add(self.module_path + '/' + id + '.yaml')
-            if not id in self.used_ids:
-                self.used_ids.append(id)
+            # Skip fields we don't want to store in the files
+            req = {field: value for field, value in self.reqs.nodes[req_name].items()
+                   if field != 'non_stored_fields'}
+            req_hash = get_req_hash(req)
+            if write_all or req_hash != self.stored_hashes.get(req_name):
+                self.store_req(id, req, stage)
+                self.stored_hashes[req_name] = req_hash
+            self.used_ids.add(id)
 
         # Make sure all deleted reqs are set to deleted status
-        for deleted_req in [r for r in self.used_ids if r not in bare_ids]:
-            file_path = self.module_path + '/' + deleted_req + '.yaml'
-            if os.path.exists(file_path):
-                with open(file_path, 'r') as del_req_file:
-                    del_req = yaml.safe_load(del_req_file)
+        active_ids = set(bare_ids)
+        for deleted_req in [r for r in self.used_ids if r not in active_ids]:
+            del_req = self.load_stored_req(deleted_req)
+            if del_req is not None:
+                if del_req.get('Status') != 'deleted' or write_all:
+                    del_req = dict(del_req)
                     del_req['Status'] = 'deleted'
-                with open(file_path, 'w') as del_req_file:
-                    yaml.dump(del_req, del_req_file)
-                if self.git_repo:
-                    self.git_repo.git.add(file_path)
-
+                    self.store_req(deleted_req, del_req, stage)
+                self.stored_hashes.pop(self.module_prefix + '_' + deleted_req, None)
 
         # Write module files
-        with open(self.module_path + '/reqs.yaml', 'w') as doc_file:
-            yaml.dump([req.split('_')[-1]
-                       for req in self.ordered_req_names], doc_file)
-
+        if self.module_file_changed or (write_all and self.uses_module_file()):
+            self.write_module_file(MODULE_FILE, self.get_module_file_reqs(), stage, write_all=True)
+            self.module_file_changed = False
+        self.write_module_file('reqs.yaml', bare_ids, stage, write_all)
         if self.config['req_version'] >= 0.2:
-            with open(self.module_path + '/used-ids.yaml', 'w') as used_ids_file:
-                yaml.dump(self.used_ids, used_ids_file)
-            if self.git_repo:
-                self.git_repo.git.add(self.module_path + '/used-ids.yaml')
-
-        with open(self.module_path + '/next-id.yaml', 'w') as next_id_file:
-            yaml.dump(self.next_id, next_id_file)
-            if self.git_repo:
-                self.git_repo.git.add(self.module_path + '/reqs.yaml',
-                                  self.module_path + '/next-id.yaml')
+            self.write_module_file('used-ids.yaml', self.used_ids.ids, stage, write_all)
+        self.write_module_file('next-id.yaml', self.used_ids.next_id, stage, write_all)
 
         for _, module in self.modules.items():
-            # Copy the reqs from the parent module, since modifications can have been made here.
-            #module.reqs = self.reqs.copy()
-            #module.reqs.remove_nodes_from(n for n in self.reqs if n not in module.reqs)
-            module.write_reqs()
+            module.write_reqs(stage, write_all)
+
+    def write_module_file(self, file_name, content, stage, write_all=False):
+        if write_all or self.stored_files.get(file_name) != content:
+            with open(self.module_path + '/' + file_name, 'w') as module_file:
+                yamlio.dump(content, module_file)
+            stage.add(self.git_repo, self.module_path + '/' + file_name)
+            if file_name != MODULE_FILE:
+                self.stored_files[file_name] = copy.copy(content)
+
+    # Moves the reqs of this module between one file per req and a single module file. All stored reqs,
+    # including deleted ones, are moved as they are, and the old files are removed from git.
+    def convert_req_storage(self, req_storage):
+        assert req_storage in REQ_STORAGES, "Invalid req storage %s, use one of %s" % (req_storage,
+                                                                                       ', '.join(REQ_STORAGES))
+        stage = git_stage()
+        if self.config.get('req_storage', REQ_STORAGE_FILES) != req_storage:
+            stored_reqs = {}
+            for req_id in list(self.used_ids) + [r for r in self.read_req_list() if r not in self.used_ids]:
+                req = self.load_stored_req(req_id)
+                if req is not None:
+                    stored_reqs[req_id] = req
+
+            self.config['req_storage'] = req_storage
+            if req_storage == REQ_STORAGE_MODULE_FILE:
+                self.module_file_reqs = stored_reqs
+                self.write_module_file(MODULE_FILE, stored_reqs, stage, write_all=True)
+                removed = [self.module_path + '/' + req_id + '.yaml' for req_id in stored_reqs]
+            else:
+                for req_id, req in stored_reqs.items():
+                    self.store_req(req_id, req, stage)
+                self.module_file_reqs = None
+                removed = [self.module_path + '/' + MODULE_FILE]
+
+            for path in removed:
+                if os.path.exists(path):
+                    os.remove(path)
+            stage.remove(self.git_repo, *removed)
+
+            with open(self.module_path + '/config.yaml', 'w') as config_file:
+                yamlio.dump(self.config, config_file)
+            stage.add(self.git_repo, self.module_path + '/config.yaml')
+        return stage.flush()
 
     def get_link_regex(self):
         regex_pattern = "git-reqs: (\S*) (\S*) (\S*)"
         return re.compile(regex_pattern)
 
+    # Adds the test cases of a JUnit file as test results. A case tagged "git-reqs: <test> <link type> ..." is
+    # linked to the test, and with connect_with_naming_convention the other cases are linked to all reqs having the
+    # case name in their description.
     def import_test_results(self, test_result_file, connect_with_naming_convention=True):
+        if self.req_names is None:
+            self.req_names = req_name_index(self.reqs.nodes)
         pattern = self.get_link_regex()
-        test_results = JUnitXml.fromfile(test_result_file)
-        if isinstance(test_results, junitparser.junitparser.TestSuite):
-            test_results = [test_results]
-
-        for suite in test_results:
-            for case in suite:
-                if not case.result:
-                    result = 'Passed'
-                    color = 'green'
-                else:
-                    import pdb
-                    pdb.set_trace()
-                    result = str(case.result)
-                    color = 'red'
-
-                match = re.search(pattern, case.name)
-                if match:
-                    # Search if test is existing on any level
-                    testname_full = '_'.join([self.module_prefix, match.groups()[0]])
-                    for d in range(1, len(self.module_prefix.split('_')) + 1):
-                        if testname_full in self.reqs.nodes.keys():
-                            break
-                        testname_full = '_'.join(self.module_prefix.split('_')[:-d] + [match.groups()[0]])
-                    testname = testname_full
-                    linktype = match.groups()[1]
-                    # Ok for nx to add node that already exists
-                    self.reqs.add_node(testname + '_result', result=result,
-                                       non_stored_fields={'color': color, 'link_status_updated': True}, Type='Test-Result', Description=case.name)
-                    self.reqs.nodes[testname + '_result']['Req-Id'] = testname.split('_')[-1] + '_result'
-                    self.reqs.add_edge(testname, testname + '_result', type='Test-Result')
-                elif connect_with_naming_convention:
-                    self.reqs.add_node(case.name, result=result,
-                                   non_stored_fields={'color': color, 'link_status_updated': True}, Type='Test-Result')
 
-                    for req_name, req_content in self.reqs.nodes.items():
-                        if 'Description' in req_content.keys() and case.name in req_content['Description']:
-                            self.reqs.add_edge(req_name, case.name, type='Test-Result')
+        named_cases = []
+        for name, result in read_junit_cases(test_result_file):
+            if result == 'Passed':
+                color = 'green'
+            else:
+                color = 'red'
+
+            match = re.search(pattern, name)
+            if match:
+                # Search if test is existing on any level
+                testname = self.resolve_req_name(match.groups()[0])
+                linktype = match.groups()[1]
+                self.test_result_nodes.extend(n for n in [testname, testname + '_result'] if n not in self.reqs)
+                # Ok for nx to add node that already exists
+                self.reqs.add_node(testname + '_result', result=result,
+                                   non_stored_fields={'color': color, 'link_status_updated': True}, Type='Test-Result', Description=name)
+                self.reqs.nodes[testname + '_result']['Req-Id'] = testname.split('_')[-1] + '_result'
+                self.reqs.add_edge(testname, testname + '_result', type='Test-Result')
+                self.req_names.add(testname)
+                self.req_names.add(testname + '_result')
+                if self.req_attrs is not None:
+                    self.req_attrs.update(testname + '_result')
+            elif connect_with_naming_convention:
+                if name not in self.reqs:
+                    self.test_result_nodes.append(name)
+                self.reqs.add_node(name, result=result,
+                                   non_stored_fields={'color': color, 'link_status_updated': True}, Type='Test-Result')
+                self.req_names.add(name)
+                if self.req_attrs is not None:
+                    self.req_attrs.update(name)
+                named_cases.append(name)
+
+        # Find the case names in all descriptions in one pass
+        if named_cases:
+            case_names = substring_index(named_cases)
+            for req_name, req_content in list(self.reqs.nodes.items()):
+                if 'Description' in req_content.keys():
+                    for name in case_names.search(str(req_content['Description'])):
+                        self.reqs.add_edge(req_name, name, type='Test-Result')
 
     def get_related_reqs(self, req_name, subgraph=None):
         if subgraph:
@@ -383,21 +784,47 @@ class requirement_module:
         descendants = nx.descendants(reqs, req_name)
         return nx.subgraph(reqs, ancestors | descendants | {req_name}), ancestors, descendants
 
+    # Yields the names of the reqs matching the query expression, see git_reqs/query.py for the syntax
+    def query(self, expression):
+        from git_reqs.query import query
+        return query(self, expression)
+
+    # Subgraph of the reqs having any of the (field, value) pairs. Indexed fields are looked up, other fields
+    # are searched for in all reqs.
     def get_reqs_with_attr(self, fields):
         if not isinstance(fields, list):
             fields = [fields]
         nodes = []
         for field in fields:
-            nodes.extend([n for n, d in self.reqs.nodes.items() if field[0] in d.keys() and d[field[0]] == field[1]])
+            if self.req_attrs is not None and field[0] in INDEXED_FIELDS:
+                nodes.extend(self.req_attrs.get(field[0], field[1]))
+            else:
+                nodes.extend([n for n, d in self.reqs.nodes.items() if field[0] in d.keys() and d[field[0]] == field[1]])
+        return self.reqs.subgraph(nodes)
+
+    # As get_reqs_with_attr, for the fields that are not stored, e.g. ('color', 'red') or ('Internal', False)
+    def get_reqs_with_non_stored_attr(self, fields):
+        if not isinstance(fields, list):
+            fields = [fields]
+        nodes = []
+        for field in fields:
+            if self.req_attrs is not None and field[0] in INDEXED_NON_STORED_FIELDS:
+                nodes.extend(self.req_attrs.get(field[0], field[1]))
+            else:
+                nodes.extend([n for n, d in self.reqs.nodes.items()
+                              if d.get('non_stored_fields', {}).get(field[0], None) == field[1]
+                              and field[0] in d.get('non_stored_fields', {})])
         return self.reqs.subgraph(nodes)
 
-def init_module(parent_path, module_name, module_prefix, req_numbering='time_hash', root_module=False):
+def init_module(parent_path, module_name, module_prefix, req_numbering='time_hash', root_module=False,
+                req_storage=REQ_STORAGE_FILES):
     module_path = parent_path + '/' + module_name
-    git_repo = git.Repo(parent_path, search_parent_directories=True)
+    git_repo = find_git_repo(parent_path)
 
     if not os.path.exists(module_path):
         os.mkdir(module_path)
     assert(not module_name == '')
+    assert(req_storage in REQ_STORAGES)
     assert(not os.path.exists(module_path + '/config.yaml'))
     assert(not os.path.exists(module_path + '/next-id.yaml'))
     assert(not os.path.exists(module_path + '/used-ids.yaml'))
@@ -411,30 +838,33 @@ def init_module(parent_path, module_name, module_prefix, req_numbering='time_has
     config['source_paths'] = []
     config['source_extensions'] = []
     config['root_module'] = root_module
+    config['req_storage'] = req_storage
     next_id = 1
 
+    stage = git_stage()
     with open(module_path + '/config.yaml', 'w') as config_file:
-        yaml.dump(config, config_file)
-        git_repo.git.add(config_file.name)
+        yamlio.dump(config, config_file)
+        stage.add(git_repo, config_file.name)
     with open(module_path + '/next-id.yaml', 'w') as next_id_file:
-        yaml.dump(next_id, next_id_file)
-        git_repo.git.add(next_id_file.name)
+        yamlio.dump(next_id, next_id_file)
+        stage.add(git_repo, next_id_file.name)
     with open(module_path + '/used-ids.yaml', 'w') as used_ids_file:
-        yaml.dump([], used_ids_file)
-        git_repo.git.add(used_ids_file.name)
+        yamlio.dump([], used_ids_file)
+        stage.add(git_repo, used_ids_file.name)
     with open(module_path + '/modules.yaml', 'w') as modules_file:
-        yaml.dump([], modules_file)
-        git_repo.git.add(modules_file.name)
+        yamlio.dump([], modules_file)
+        stage.add(git_repo, modules_file.name)
     with open(module_path + '/reqs.yaml', 'w') as reqs_file:
-        yaml.dump([], reqs_file)
-        git_repo.git.add(reqs_file.name)
+        yamlio.dump([], reqs_file)
+        stage.add(git_repo, reqs_file.name)
 
     if os.path.exists(module_path + '/../config.yaml'):
         with open(module_path + '/../config.yaml', 'r') as parent_config_file:
-            config = yaml.safe_load(parent_config_file)
+            config = yamlio.load(parent_config_file)
             config['modules'].append(module_name)
             print(config['modules'])
         with open(module_path + '/../config.yaml', 'w') as parent_config_file:
-            yaml.dump(config, parent_config_file)
-        parent_git_repo = git.Repo(parent_path, search_parent_directories=True)
-        parent_git_repo.git.add(module_path + '/../config.yaml')
\ No newline at end of file
+            yamlio.dump(config, parent_config_file)
+        parent_git_repo = find_git_repo(parent_path)
+        stage.add(parent_git_repo, module_path + '/../config.yaml')
+    stage.flush()
\ No newline at end of file
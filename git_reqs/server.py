@@ -0,0 +1,259 @@
+import os
+import json
+import stat
+import socket
+import hashlib
+import tempfile
+import threading
+import socketserver
+import yaml
+from git_reqs import yamlio
+# requirementmodule is imported when a project is read, as networkx takes a while to import
+
+POLL_INTERVAL = 1.0
+WATCHED_SUFFIXES = ['.yaml']
+
+
+# The sockets are kept in the runtime dir of the user, or else in a directory in the temp dir only the user can
+# access, so that other users can neither plant a socket nor connect to one
+def get_socket_dir():
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir and os.path.isdir(runtime_dir):
+        return runtime_dir
+    socket_dir = os.path.join(tempfile.gettempdir(), 'git-reqs-%d' % os.getuid())
+    try:
+        os.mkdir(socket_dir, 0o700)
+    except FileExistsError:
+        pass
+    dir_stat = os.lstat(socket_dir)
+    assert stat.S_ISDIR(dir_stat.st_mode) and dir_stat.st_uid == os.getuid() and \
+        stat.S_IMODE(dir_stat.st_mode) & 0o077 == 0, "%s is not a private directory of the user" % socket_dir
+    return socket_dir
+
+
+# The server of a project listens on a unix socket in the socket dir, named by the path of the project
+def get_socket_path(project_root):
+    project_hash = hashlib.sha1(os.path.realpath(project_root).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(get_socket_dir(), 'git-reqs-%s.sock' % project_hash)
+
+
+# Only sockets of the user are trusted
+def is_own_socket(path):
+    path_stat = os.lstat(path)
+    return stat.S_ISSOCK(path_stat.st_mode) and path_stat.st_uid == os.getuid()
+
+
+def get_req_module(project, module):
+    return project.modules[module] if module else project
+
+
+# The commands served, also run in-process by the command line when no server is running.
+# Each takes the project and the request, and returns a json serializable result.
+def run_query(project, request):
+    req_module = get_req_module(project, request.get('module'))
+    fields = request.get('fields') or []
+    return [[req] + [str(project.reqs.nodes[req].get(field, '')) for field in fields]
+            for req in req_module.query(request['expression'])]
+
+
+def run_export(project, request):
+    from git_reqs import exporttools
+    req_module = get_req_module(project, request.get('module'))
+    if request['format'] == 'xls':
+        return exporttools.convert_to_xls(req_module, write_only=request.get('write_only', False))
+    elif request['format'] == 'md':
+        exporttools.convert_to_markdown(req_module)
+        return None
+    assert False, "Invalid format. See available formats with git-reqs export --help"
+
+
+def run_coverage(project, request):
+    from git_reqs import coverage
+    table = coverage.get_coverage_table(project)
+    result = {'summary': table.get_summary(),
+              'failures': table.check_thresholds(coverage.parse_thresholds(request.get('min')),
+                                                 coverage.parse_thresholds(request.get('max')))}
+    if request.get('format'):
+        file = request.get('file') or project.module_path + "/" + project.module_prefix + "_TestCoverage." + \
+            request['format']
+        if request['format'] == 'json':
+            table.write_json(file)
+        elif request['format'] == 'csv':
+            table.write_csv(file)
+        else:
+            assert False, "Invalid format. See available formats with git-reqs report --help"
+        result['file'] = file
+    return result
+
+
+def run_add_req(project, request):
+    req_module = get_req_module(project, request.get('module'))
+    req = dict(request['req'])
+    req.setdefault('Req-Id', '')
+    req_name = req_module.add_req(req)
+    project.update_link_status(req_name)
+    req_module.write_reqs()
+    return req_name
+
+
+COMMANDS = {'query': run_query,
+            'export': run_export,
+            'coverage': run_coverage,
+            'add_req': run_add_req}
+
+
+def get_file_signature(path):
+    try:
+        file_stat = os.stat(path)
+    except OSError:
+        return None
+    return (file_stat.st_mtime_ns, file_stat.st_size)
+
+
+def get_test_result_files(path):
+    try:
+        with open(path, 'r') as test_results_file:
+            return yamlio.load(test_results_file) or []
+    except (OSError, yaml.YAMLError):
+        return []
+
+
+# Modification time and size of the files of all modules of the project. The JUnit files listed in
+# test_results.temp.yaml are a part of its signature, so that changed test results are imported again.
+def get_signature(project):
+    signature = {}
+    for module in project.get_module_tree():
+        try:
+            entries = list(os.scandir(module.module_path))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if entry.is_file() and os.path.splitext(entry.name)[1] in WATCHED_SUFFIXES:
+                signature[entry.path] = get_file_signature(entry.path)
+                if entry.name == 'test_results.temp.yaml' and signature[entry.path] is not None:
+                    signature[entry.path] += tuple(get_file_signature(test_file)
+                                                   for test_file in get_test_result_files(entry.path))
+    return signature
+
+
+# Keeps the project graph loaded and answers json requests, one per line, on the unix socket of the project.
+# A watcher thread polls the module directories and reloads the changed files, so that the graph is up to date
+# before the next request. A request with "sync" checks for changes before it is run.
+class req_server:
+    def __init__(self, project_root, workers=None, poll_interval=POLL_INTERVAL):
+        self.project_root = os.path.abspath(project_root)
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.socket_path = get_socket_path(self.project_root)
+        # Requests and reloads use the graph one at a time
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        from git_reqs.requirementmodule import requirement_module
+        self.project = requirement_module(self.project_root, workers=workers)
+        self.signature = get_signature(self.project)
+
+    def reload_if_changed(self):
+        signature = get_signature(self.project)
+        if signature != self.signature:
+            changed_paths = [path for path in set(signature) | set(self.signature)
+                             if signature.get(path) != self.signature.get(path)]
+            self.project.reload_changed(changed_paths)
+            # Config changes can add or remove modules
+            self.signature = get_signature(self.project)
+
+    def watch(self):
+        while not self.stopped.wait(self.poll_interval):
+            with self.lock:
+                self.reload_if_changed()
+
+    def handle(self, request):
+        command = request.get('command')
+        if command == 'ping':
+            return {'ok': True, 'result': self.project_root}
+        if command == 'stop':
+            self.stop()
+            return {'ok': True, 'result': None}
+        if command not in COMMANDS:
+            return {'ok': False, 'error': 'Invalid command %s' % command}
+        with self.lock:
+            try:
+                if request.get('sync'):
+                    self.reload_if_changed()
+                result = COMMANDS[command](self.project, request)
+                if command == 'add_req':
+                    # The req files written are already in the graph
+                    self.signature = get_signature(self.project)
+                return {'ok': True, 'result': result}
+            except Exception as error:
+                return {'ok': False, 'error': '%s: %s' % (type(error).__name__, error)}
+
+    def stop(self):
+        self.stopped.set()
+        threading.Thread(target=self.socket_server.shutdown).start()
+
+    def serve(self):
+        assert hasattr(socket, 'AF_UNIX'), "git-reqs serve needs unix sockets"
+        assert send_request(self.project_root, {'command': 'ping'}) is None, \
+            "A server is already running for %s" % self.project_root
+        if os.path.lexists(self.socket_path):
+            assert is_own_socket(self.socket_path), "%s is not a socket of the user" % self.socket_path
+            # Left by a server that did not stop cleanly
+            os.remove(self.socket_path)
+
+        server = self
+
+        class request_handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        response = server.handle(json.loads(line))
+                    except ValueError as error:
+                        response = {'ok': False, 'error': 'Invalid request: %s' % error}
+                    self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+                    self.wfile.flush()
+
+        self.socket_server = socketserver.ThreadingUnixStreamServer(self.socket_path, request_handler)
+        self.socket_server.daemon_threads = True
+        watcher = threading.Thread(target=self.watch, daemon=True)
+        watcher.start()
+        print('Serving %s on %s' % (self.project_root, self.socket_path))
+        try:
+            self.socket_server.serve_forever()
+        finally:
+            self.stopped.set()
+            self.socket_server.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+
+# Sends a request to the server of the project. Returns None when no server is running.
+def send_request(project_root, request):
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    socket_path = get_socket_path(project_root)
+    try:
+        if not is_own_socket(socket_path):
+            return None
+    except FileNotFoundError:
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        client.close()
+        return None
+    with client, client.makefile('rwb') as stream:
+        stream.write(json.dumps(request).encode('utf-8') + b'\n')
+        stream.flush()
+        return json.loads(stream.readline())
+
+
+# Runs a command by the server of the project when there is one, else in this process
+def execute(project_root, request, workers=None, use_server=True):
+    response = send_request(project_root, dict(request, sync=True)) if use_server else None
+    if response is None:
+        from git_reqs.requirementmodule import requirement_module
+        project = requirement_module(project_root, workers=workers)
+        return COMMANDS[request['command']](project, request)
+    assert response['ok'], response['error']
+    return response['result']
@@ -0,0 +1,34 @@
+import yaml
+
+# Serialization backend for all yaml files of a module.
+# The libyaml based loader and dumper are used when PyYAML is built with libyaml, they are many times faster
+# than the pure python implementation. Both give the same data when the files are read back.
+BACKENDS = {'python': (yaml.SafeLoader, yaml.SafeDumper)}
+if getattr(yaml, '__with_libyaml__', False):
+    BACKENDS['libyaml'] = (yaml.CSafeLoader, yaml.CSafeDumper)
+
+backend = 'libyaml' if 'libyaml' in BACKENDS else 'python'
+
+
+def set_backend(name):
+    global backend
+    assert name in BACKENDS, "Invalid yaml backend %s, available backends are %s" % (name, ', '.join(BACKENDS))
+    backend = name
+
+
+def load(stream):
+    return yaml.load(stream, Loader=BACKENDS[backend][0])
+
+
+def dump(data, stream=None):
+    return yaml.dump(data, stream, Dumper=BACKENDS[backend][1])
+
+
+# Reads yaml files in one go. Used by the worker processes parsing req files, which only import this module.
+def load_files(file_paths, backend_name=None):
+    loader = BACKENDS[backend_name or backend][0]
+    docs = []
+    for file_path in file_paths:
+        with open(file_path, 'r') as yaml_file:
+            docs.append(yaml.load(yaml_file, Loader=loader))
+    return docs
@@ -10,7 +10,6 @@ setup(
   download_url = 'https://github.com/niradynamics/git-reqs/archive/0.1.tar.gz',
   keywords = ['Requirements', 'gitreqs'],
    install_requires=[
-           'junitparser',
            'networkx',
            'numpy',
            'pydot',
@@ -1,240 +1,516 @@
 import unittest
 import os
 import sys
-import shutil
+import subprocess
+import tempfile
+import json
+import yaml
 from openpyxl import load_workbook, Workbook
+sys.path.append("..")
 sys.path.append("../git_reqs")
 import requirementmodule
+from helpers import temp_repo, in_temp_repo, GIT_REQS
 from exporttools import convert_to_xls
 
-class TestGitReqs(unittest.TestCase):
-    def test_init(self):
-        if os.path.exists("test_init"):
-            shutil.rmtree("test_init", ignore_errors=True)
-
-        self.assertEqual(os.system('../git-reqs init --module test_init --module_prefix TEST1 --root_module'), 0)
-        self.assertEqual(os.system('cd test_init && ../../git-reqs init --module test_init2 --module_prefix TEST2 --root_module'), 0)
-        self.assertEqual(os.system('cd test_init/test_init2 && ../../../git-reqs init --module test_init3 --module_prefix TEST3'), 0)
-        self.assertEqual(os.system('cd test_init/test_init2 && ../../../git-reqs init --module test_init4 --module_prefix TEST4 --req_numbering_format numbers'), 0)
-
-        req_module = requirementmodule.requirement_module("./test_init")
+# Max time in seconds for the cli to import its modules
+STARTUP_TIME_BUDGET = 2.0
 
-        self.assertEqual(req_module.config['module_prefix'], "TEST1")
-        self.assertEqual(req_module.config['root_module'], True)
-        self.assertEqual(req_module.config['req_number_format'], "time_hash")
-
-        self.assertEqual(req_module.modules['test_init2'].config['module_prefix'], "TEST2")
-        self.assertEqual(req_module.modules['test_init2'].config['root_module'], True)
-        self.assertEqual(req_module.modules['test_init2'].config['req_number_format'], "time_hash")
-
-        self.assertEqual(
-            req_module.modules['test_init2'].modules['test_init3'].config['module_prefix'], "TEST3")
-        self.assertEqual(
-            req_module.modules['test_init2'].modules['test_init3'].config['root_module'], False)
-        self.assertEqual(
-            req_module.modules['test_init2'].modules['test_init3'].config['req_number_format'],
-            "time_hash")
-
-        self.assertEqual(
-            req_module.modules['test_init2'].modules['test_init4'].config['module_prefix'], "TEST4")
-        self.assertEqual(
-            req_module.modules['test_init2'].modules['test_init4'].config['root_module'], False)
-        self.assertEqual(req_module.modules['test_init2'].modules['test_init4'].config['req_number_format'],
-            "numbers")
+class TestGitReqs(unittest.TestCase):
+    def test_startup_time(self):
+        result = subprocess.run([sys.executable, '-X', 'importtime', GIT_REQS, '--help'],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(result.returncode, 0)
+
+        imported = []
+        startup_time = 0
+        for line in result.stderr.splitlines():
+            if line.startswith('import time:') and not line.endswith('imported package'):
+                _, cumulative, name = line.split('|')
+                imported.append(name.strip())
+                # Only count the top level imports, the cumulative time includes the nested ones
+                if not name[1:].startswith(' '):
+                    startup_time += int(cumulative) / 1e6
+
+        # The heavy dependencies shall only be imported by the commands using them
+        for module in ['networkx', 'bokeh', 'openpyxl', 'pydot', 'git', 'junitparser']:
+            self.assertFalse(module in imported, "%s imported at startup" % module)
+        self.assertLess(startup_time, STARTUP_TIME_BUDGET)
 
-        shutil.rmtree("test_init", ignore_errors=True)
+    def test_init(self):
+        with in_temp_repo():
+            self.assertEqual(os.system('%s init --module test_init --module_prefix TEST1 --root_module' % GIT_REQS), 0)
+            self.assertEqual(os.system('cd test_init && %s init --module test_init2 --module_prefix TEST2 --root_module' % GIT_REQS), 0)
+            self.assertEqual(os.system('cd test_init/test_init2 && %s init --module test_init3 --module_prefix TEST3' % GIT_REQS), 0)
+            self.assertEqual(os.system('cd test_init/test_init2 && %s init --module test_init4 --module_prefix TEST4 --req_numbering_format numbers' % GIT_REQS), 0)
+
+            req_module = requirementmodule.requirement_module("./test_init")
+
+            self.assertEqual(req_module.config['module_prefix'], "TEST1")
+            self.assertEqual(req_module.config['root_module'], True)
+            self.assertEqual(req_module.config['req_number_format'], "time_hash")
+
+            self.assertEqual(req_module.modules['test_init2'].config['module_prefix'], "TEST2")
+            self.assertEqual(req_module.modules['test_init2'].config['root_module'], True)
+            self.assertEqual(req_module.modules['test_init2'].config['req_number_format'], "time_hash")
+
+            self.assertEqual(
+                req_module.modules['test_init2'].modules['test_init3'].config['module_prefix'], "TEST3")
+            self.assertEqual(
+                req_module.modules['test_init2'].modules['test_init3'].config['root_module'], False)
+            self.assertEqual(
+                req_module.modules['test_init2'].modules['test_init3'].config['req_number_format'],
+                "time_hash")
+
+            self.assertEqual(
+                req_module.modules['test_init2'].modules['test_init4'].config['module_prefix'], "TEST4")
+            self.assertEqual(
+                req_module.modules['test_init2'].modules['test_init4'].config['root_module'], False)
+            self.assertEqual(req_module.modules['test_init2'].modules['test_init4'].config['req_number_format'],
+                "numbers")
 
     def test_export(self):
-        if os.path.exists("test_export"):
-            shutil.rmtree("test_export", ignore_errors=True)
-
-        self.assertEqual(os.system('../git-reqs init --module test_export --module_prefix TEST1'), 0)
-        self.assertEqual(os.system('cd test_export && ../../git-reqs init --module test_export2 --module_prefix TEST2 --root_module'), 0)
+        with in_temp_repo():
+            self.assertEqual(os.system('%s init --module test_export --module_prefix TEST1' % GIT_REQS), 0)
+            self.assertEqual(os.system('cd test_export && %s init --module test_export2 --module_prefix TEST2 --root_module' % GIT_REQS), 0)
 
-        req_module = requirementmodule.requirement_module("./test_export")
+            req_module = requirementmodule.requirement_module("./test_export")
 
-        # Create some reqs
-        req_1 = {'Req-Id': '', 'Type': 'Requirement', 'Description': 'Req desc 1',
-                 'upward_links': 'extern:Ext_1'}
-        req_2 = {'Req-Id': '', 'Type': 'Requirement', 'Description': 'Req desc 2',
-                 'downward_links': 'verifies:Test_1', 'upward_links': 'refines:Req_1'}
-        test_1 = {'Req-Id': '', 'Type': 'Testcase', 'Description': 'Test desc 1'}
+            # Create some reqs
+            req_1 = {'Req-Id': '', 'Type': 'Requirement', 'Description': 'Req desc 1',
+                     'upward_links': 'extern:Ext_1'}
+            req_2 = {'Req-Id': '', 'Type': 'Requirement', 'Description': 'Req desc 2',
+                     'downward_links': 'verifies:Test_1', 'upward_links': 'refines:Req_1'}
+            test_1 = {'Req-Id': '', 'Type': 'Testcase', 'Description': 'Test desc 1'}
 
-        req_1['Req-Id'] = req_module.add_req(req_1)
-        req_2['Req-Id'] = req_module.add_req(req_2)
-        test_1['Req-Id'] = req_module.modules['test_export2'].add_req(test_1)
+            req_1['Req-Id'] = req_module.add_req(req_1)
+            req_2['Req-Id'] = req_module.add_req(req_2)
+            test_1['Req-Id'] = req_module.modules['test_export2'].add_req(test_1)
 
-        for field in req_1.keys():
-            self.assertTrue(field in req_module.fields)
-        for field in req_2.keys():
-            self.assertTrue(field in req_module.fields)
-        for field in test_1.keys():
-            self.assertTrue(field in req_module.modules['test_export2'].fields)
+            for field in req_1.keys():
+                self.assertTrue(field in req_module.fields)
+            for field in req_2.keys():
+                self.assertTrue(field in req_module.fields)
+            for field in test_1.keys():
+                self.assertTrue(field in req_module.modules['test_export2'].fields)
 
-        req_module.write_reqs()
+            req_module.write_reqs()
 
-        self.assertEqual(os.system(('../git-reqs export --project_root ./test_export --format md')), 0)
-        self.assertEqual(os.system(('cd test_export && ../../git-reqs export --format xls')), 0)
-        self.assertEqual(os.system(('cd test_export && ../../git-reqs export --module test_export2 --format xls')), 0)
+            self.assertEqual(os.system(('%s export --project_root ./test_export --format md' % GIT_REQS)), 0)
+            self.assertEqual(os.system(('cd test_export && %s export --format xls' % GIT_REQS)), 0)
+            self.assertEqual(os.system(('cd test_export && %s export --module test_export2 --format xls' % GIT_REQS)), 0)
 
-        wb1 = load_workbook('./test_export/TEST1.xlsx')
+            wb1 = load_workbook('./test_export/TEST1.xlsx')
 
 
-        sheet = wb1['TEST1']
-        for col, field in enumerate(req_module.fields):
-            self.assertEqual(sheet.cell(1, col+1).value, field)
-            if field in req_1.keys():
-                self.assertEqual(sheet.cell(2, col+1).value, req_1[field])
-            if field in req_2.keys():
-                self.assertEqual(sheet.cell(3, col+1).value, req_2[field])
+            sheet = wb1['TEST1']
+            for col, field in enumerate(req_module.fields):
+                self.assertEqual(sheet.cell(1, col+1).value, field)
+                if field in req_1.keys():
+                    self.assertEqual(sheet.cell(2, col+1).value, req_1[field])
+                if field in req_2.keys():
+                    self.assertEqual(sheet.cell(3, col+1).value, req_2[field])
 
-        wb2 = load_workbook('./test_export/test_export2/TEST1_TEST2.xlsx')
-        sheet = wb2['TEST1_TEST2']
-        for col, field in enumerate(req_module.modules['test_export2'].fields):
-            self.assertEqual(sheet.cell(1, col+1).value, field)
+            wb2 = load_workbook('./test_export/test_export2/TEST1_TEST2.xlsx')
+            sheet = wb2['TEST1_TEST2']
+            for col, field in enumerate(req_module.modules['test_export2'].fields):
+                self.assertEqual(sheet.cell(1, col+1).value, field)
 
-            if field in test_1.keys():
-                self.assertEqual(sheet.cell(2, col+1).value, test_1[field])
+                if field in test_1.keys():
+                    self.assertEqual(sheet.cell(2, col+1).value, test_1[field])
 
-        shutil.rmtree("test_export", ignore_errors=True)
+            # The write-only export gives the same sheets
+            self.assertEqual(os.system(('cd test_export && %s export --format xls --write_only' % GIT_REQS)), 0)
+            wb3 = load_workbook('./test_export/TEST1.xlsx')
+            self.assertEqual(wb3.sheetnames, wb1.sheetnames)
+            for sheet_name in wb1.sheetnames:
+                self.assertEqual(list(wb3[sheet_name].values), list(wb1[sheet_name].values))
 
     def test_import(self):
-        if os.path.exists("test_import"):
-            shutil.rmtree("test_import", ignore_errors=True)
-
-        self.assertEqual(os.system('../git-reqs init --module test_import --module_prefix TEST1 --req_numbering_format numbers'), 0)
-        self.assertEqual(os.system('cd test_import && ../../git-reqs init --module test_import2 --module_prefix TEST2 --root_module --req_numbering_format numbers'), 0)
-
-        wb = Workbook()
-
-        # Create some reqs
-        req_1 = {'Req-Id': '', 'Type': 'Requirement', 'Description': 'Req desc 1',
-                 'upward_links': 'extern:Ext_1'}
-        req_2 = {'Req-Id': '', 'Type': 'Requirement', 'Description': 'Req desc 2',
-                 'downward_links': 'verifies:TEST1_TEST2_1', 'upward_links': 'refines:TEST1_1'}
-        test_1 = {'Req-Id': '', 'Type': 'Testcase', 'Description': 'Test desc 1'}
-
-        fields = list(req_1.keys())
-        fields.extend(list(req_2.keys()))
-        fields.extend(list(test_1.keys()))
-        fields = set(fields)
-
-        sheet1 = wb[wb.sheetnames[0]]
-        sheet2 = wb.copy_worksheet(wb[wb.sheetnames[0]])
-        sheet1.title = "TEST1"
-        sheet2.title = "TEST1_TEST2"
-
-        for col, field in enumerate(fields):
-            sheet1.cell(1, col + 1, field)
-            sheet2.cell(1, col + 1, field)
-            if field in req_1.keys():
-                sheet1.cell(2, col + 1, req_1[field])
-            if field in req_2.keys():
-                sheet1.cell(3, col + 1, req_2[field])
-            if field in test_1.keys():
-                sheet2.cell(2, col + 1, test_1[field])
-
-        wb.save("./test_import/TEST1.xlsx")
-
-        self.assertEqual(os.system(('cd test_import && ../../git-reqs import --format xlsx')), 0)
-
-
-        req_module = requirementmodule.requirement_module("./test_import")
-
-        for field in fields:
-            if field != 'Req-Id':
+        with in_temp_repo():
+            self.assertEqual(os.system('%s init --module test_import --module_prefix TEST1 --req_numbering_format numbers' % GIT_REQS), 0)
+            self.assertEqual(os.system('cd test_import && %s init --module test_import2 --module_prefix TEST2 --root_module --req_numbering_format numbers' % GIT_REQS), 0)
+
+            wb = Workbook()
+
+            # Create some reqs
+            req_1 = {'Req-Id': '', 'Type': 'Requirement', 'Description': 'Req desc 1',
+                     'upward_links': 'extern:Ext_1'}
+            req_2 = {'Req-Id': '', 'Type': 'Requirement', 'Description': 'Req desc 2',
+                     'downward_links': 'verifies:TEST1_TEST2_1', 'upward_links': 'refines:TEST1_1'}
+            test_1 = {'Req-Id': '', 'Type': 'Testcase', 'Description': 'Test desc 1'}
+
+            fields = list(req_1.keys())
+            fields.extend(list(req_2.keys()))
+            fields.extend(list(test_1.keys()))
+            fields = set(fields)
+
+            sheet1 = wb[wb.sheetnames[0]]
+            sheet2 = wb.copy_worksheet(wb[wb.sheetnames[0]])
+            sheet1.title = "TEST1"
+            sheet2.title = "TEST1_TEST2"
+
+            for col, field in enumerate(fields):
+                sheet1.cell(1, col + 1, field)
+                sheet2.cell(1, col + 1, field)
                 if field in req_1.keys():
-                    self.assertEqual(req_module.reqs.nodes["TEST1_1"][field], req_1[field])
+                    sheet1.cell(2, col + 1, req_1[field])
                 if field in req_2.keys():
-                    self.assertEqual(req_module.reqs.nodes["TEST1_2"][field], req_2[field])
+                    sheet1.cell(3, col + 1, req_2[field])
                 if field in test_1.keys():
-                    self.assertEqual(req_module.modules["test_import2"].reqs.nodes["TEST1_TEST2_1"][field], test_1[field])
+                    sheet2.cell(2, col + 1, test_1[field])
 
-        self.assertEqual(os.system(('../git-reqs import --project_root ./test_import --format xlsx')), 0)
-        self.assertEqual(os.system(('cd test_import && ../../git-reqs import --format xls --file TEST1.xlsx')), 0)
+            wb.save("./test_import/TEST1.xlsx")
 
-        shutil.rmtree("test_import", ignore_errors=True)
+            self.assertEqual(os.system(('cd test_import && %s import --format xlsx' % GIT_REQS)), 0)
 
-    def test_report(self):
-        if os.path.exists("test_report"):
-            shutil.rmtree("test_report", ignore_errors=True)
-
-        self.assertEqual(os.system('../git-reqs init --module test_report --module_prefix TEST1'), 0)
-        self.assertEqual(os.system('cd test_report && ../../git-reqs init --module test_report2 --module_prefix TEST2 --root_module'), 0)
 
-        req_module = requirementmodule.requirement_module("./test_report")
+            req_module = requirementmodule.requirement_module("./test_import")
 
-        # Create some reqs
-        test_1 = {'Req-Id': '', 'Type': 'Testcase', 'Description': 'Test desc 1'}
-        test_1['Req-Id'] = req_module.modules['test_report2'].add_req(test_1)
-        req_1 = {'Req-Id': '', 'Type': 'Requirement', 'Description': 'Req desc 1',
-                 'upward_links': 'extern:Ext_1'}
-        req_1['Req-Id'] = req_module.add_req(req_1)
-        req_2 = {'Req-Id': '', 'Type': 'Requirement', 'Description': 'Req desc 2',
-                 'downward_links': 'verifies:%s' % test_1['Req-Id'], 'upward_links': 'refines:%s' % req_1['Req-Id']}
-        req_2['Req-Id'] = req_module.add_req(req_2)
+            for field in fields:
+                if field != 'Req-Id':
+                    if field in req_1.keys():
+                        self.assertEqual(req_module.reqs.nodes["TEST1_1"][field], req_1[field])
+                    if field in req_2.keys():
+                        self.assertEqual(req_module.reqs.nodes["TEST1_2"][field], req_2[field])
+                    if field in test_1.keys():
+                        self.assertEqual(req_module.modules["test_import2"].reqs.nodes["TEST1_TEST2_1"][field], test_1[field])
 
-        req_module.write_reqs()
+            self.assertEqual(os.system(('%s import --project_root ./test_import --format xlsx' % GIT_REQS)), 0)
+            self.assertEqual(os.system(('cd test_import && %s import --format xls --file TEST1.xlsx' % GIT_REQS)), 0)
 
-        self.assertEqual(os.system(('../git-reqs report --project_root ./test_report --type test_coverage --dont_show_output')), 0)
-        self.assertEqual(os.system(('../git-reqs report --project_root ./test_report --type relations --dont_show_output')), 0)
+    def test_report(self):
+        with in_temp_repo():
+            self.assertEqual(os.system('%s init --module test_report --module_prefix TEST1' % GIT_REQS), 0)
+            self.assertEqual(os.system('cd test_report && %s init --module test_report2 --module_prefix TEST2 --root_module' % GIT_REQS), 0)
+
+            req_module = requirementmodule.requirement_module("./test_report")
+
+            # Create some reqs
+            test_1 = {'Req-Id': '', 'Type': 'Testcase', 'Description': 'Test desc 1'}
+            test_1['Req-Id'] = req_module.modules['test_report2'].add_req(test_1)
+            req_1 = {'Req-Id': '', 'Type': 'Requirement', 'Description': 'Req desc 1',
+                     'upward_links': 'extern:Ext_1'}
+            req_1['Req-Id'] = req_module.add_req(req_1)
+            req_2 = {'Req-Id': '', 'Type': 'Requirement', 'Description': 'Req desc 2',
+                     'downward_links': 'verifies:%s' % test_1['Req-Id'], 'upward_links': 'refines:%s' % req_1['Req-Id']}
+            req_2['Req-Id'] = req_module.add_req(req_2)
+
+            req_module.write_reqs()
+
+            self.assertEqual(os.system(('%s report --project_root ./test_report --type test_coverage --dont_show_output' % GIT_REQS)), 0)
+            self.assertEqual(os.system(('%s report --project_root ./test_report --type relations --dont_show_output' % GIT_REQS)), 0)
+
+    def test_layout_cache(self):
+        import exporttools
+        import networkx as nx
+        laid_out = []
+
+        def fake_layout(G):
+            laid_out.append(sorted(G.nodes))
+            return {node: (i * 10.0, -i * 10.0) for i, node in enumerate(sorted(G.nodes))}
+
+        from git_reqs import cache
+        max_entries = cache.LAYOUT_MAX_ENTRIES
+        run_graph_layout = exporttools.run_graph_layout
+        exporttools.run_graph_layout = fake_layout
+        try:
+            with tempfile.TemporaryDirectory() as module_path:
+                G = nx.DiGraph([('A', 'B'), ('B', 'C'), ('D', 'E')])
+                pos = exporttools.get_graph_layout(G, module_path)
+                self.assertEqual(list(pos.keys()), list(G.nodes))
+                self.assertEqual(laid_out, [['A', 'B', 'C', 'D', 'E']])
+
+                # Only the changed component is laid out again
+                G.add_edge('E', 'F')
+                new_pos = exporttools.get_graph_layout(G, module_path)
+                self.assertEqual(laid_out[1:], [['D', 'E', 'F']])
+                for node in ['A', 'B', 'C']:
+                    self.assertEqual(new_pos[node], pos[node])
+
+                exporttools.get_graph_layout(G, module_path)
+                self.assertEqual(len(laid_out), 2)
+                with open(module_path + '/.git-reqs-cache/layouts.json', 'r') as layouts_file:
+                    self.assertEqual(len(json.load(layouts_file)['entries']), 3)
+
+                # More components than the cache holds, the ones of the graph are kept and the others evicted
+                cache.LAYOUT_MAX_ENTRIES = 4
+                G = nx.DiGraph()
+                G.add_nodes_from(['N%d' % i for i in range(6)])
+                pos = exporttools.get_graph_layout(G, module_path)
+                self.assertEqual(sorted(pos), sorted(G.nodes))
+                with open(module_path + '/.git-reqs-cache/layouts.json', 'r') as layouts_file:
+                    self.assertEqual(len(json.load(layouts_file)['entries']), 6)
+                exporttools.get_graph_layout(G, module_path)
+                self.assertEqual(len(laid_out), 3)
+        finally:
+            exporttools.run_graph_layout = run_graph_layout
+            cache.LAYOUT_MAX_ENTRIES = max_entries
+
+    def test_coverage_table(self):
+        from git_reqs.coverage import coverage_table
+        import networkx as nx
+        reqs = nx.DiGraph()
+        for req, status in [('Req_1', 1), ('Req_2', 1), ('Req_3', 0.5), ('Req_4', None), ('Req_5', 1)]:
+            non_stored_fields = {} if status is None else {'verifies_link_status': status}
+            reqs.add_node(req, Type='Requirement', Description=req + ' desc', non_stored_fields=non_stored_fields)
+        for test, result in [('Test_1', 'Passed'), ('Test_2', 'failure')]:
+            reqs.add_node(test, Type='Testcase', Description=test)
+            reqs.add_node(test + '_result', Type='Test-Result', result=result, Description=test)
+            reqs.add_edge(test, test + '_result')
+        reqs.add_edges_from([('Req_1', 'Test_1'), ('Req_2', 'Test_1'), ('Req_2', 'Test_2'), ('Req_3', 'Test_1'),
+                             ('Req_5', 'Req_1')])
+
+        coverage = coverage_table(reqs)
+        self.assertEqual(len(coverage), 5)
+        self.assertEqual(coverage.get_group('passed')['Req-Ids'], ['Req_1', 'Req_5'])
+        self.assertEqual(coverage.get_group('passed')['leaves'], [['Test_1_result'], ['Test_1_result']])
+        self.assertEqual(coverage.get_group('failed')['Req-Ids'], ['Req_2'])
+        self.assertEqual(coverage.get_group('partly_tested')['Req-Ids'], ['Req_3'])
+        self.assertEqual(coverage.get_group('partly_tested')['result'], ['partly tested'])
+        self.assertEqual(coverage.get_group('untested')['Req-Ids'], ['Req_4'])
+        self.assertEqual(coverage.count('fully_tested'), 0)
+
+    def test_coverage_report(self):
+        with temp_repo('test_coverage', 'TEST1') as repo_path:
+            module_path = repo_path + '/test_coverage'
+            req_module = requirementmodule.requirement_module(module_path)
+            test_1 = req_module.add_req({'Req-Id': '', 'Type': 'Testcase', 'Description': 'Test desc 1'})
+            req_module.add_req({'Req-Id': '', 'Type': 'Requirement', 'Description': 'Req desc 1',
+                                'downward_links': 'verifies:%s' % test_1})
+            req_module.add_req({'Req-Id': '', 'Type': 'Requirement', 'Description': 'Req desc 2'})
+            req_module.write_reqs()
+
+            report = '%s report --project_root %s --type test_coverage ' % (GIT_REQS, module_path)
+            self.assertEqual(os.system(report + '--format json --file %s/coverage.json '
+                                                '--max untested=50 --min fully_tested=50' % module_path), 0)
+            with open(module_path + '/coverage.json', 'r') as json_file:
+                coverage = json.load(json_file)
+            self.assertEqual(coverage['total'], 2)
+            self.assertEqual(coverage['counts']['fully_tested'], 1)
+            self.assertEqual(coverage['counts']['untested'], 1)
+            self.assertNotEqual(os.system(report + '--format csv --max untested=49'), 0)
+            self.assertTrue(os.path.exists(module_path + '/TEST1_TestCoverage.csv'))
 
-        shutil.rmtree("test_report", ignore_errors=True)
-        
     def test_links(self):
-        if os.path.exists("test_links"):
-            shutil.rmtree("test_links", ignore_errors=True)
-
-        self.assertEqual(os.system('../git-reqs init --module test_links --module_prefix ROOT --root_module'), 0)
-        self.assertEqual(os.system('cd test_links && ../../git-reqs init --module ProductSpec --module_prefix PROD'), 0)
-        self.assertEqual(os.system('cd test_links && ../../git-reqs init --module SubSystemRoot --module_prefix SubSystem'), 0)
-        self.assertEqual(os.system('cd test_links/SubSystemRoot && ../../../git-reqs init --module SystemRS --module_prefix SystemRS'), 0)
-        self.assertEqual(os.system('cd test_links/SubSystemRoot && ../../../git-reqs init --module Test --module_prefix Test'), 0)
-
-        req_module = requirementmodule.requirement_module("./test_links")
-        
-        # Create some reqs
-        ProdReq_1 = {'Req-Id': '', 'Type': 'Requirement', 'Description': 'Prod desc 1'}
-        ProdReq_1['Req-Id'] = req_module.modules['ProductSpec'].add_req(ProdReq_1).split('_')[-1]
-
-        # Link a subsystem requirement to an external requirement
-        SubSystemReq1 = {'Req-Id': '', 'Type': 'Requirement', 'Description': 'Req desc 1',
-                 'upward_links': 'extern:Ext_1'}        
-        SubSystemReq1['Req-Id'] = req_module.modules['SubSystemRoot'].modules['SystemRS'].add_req(SubSystemReq1).split('_')[-1]
-
-        # Link a test-case to a requirement on a sibling level module
-        SubSystemTest1 = {'Req-Id': '', 'Type': 'Testcase', 'Description': 'Req desc 2',
-                 'upward_links': 'verfies:SystemRS_%s' % SubSystemReq1['Req-Id']}
-        SubSystemTest1['Req-Id'] = req_module.modules['SubSystemRoot'].modules['Test'].add_req(SubSystemTest1).split('_')[-1]
-
-        # Link a requirement to a requirement in the same module, using only the number, and to the two-down-one-up
-        # Production spec.
-        SubSystemReq2 = {'Req-Id': '', 'Type': 'Requirement', 'Description': 'Req desc 1',
-                         'upward_links': 'refines:%s,refines:PROD_%s' % (SubSystemReq1['Req-Id'], ProdReq_1['Req-Id'])}
-        SubSystemReq2['Req-Id'] = req_module.modules['SubSystemRoot'].modules['SystemRS'].add_req(SubSystemReq2).split('_')[-1]
-
-        ProdReq_2 = {'Req-Id': '', 'Type': 'Requirement', 'Description': 'Prod desc 2',
-                     'downward_links': 'refines:SubSystem_SystemRS_%s' % SubSystemReq1['Req-Id']}
-        ProdReq_2['Req-Id'] = req_module.modules['ProductSpec'].add_req(ProdReq_2).split('_')[-1]
-
-        # Write the reqs and load the module again to get the links read properly
-        req_module.write_reqs()
-        req_module = requirementmodule.requirement_module("./test_links")
-
-
-        self.assertTrue(('Ext_1', 'ROOT_SubSystem_SystemRS_%s' % SubSystemReq1['Req-Id'])\
-                        in list(req_module.reqs.edges))
-        self.assertTrue(('ROOT_SubSystem_SystemRS_%s' % SubSystemReq1['Req-Id'],
-                         'ROOT_SubSystem_Test_%s' % SubSystemTest1['Req-Id']) \
-                        in list(req_module.reqs.edges))
-        self.assertTrue(('ROOT_PROD_%s' % ProdReq_1['Req-Id'], 'ROOT_SubSystem_SystemRS_%s' % SubSystemReq2['Req-Id']) \
-                        in list(req_module.reqs.edges))
-        self.assertTrue(('ROOT_PROD_%s' % ProdReq_2['Req-Id'],
-                         'ROOT_SubSystem_SystemRS_%s' % SubSystemReq1['Req-Id']) \
-                        in list(req_module.reqs.edges))
-
-        shutil.rmtree("test_links", ignore_errors=True)
+        with in_temp_repo():
+            self.assertEqual(os.system('%s init --module test_links --module_prefix ROOT --root_module' % GIT_REQS), 0)
+            self.assertEqual(os.system('cd test_links && %s init --module ProductSpec --module_prefix PROD' % GIT_REQS), 0)
+            self.assertEqual(os.system('cd test_links && %s init --module SubSystemRoot --module_prefix SubSystem' % GIT_REQS), 0)
+            self.assertEqual(os.system('cd test_links/SubSystemRoot && %s init --module SystemRS --module_prefix SystemRS' % GIT_REQS), 0)
+            self.assertEqual(os.system('cd test_links/SubSystemRoot && %s init --module Test --module_prefix Test' % GIT_REQS), 0)
+
+            req_module = requirementmodule.requirement_module("./test_links")
         
+            # Create some reqs
+            ProdReq_1 = {'Req-Id': '', 'Type': 'Requirement', 'Description': 'Prod desc 1'}
+            ProdReq_1['Req-Id'] = req_module.modules['ProductSpec'].add_req(ProdReq_1).split('_')[-1]
+
+            # Link a subsystem requirement to an external requirement
+            SubSystemReq1 = {'Req-Id': '', 'Type': 'Requirement', 'Description': 'Req desc 1',
+                     'upward_links': 'extern:Ext_1'}        
+            SubSystemReq1['Req-Id'] = req_module.modules['SubSystemRoot'].modules['SystemRS'].add_req(SubSystemReq1).split('_')[-1]
+
+            # Link a test-case to a requirement on a sibling level module
+            SubSystemTest1 = {'Req-Id': '', 'Type': 'Testcase', 'Description': 'Req desc 2',
+                     'upward_links': 'verfies:SystemRS_%s' % SubSystemReq1['Req-Id']}
+            SubSystemTest1['Req-Id'] = req_module.modules['SubSystemRoot'].modules['Test'].add_req(SubSystemTest1).split('_')[-1]
+
+            # Link a requirement to a requirement in the same module, using only the number, and to the two-down-one-up
+            # Production spec.
+            SubSystemReq2 = {'Req-Id': '', 'Type': 'Requirement', 'Description': 'Req desc 1',
+                             'upward_links': 'refines:%s,refines:PROD_%s' % (SubSystemReq1['Req-Id'], ProdReq_1['Req-Id'])}
+            SubSystemReq2['Req-Id'] = req_module.modules['SubSystemRoot'].modules['SystemRS'].add_req(SubSystemReq2).split('_')[-1]
+
+            ProdReq_2 = {'Req-Id': '', 'Type': 'Requirement', 'Description': 'Prod desc 2',
+                         'downward_links': 'refines:SubSystem_SystemRS_%s' % SubSystemReq1['Req-Id']}
+            ProdReq_2['Req-Id'] = req_module.modules['ProductSpec'].add_req(ProdReq_2).split('_')[-1]
+
+            # Write the reqs and load the module again to get the links read properly
+            req_module.write_reqs()
+            req_module = requirementmodule.requirement_module("./test_links")
+
+
+            self.assertTrue(('Ext_1', 'ROOT_SubSystem_SystemRS_%s' % SubSystemReq1['Req-Id'])\
+                            in list(req_module.reqs.edges))
+            self.assertTrue(('ROOT_SubSystem_SystemRS_%s' % SubSystemReq1['Req-Id'],
+                             'ROOT_SubSystem_Test_%s' % SubSystemTest1['Req-Id']) \
+                            in list(req_module.reqs.edges))
+            self.assertTrue(('ROOT_PROD_%s' % ProdReq_1['Req-Id'], 'ROOT_SubSystem_SystemRS_%s' % SubSystemReq2['Req-Id']) \
+                            in list(req_module.reqs.edges))
+            self.assertTrue(('ROOT_PROD_%s' % ProdReq_2['Req-Id'],
+                             'ROOT_SubSystem_SystemRS_%s' % SubSystemReq1['Req-Id']) \
+                            in list(req_module.reqs.edges))
+
+    def test_source_links(self):
+        import importtools
+        with temp_repo('test_source_links', 'SRC', req_numbering='numbers') as repo_path:
+            module_path = repo_path + '/test_source_links'
+            requirementmodule.init_module(module_path, 'Tests', 'T', req_numbering='numbers')
+            req_module = requirementmodule.requirement_module(module_path)
+            req_module.config['source_paths'] = ['src', 'src/sub']
+            req_module.config['source_extensions'] = ['py', 'c']
+            req_module.add_req({'Req-Id': '', 'Type': 'Requirement', 'Description': 'Req desc 1',
+                                'downward_links': ''})
+            req_module.write_reqs()
+
+            os.makedirs(module_path + '/src/sub')
+            with open(module_path + '/src/a.py', 'w') as src_file:
+                src_file.write('def test_a():\n    # git-reqs: T_7 verifies 1\n    pass\n')
+            with open(module_path + '/src/sub/b.c', 'w') as src_file:
+                src_file.write('// git-reqs: ?Tests:Testcase:New..test verifies 1\r\nint b;\r\n')
+            with open(module_path + '/src/sub/c.h', 'w') as src_file:
+                src_file.write('// git-reqs: T_8 verifies 1\n')
+            mtime = os.path.getmtime(module_path + '/src/a.py')
+
+            importtools.parse_requirement_links(req_module, module_path)
+            self.assertEqual(req_module.reqs.nodes['SRC_1']['downward_links'], 'verifies:T_7,verifies:T_1')
+            self.assertEqual(req_module.modules['Tests'].ordered_req_names, ['SRC_T_1'])
+            with open(module_path + '/src/sub/b.c', 'r', newline='') as src_file:
+                self.assertEqual(src_file.read(), '// git-reqs: T_1 verifies 1\r\nint b;\r\n')
+            self.assertEqual(os.path.getmtime(module_path + '/src/a.py'), mtime)
+
+    def test_incremental_source_links(self):
+        import importtools
+        import git
+        with temp_repo('reqs', 'SRC', req_numbering='numbers') as repo_path:
+            git_repo = git.Repo(repo_path)
+            req_module = requirementmodule.requirement_module(repo_path + '/reqs')
+            req_module.config['source_paths'] = ['../src']
+            req_module.config['source_extensions'] = ['py']
+            # The link of req 2 is also written by hand
+            for i, links in enumerate(['', 'verifies:T_5']):
+                req_module.add_req({'Req-Id': '', 'Type': 'Requirement', 'Description': 'Req desc %d' % i,
+                                    'downward_links': links})
+            req_module.write_reqs()
+
+            os.makedirs(repo_path + '/src')
+            with open(repo_path + '/src/a.py', 'w') as src_file:
+                src_file.write('# git-reqs: T_1 verifies 1\n# git-reqs: T_2 verifies 2\n')
+            with open(repo_path + '/src/b.py', 'w') as src_file:
+                src_file.write('# git-reqs: T_3 verifies 1\n# git-reqs: T_5 verifies 2\n')
+            importtools.parse_requirement_links(req_module, repo_path + '/reqs')
+            self.assertEqual(req_module.reqs.nodes['SRC_1']['downward_links'], 'verifies:T_1,verifies:T_3')
+            self.assertEqual(req_module.reqs.nodes['SRC_2']['downward_links'], 'verifies:T_5,verifies:T_2')
+            git_repo.git.add('src')
+            git_repo.index.commit('Add sources')
+            importtools.parse_requirement_links(req_module, repo_path + '/reqs')
+            git_repo.index.commit('Scan sources')
+
+            # Only the changed file is scanned, its old links are retracted, but not the ones written by hand
+            with open(repo_path + '/src/a.py', 'w') as src_file:
+                src_file.write('# git-reqs: T_4 verifies 2\n# git-reqs: T_2 verifies 2\n')
+            os.remove(repo_path + '/src/b.py')
+            scanned = []
+            scan_source_file = importtools.scan_source_file
+            importtools.scan_source_file = lambda path, pattern: scanned.append(path) or scan_source_file(path, pattern)
+            try:
+                importtools.parse_requirement_links(req_module, repo_path + '/reqs', incremental=True)
+            finally:
+                importtools.scan_source_file = scan_source_file
+            self.assertEqual(scanned, [repo_path + '/src/a.py'])
+            self.assertEqual(req_module.reqs.nodes['SRC_1']['downward_links'], '')
+            self.assertEqual(req_module.reqs.nodes['SRC_2']['downward_links'], 'verifies:T_5,verifies:T_2,verifies:T_4')
+
+            with open(repo_path + '/reqs/source-links.yaml', 'r') as state_file:
+                state = yaml.safe_load(state_file)
+            self.assertEqual(state['commit'], git_repo.head.commit.hexsha)
+            self.assertEqual(state['links'], {'../src/a.py': [['SRC_2', 'verifies:T_4'], ['SRC_2', 'verifies:T_2']]})
+            self.assertEqual(state['added'], [['SRC_2', 'verifies:T_2'], ['SRC_2', 'verifies:T_4']])
+            self.assertEqual(state['dirty'], ['../src/a.py', '../src/b.py'])
+
+            # Files reverted to the scanned commit are scanned again, as they were changed when last scanned
+            git_repo.git.checkout('--', 'src/a.py', 'src/b.py')
+            importtools.parse_requirement_links(req_module, repo_path + '/reqs', incremental=True)
+            self.assertEqual(req_module.reqs.nodes['SRC_1']['downward_links'], 'verifies:T_1,verifies:T_3')
+            self.assertEqual(req_module.reqs.nodes['SRC_2']['downward_links'], 'verifies:T_5,verifies:T_2')
+            with open(repo_path + '/reqs/source-links.yaml', 'r') as state_file:
+                self.assertEqual(yaml.safe_load(state_file)['dirty'], [])
+
+    def test_server(self):
+        import threading
+        import server
+        with temp_repo('reqs', 'SRV', req_numbering='numbers') as repo_path:
+            req_module = requirementmodule.requirement_module(repo_path + '/reqs')
+            req_module.add_req({'Req-Id': '', 'Type': 'Requirement', 'Description': 'Req desc'})
+            req_module.write_reqs()
+
+            self.assertEqual(server.send_request(repo_path + '/reqs', {'command': 'ping'}), None)
+            req_server = server.req_server(repo_path + '/reqs', poll_interval=0.05)
+            thread = threading.Thread(target=req_server.serve)
+            thread.start()
+            try:
+                while server.send_request(repo_path + '/reqs', {'command': 'ping'}) is None:
+                    thread.join(0.01)
+
+                result = server.execute(repo_path + '/reqs', {'command': 'add_req',
+                                                              'req': {'Type': 'Testcase', 'Description': 'Test desc'}})
+                self.assertEqual(result, 'SRV_2')
+                self.assertTrue(os.path.exists(repo_path + '/reqs/2.yaml'))
+
+                # The command line is a client of the server
+                result = subprocess.run([sys.executable, GIT_REQS, 'query', '--project_root',
+                                         repo_path + '/reqs', '--fields', 'Description', 'Type=Testcase'],
+                                        stdout=subprocess.PIPE, universal_newlines=True)
+                self.assertEqual(result.stdout, 'SRV_2\tTest desc\n')
+
+                # Files changed by others are reloaded
+                req_module = requirementmodule.requirement_module(repo_path + '/reqs')
+                req_module.add_req({'Req-Id': '', 'Type': 'Requirement', 'Description': 'Written elsewhere'})
+                req_module.write_reqs()
+                self.assertEqual(server.execute(repo_path + '/reqs', {'command': 'query', 'expression': 'Type=Requirement',
+                                                                      'fields': ['Description']}),
+                                 [['SRV_1', 'Req desc'], ['SRV_3', 'Written elsewhere']])
+
+                response = server.send_request(repo_path + '/reqs', {'command': 'query', 'expression': 'Type='})
+                self.assertFalse(response['ok'])
+
+                # Changed test results are imported again
+                def write_results(case):
+                    with open(repo_path + '/results.xml', 'w') as results_file:
+                        results_file.write('<?xml version="1.0"?>\n<testsuites><testsuite name="suite">%s'
+                                           '</testsuite></testsuites>' % case)
+                write_results('<testcase name="test_a"/>')
+                with open(repo_path + '/reqs/test_results.temp.yaml', 'w') as test_results_file:
+                    yaml.safe_dump([repo_path + '/results.xml'], test_results_file)
+                query = {'command': 'query', 'expression': 'Type=Test-Result', 'fields': ['result']}
+                self.assertEqual(server.execute(repo_path + '/reqs', query), [['test_a', 'Passed']])
+                write_results('<testcase name="test_a"><failure message="boom">trace</failure></testcase>')
+                self.assertEqual(server.execute(repo_path + '/reqs', query), [['test_a', 'failure: boom']])
+            finally:
+                server.send_request(repo_path + '/reqs', {'command': 'stop'})
+                thread.join()
+            socket_path = server.get_socket_path(repo_path + '/reqs')
+            self.assertFalse(os.path.exists(socket_path))
+
+            # Other files at the socket path are not trusted nor removed
+            with open(socket_path, 'w'):
+                pass
+            try:
+                self.assertEqual(server.send_request(repo_path + '/reqs', {'command': 'ping'}), None)
+                self.assertRaises(AssertionError, server.req_server(repo_path + '/reqs').serve)
+                self.assertTrue(os.path.exists(socket_path))
+            finally:
+                os.remove(socket_path)
+
+    def test_benchmark(self):
+        with tempfile.TemporaryDirectory() as output_path:
+            result = subprocess.run([sys.executable, '../benchmark/run.py', '--reqs', '20', '--depth', '1', '--repeat', '2',
+                                     '--stages', 'read_cold,update_link_status,write_reqs,reload_changed',
+                                     '--output', output_path + '/results.json'],
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+            self.assertEqual(result.returncode, 0, result.stderr)
+            with open(output_path + '/results.json', 'r') as results_file:
+                results = json.load(results_file)
+            self.assertEqual(results['params']['reqs'], 20)
+            self.assertEqual(list(results['stages']), ['read_cold', 'update_link_status', 'write_reqs', 'reload_changed'])
+            for stage in results['stages'].values():
+                self.assertEqual(stage['error'], None)
+                self.assertEqual(len(stage['seconds']), 2)
+                self.assertGreater(stage['peak_bytes'], 0)
+
+            result = subprocess.run([sys.executable, '../benchmark/run.py', '--compare', output_path + '/results.json',
+                                     output_path + '/results.json'], stdout=subprocess.PIPE, universal_newlines=True)
+            self.assertTrue('reload_changed' in result.stdout)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,33 @@
+import os
+import sys
+import tempfile
+import contextlib
+import git
+sys.path.append("..")
+sys.path.append("../git_reqs")
+import requirementmodule
+
+GIT_REQS = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'git-reqs'))
+
+
+# Runs a test in a new git repo in a temporary directory, which is removed when done, so that nothing is staged in
+# the git-reqs repo. With a module name and prefix, the module is created in the repo first.
+@contextlib.contextmanager
+def temp_repo(module=None, module_prefix=None, **init_args):
+    with tempfile.TemporaryDirectory() as repo_path:
+        git.Repo.init(repo_path)
+        if module is not None:
+            requirementmodule.init_module(repo_path, module, module_prefix, **init_args)
+        yield repo_path
+
+
+# A temp repo that is the working directory while the test runs, for tests using relative paths
+@contextlib.contextmanager
+def in_temp_repo():
+    cwd = os.getcwd()
+    with temp_repo() as repo_path:
+        os.chdir(repo_path)
+        try:
+            yield repo_path
+        finally:
+            os.chdir(cwd)
@@ -2,14 +2,30 @@ import unittest
 import sys
 import os
 import yaml
+import time
+import git
+sys.path.append("..")
 sys.path.append("../git_reqs")
 import requirementmodule
+from helpers import temp_repo
 
 def strip(reqmodule):
     for req in reqmodule.reqs:
         reqmodule.reqs.nodes[req].pop('non_stored_fields')
     return reqmodule
 
+class counting_git:
+    def __init__(self, git_cmd):
+        self.git_cmd = git_cmd
+        self.calls = []
+
+    def add(self, *args):
+        self.calls.append(args)
+        return self.git_cmd.add(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.git_cmd, name)
+
 class TestRequirementModule(unittest.TestCase):
 
     def test_read_reqs(self):
@@ -22,77 +38,148 @@ class TestRequirementModule(unittest.TestCase):
         reqs = {'_Req_1': Req_1, '_Req_2': Req_2, '_Test_1': Test_1}
 
         # Dump tp yaml
-        module_path = os.getcwd() + '/test_read_reqs'
-        if not os.path.exists(module_path):
-            os.mkdir(module_path)
+        with temp_repo() as module_path:
+            for req in reqs.values():
+                with open(module_path + '/' + req['Req-Id'] + '.yaml', 'w') as req_file:
+                    yaml.dump(req, req_file)
 
-        for req in reqs.values():
-            with open(module_path + '/' + req['Req-Id'] + '.yaml', 'w') as req_file:
-                yaml.dump(req, req_file)
+            with open(module_path + '/reqs.yaml', 'w') as reqs_file:
+                yaml.dump([req['Req-Id'] for req in reqs.values()], reqs_file)
 
-        with open(module_path + '/reqs.yaml', 'w') as reqs_file:
-            yaml.dump([req['Req-Id'] for req in reqs.values()], reqs_file)
+            # Read in the yaml files with git-reqs
+            req_module = requirementmodule.requirement_module(module_path)
 
-        # Read in the yaml files with git-reqs
-        req_module = requirementmodule.requirement_module(module_path)
+            # Check that the order of the reqs are correct (add module prefix to names):
+            self.assertEqual(req_module.ordered_req_names, ['_' + req['Req-Id'] for req in reqs.values()])
 
-        # Check that the order of the reqs are correct (add module prefix to names):
-        self.assertEqual(req_module.ordered_req_names, ['_' + req['Req-Id'] for req in reqs.values()])
+            # Add the external node to the testset:
+            reqs['Ext_1'] = {}
 
-        # Add the external node to the testset:
-        reqs['Ext_1'] = {}
+            # Check that all nodes contain the correct information:
+            self.assertEqual(strip(req_module).reqs.nodes, reqs)
 
-        # Check that all nodes contain the correct information:
-        self.assertEqual(strip(req_module).reqs.nodes, reqs)
+            # Check that the edges are connected correctly:
+            expected_list = [('Ext_1', '_Req_1'), ('_Req_1', '_Req_2'), ('_Req_2', '_Test_1')]
+            expected_list.sort()
+            actual_list = [e for e in req_module.reqs.edges]
+            actual_list.sort()
+            self.assertListEqual(actual_list, expected_list)
 
-        # Check that the edges are connected correctly:
-        expected_list = [('Ext_1', '_Req_1'), ('_Req_1', '_Req_2'), ('_Req_2', '_Test_1')]
-        expected_list.sort()
-        actual_list = [e for e in req_module.reqs.edges]
-        actual_list.sort()
-        self.assertListEqual(actual_list, expected_list)
-
-        # Check that the edges has the correct values:
-        expected_list = [('Ext_1', '_Req_1'), ('_Req_1', '_Req_2'), ('_Req_2', '_Test_1')]
-        expected_values = [{'type': 'extern'}, {'type': 'refines'}, {'type': 'verifies'}]
-        for v, n in zip(expected_values, expected_list):
-            self.assertEqual(req_module.reqs.get_edge_data(n[0], n[1]), v)
+            # Check that the edges has the correct values:
+            expected_list = [('Ext_1', '_Req_1'), ('_Req_1', '_Req_2'), ('_Req_2', '_Test_1')]
+            expected_values = [{'type': 'extern'}, {'type': 'refines'}, {'type': 'verifies'}]
+            for v, n in zip(expected_values, expected_list):
+                self.assertEqual(req_module.reqs.get_edge_data(n[0], n[1]), v)
 
     def test_write_reqs(self):
         # Create a temp folder
-        module_path = os.getcwd() + '/test_write_reqs'
-        if not os.path.exists(module_path):
-            os.mkdir(module_path)
-
-        # Create an empty git-reqs module:
-        req_module = requirementmodule.requirement_module(module_path)
-
-
-        # Create some reqs and add them to git-reqs, let git-reqs create req-ids
-        Req_1 = {'Req-Id': '', 'Type': 'Requirement', 'Description': 'Req desc 1',
-                 'upward_links': 'extern:Ext_1'}
-        Req_1_name = req_module.add_req(Req_1)
-        Req_1['Req-Id'] = Req_1_name.split('_')[-1]
-
-        Test_1 = {'Req-Id': '', 'Type': 'Testcase', 'Description': 'Test desc 1'}
-        Test_1_name = req_module.add_req(Test_1)
-        Test_1['Req-Id'] = Test_1_name.split('_')[-1]
-
-        Req_2 = {'Req-Id': '', 'Type': 'Requirement', 'Description': 'Req desc 2',
-                 'downward_links': 'verifies:%s' % Test_1_name, 'upward_links': 'refines:%s' % Req_1_name}
-        Req_2_name = req_module.add_req(Req_2)
-        Req_2['Req-Id'] = Req_2_name.split('_')[-1]
-
-        reqs = {Req_1_name: Req_1, Req_2_name: Req_2, Test_1_name: Test_1}
-
-        # Write reqs
-        req_module.write_reqs()
-
-        # Read the yaml files:
-        for req in reqs.values():
-            with open(module_path + '/' + req['Req-Id'] + '.yaml', 'r') as req_file:
-                read_req = yaml.safe_load(req_file)
-                self.assertEqual(read_req, req)
+        with temp_repo() as module_path:
+            # Create an empty git-reqs module:
+            req_module = requirementmodule.requirement_module(module_path)
+
+
+            # Create some reqs and add them to git-reqs, let git-reqs create req-ids
+            Req_1 = {'Req-Id': '', 'Type': 'Requirement', 'Description': 'Req desc 1',
+                     'upward_links': 'extern:Ext_1'}
+            Req_1_name = req_module.add_req(Req_1)
+            Req_1['Req-Id'] = Req_1_name.split('_')[-1]
+
+            Test_1 = {'Req-Id': '', 'Type': 'Testcase', 'Description': 'Test desc 1'}
+            Test_1_name = req_module.add_req(Test_1)
+            Test_1['Req-Id'] = Test_1_name.split('_')[-1]
+
+            Req_2 = {'Req-Id': '', 'Type': 'Requirement', 'Description': 'Req desc 2',
+                     'downward_links': 'verifies:%s' % Test_1_name, 'upward_links': 'refines:%s' % Req_1_name}
+            Req_2_name = req_module.add_req(Req_2)
+            Req_2['Req-Id'] = Req_2_name.split('_')[-1]
+
+            reqs = {Req_1_name: Req_1, Req_2_name: Req_2, Test_1_name: Test_1}
+
+            # Write reqs
+            req_module.write_reqs()
+
+            # Read the yaml files:
+            for req in reqs.values():
+                with open(module_path + '/' + req['Req-Id'] + '.yaml', 'r') as req_file:
+                    read_req = yaml.safe_load(req_file)
+                    self.assertEqual(read_req, req)
+
+    def test_write_reqs_staging(self):
+        with temp_repo('test_staging', 'STAGE') as repo_path:
+            git_repo = git.Repo(repo_path)
+            req_module = requirementmodule.requirement_module(repo_path + '/test_staging')
+
+            req_names = [req_module.add_req({'Req-Id': '', 'Type': 'Requirement', 'Description': 'Req desc %d' % i})
+                         for i in range(5)]
+
+            # Count the git commands used for staging
+            req_module.git_repo.git = counting_git(req_module.git_repo.git)
+            self.assertEqual(req_module.write_reqs(), {})
+            self.assertEqual(len(req_module.git_repo.git.calls), 1)
+
+            staged = git_repo.git.diff('--cached', '--name-only').split('\n')
+            for req_name in req_names:
+                self.assertTrue('test_staging/' + req_name.split('_')[-1] + '.yaml' in staged)
+            for file_name in ['reqs.yaml', 'used-ids.yaml', 'next-id.yaml', 'config.yaml']:
+                self.assertTrue('test_staging/' + file_name in staged)
+
+            # Failures are reported per path
+            with open(repo_path + '/.gitignore', 'w') as gitignore:
+                gitignore.write('ignored.yaml\n')
+            open(repo_path + '/ignored.yaml', 'w').close()
+            open(repo_path + '/other.yaml', 'w').close()
+            stage = requirementmodule.git_stage()
+            stage.add(git_repo, repo_path + '/ignored.yaml', repo_path + '/other.yaml')
+            failed = stage.flush()
+            self.assertEqual(list(failed.keys()), [repo_path + '/ignored.yaml'])
+            self.assertTrue('other.yaml' in git_repo.git.diff('--cached', '--name-only'))
+
+            # The cache is never staged
+            req_module.cache.save()
+            stage.add(git_repo, repo_path + '/test_staging/.git-reqs-cache/snapshot.json')
+            self.assertEqual(stage.flush(), {})
+            self.assertFalse('.git-reqs-cache' in git_repo.git.diff('--cached', '--name-only'))
+
+    def test_write_only_changed_reqs(self):
+        with temp_repo('test_dirty', 'DIRTY', req_numbering='numbers') as repo_path:
+            req_module = requirementmodule.requirement_module(repo_path + '/test_dirty')
+            reqs = [{'Req-Id': '', 'Type': 'Requirement', 'Description': 'Req desc %d' % i} for i in range(3)]
+            for req in reqs:
+                req_module.add_req(req)
+            req_module.write_reqs()
+
+            # Re-add all reqs like an excel import does, but only change one of them
+            req_module = requirementmodule.requirement_module(repo_path + '/test_dirty')
+            req_module.clear_ordered_req_list()
+            reqs[1]['Description'] = 'Changed desc 1'
+            for req in reqs:
+                req_module.add_req(dict(req))
+
+            req_module.git_repo.git = counting_git(req_module.git_repo.git)
+            req_module.write_reqs()
+            self.assertEqual(req_module.git_repo.git.calls, [('--', repo_path + '/test_dirty/2.yaml')])
+            with open(repo_path + '/test_dirty/2.yaml', 'r') as req_file:
+                self.assertEqual(yaml.safe_load(req_file)['Description'], 'Changed desc 1')
+
+            # Nothing changed, nothing to write
+            req_module.write_reqs()
+            self.assertEqual(len(req_module.git_repo.git.calls), 1)
+
+            # Reqs changed directly in the graph are written too
+            req_module.reqs.nodes['DIRTY_1']['Description'] = 'Changed desc 0'
+            req_module.write_reqs()
+            self.assertEqual(req_module.git_repo.git.calls[1], ('--', repo_path + '/test_dirty/1.yaml'))
+            with open(repo_path + '/test_dirty/1.yaml', 'r') as req_file:
+                self.assertEqual(yaml.safe_load(req_file)['Description'], 'Changed desc 0')
+
+            # Removed reqs are set to deleted status once
+            req_module.clear_ordered_req_list()
+            req_module.add_req(dict(reqs[0], Description='Changed desc 0'))
+            req_module.write_reqs()
+            self.assertEqual(set(req_module.git_repo.git.calls[2][1:]),
+                             {repo_path + '/test_dirty/' + f for f in ['2.yaml', '3.yaml', 'reqs.yaml']})
+            with open(repo_path + '/test_dirty/3.yaml', 'r') as req_file:
+                self.assertEqual(yaml.safe_load(req_file)['Status'], 'deleted')
 
     def test_update_link_status(self):
         req_module = requirementmodule.requirement_module()
@@ -136,6 +223,378 @@ class TestRequirementModule(unittest.TestCase):
         self.assertEqual(req_module.reqs.nodes[Req_1]['non_stored_fields']['verifies_link_status'], 0.75)
         self.assertEqual(req_module.reqs.nodes[Req_1]['non_stored_fields']['implements_link_status'], 1)
 
+    def test_update_link_status_shared_descendants(self):
+        req_module = requirementmodule.requirement_module()
+
+        Test_1 = req_module.add_req({'Req-Id': ""})
+        Test_2 = req_module.add_req({'Req-Id': ""})
+        Req_4 = req_module.add_req({'Req-Id': "", 'downward_links': 'partly_verifies(1/2):%s' % Test_1})
+        Req_5 = req_module.add_req({'Req-Id': "", 'downward_links': 'verifies:%s' % Test_2})
+        Req_2 = req_module.add_req({'Req-Id': "", 'downward_links': 'refines:%s' % Req_4})
+        Req_3 = req_module.add_req({'Req-Id': "", 'downward_links': 'refines:%s,refines:%s' % (Req_4, Req_5)})
+        Req_1 = req_module.add_req({'Req-Id': "", 'downward_links': 'refines:%s,refines:%s' % (Req_2, Req_3)})
+
+        req_module.update_link_status()
+        status = lambda req, link_type: req_module.reqs.nodes[req]['non_stored_fields'][link_type + '_link_status']
+
+        # Req 3 is verified by its descendants Req 4 (1/2) and Req 5 (1) -> Verification status = 3/4
+        self.assertEqual(status(Req_3, 'verifies'), 0.75)
+        # Req 4 is reached through both Req 2 and Req 3, but shall only be counted once
+        # Req 1 -> (Req 2: 1/2 + Req 3: 3/4 + Req 4: 1/2 + Req 5: 1)/4
+        self.assertEqual(status(Req_1, 'verifies'), 2.75/4)
+        # Req 1 refines two reqs (2), limited by the mean of Req 2 (1) and Req 3 (2)
+        self.assertEqual(status(Req_1, 'refines'), 1.5)
+
+        # Fully verify Req 4, only Req 4 and its ancestors shall be updated
+        req_module.reqs.nodes[Req_4]['downward_links'] = 'verifies:%s' % Test_1
+        req_module.reqs.nodes[Req_5]['non_stored_fields']['verifies_link_status'] = 'untouched'
+        req_module.update_link_status(Req_4)
+        self.assertEqual(status(Req_4, 'verifies'), 1)
+        self.assertEqual(status(Req_5, 'verifies'), 'untouched')
+        self.assertEqual(status(Req_3, 'verifies'), 1)
+        self.assertEqual(req_module.reqs.edges[(Req_4, Test_1)]['type'], 'verifies')
+
+        # Removing the link removes the edge and the status
+        req_module.reqs.nodes[Req_4]['downward_links'] = ''
+        req_module.update_link_status(Req_4)
+        self.assertFalse(req_module.reqs.has_edge(Req_4, Test_1))
+        self.assertTrue('verifies_link_status' not in req_module.reqs.nodes[Req_4]['non_stored_fields'])
+
+    def test_resolve_req_name(self):
+        names = ['ROOT_PROD_1', 'ROOT_SubSystem_SystemRS_2', 'ROOT_SubSystem_Test_3', 'ROOT_SubSystem_PROD_1']
+        index = requirementmodule.req_name_index(names)
+
+        # The deepest match from the module prefix is used
+        self.assertEqual(index.resolve('PROD_1', ('ROOT', 'SubSystem', 'Test')), 'ROOT_SubSystem_PROD_1')
+        self.assertEqual(index.resolve('PROD_1', ('ROOT', 'Other')), 'ROOT_PROD_1')
+        self.assertEqual(index.resolve('SystemRS_2', index.get_prefix('ROOT_SubSystem_Test_3')),
+                         'ROOT_SubSystem_SystemRS_2')
+        self.assertEqual(index.resolve('SubSystem_SystemRS_2', ('ROOT', 'PROD')), 'ROOT_SubSystem_SystemRS_2')
+        # Unknown reqs are returned as written
+        self.assertEqual(index.resolve('Ext_1', ('ROOT', 'PROD')), 'Ext_1')
+
+        index.remove('ROOT_SubSystem_PROD_1')
+        self.assertEqual(index.resolve('PROD_1', ('ROOT', 'SubSystem', 'Test')), 'ROOT_PROD_1')
+
+        req_module = requirementmodule.requirement_module()
+        req = req_module.add_req({'Req-Id': ''})
+        self.assertEqual(req_module.resolve_req_name(req.split('_')[-1]), req)
+
+    def test_link_index(self):
+        reqs = requirementmodule.nx.DiGraph()
+        reqs.add_node('A_1', downward_links='verifies:T_12, refines:A_2', upward_links='')
+        index = requirementmodule.link_index(reqs)
+
+        self.assertEqual(list(index.get('A_1')), ['verifies:T_12', 'refines:A_2'])
+        self.assertFalse(index.has('A_1', 'verifies:T_1'))
+        self.assertTrue(index.add('A_1', 'verifies:T_1'))
+        self.assertFalse(index.add('A_1', 'verifies: T_1'))
+        self.assertEqual(reqs.nodes['A_1']['downward_links'], 'verifies:T_12,refines:A_2,verifies:T_1')
+        self.assertTrue(index.remove('A_1', 'verifies:T_12'))
+        self.assertFalse(index.remove('A_1', 'verifies:T_12'))
+        self.assertEqual(reqs.nodes['A_1']['downward_links'], 'refines:A_2,verifies:T_1')
+
+        # Fields changed in the node are parsed again
+        reqs.nodes['A_1']['downward_links'] = 'verifies:T_3'
+        self.assertEqual(index.get('A_1'), {'verifies:T_3': ('verifies', 'T_3')})
+        self.assertTrue(index.add('A_1', 'verifies:T_4', 'upward_links'))
+        self.assertEqual(reqs.nodes['A_1']['upward_links'], 'verifies:T_4')
+
+    def test_attr_index(self):
+        with temp_repo('test_attrs', 'AT', req_numbering='numbers') as repo_path:
+            req_module = requirementmodule.requirement_module(repo_path + '/test_attrs')
+            req_module.add_req({'Req-Id': '', 'Type': 'Requirement', 'Description': 'First', 'downward_links': 'verifies:2'})
+            req_module.add_req({'Req-Id': '', 'Type': 'Testcase', 'Description': 'Second'})
+            req_module.add_req({'Req-Id': '', 'Type': 'Requirement', 'Description': 'Third', 'downward_links': 'verifies:EXT_9'})
+            req_module.update_link_status()
+
+            self.assertEqual(list(req_module.get_reqs_with_attr(('Type', 'Requirement')).nodes), ['AT_1', 'AT_3'])
+            self.assertEqual(req_module.req_attrs.get('Type', 'Requirement'), ['AT_1', 'AT_3'])
+            # Reqs added by the link status, outside of the module, are indexed as well
+            self.assertEqual(list(req_module.get_reqs_with_non_stored_attr(('Internal', False)).nodes), ['EXT_9'])
+
+            req_module.add_req({'Req-Id': 'AT_1', 'Type': 'Testcase', 'Description': 'First'})
+            self.assertEqual(req_module.req_attrs.get('Type', 'Requirement'), ['AT_3'])
+            self.assertEqual(req_module.req_attrs.get('Type', 'Testcase'), ['AT_2', 'AT_1'])
+            self.assertEqual(list(req_module.get_reqs_with_attr(('Description', 'Second')).nodes), ['AT_2'])
+
+    def test_query(self):
+        with temp_repo('project', 'P', req_numbering='numbers', root_module=True) as repo_path:
+            requirementmodule.init_module(repo_path + '/project', 'SRS', 'SRS', req_numbering='numbers')
+            requirementmodule.init_module(repo_path + '/project', 'TST', 'TST', req_numbering='numbers')
+            project = requirementmodule.requirement_module(repo_path + '/project')
+            srs = project.modules['SRS']
+            tst = project.modules['TST']
+            tst.add_req({'Req-Id': '', 'Type': 'Testcase', 'Description': 'Test of speed'})
+            srs.add_req({'Req-Id': '', 'Type': 'Requirement', 'Description': 'Speed', 'downward_links': 'verifies:TST_1'})
+            srs.add_req({'Req-Id': '', 'Type': 'Requirement', 'Description': 'Braking', 'downward_links': 'refines:P_SRS_3'})
+            srs.add_req({'Req-Id': '', 'Type': 'Requirement', 'Description': 'Braking distance'})
+            srs.add_req({'Req-Id': '', 'Type': 'Information', 'Description': 'Background'})
+            project.reqs.add_node('P_SRS_3_result', Type='Test-Result', result='failure: too long')
+            project.reqs.add_edge('P_SRS_3', 'P_SRS_3_result', type='Test-Result')
+            project.update_link_status()
+
+            def query(expression):
+                return list(project.query(expression))
+
+            self.assertEqual(query('Type=Requirement'), ['P_SRS_1', 'P_SRS_2', 'P_SRS_3'])
+            self.assertEqual(query('module SRS and Type!=Requirement'), ['P_SRS_4'])
+            # Traversals give their reqs in the order they are reached
+            self.assertEqual(sorted(query('Type=Requirement and not link verifies and '
+                                          'ancestors(Type=Test-Result and result!=Passed)')), ['P_SRS_2', 'P_SRS_3'])
+            self.assertEqual(query('descendants(Description="Speed") or Description~^Back'), ['P_TST_1', 'P_SRS_4'])
+            self.assertEqual(query('link refines or (module TST and Internal=True)'), ['P_TST_1', 'P_SRS_2'])
+            self.assertEqual(list(srs.query('Description~"distance$"')), ['P_SRS_3'])
+            with self.assertRaises(AssertionError):
+                query('Type=Requirement and')
+
+    def test_reload_changed(self):
+        with temp_repo('project', 'P', req_numbering='numbers', root_module=True) as repo_path:
+            requirementmodule.init_module(repo_path + '/project', 'SRS', 'SRS', req_numbering='numbers')
+            requirementmodule.init_module(repo_path + '/project', 'TST', 'TST', req_numbering='numbers')
+            project = requirementmodule.requirement_module(repo_path + '/project')
+            project.modules['TST'].add_req({'Req-Id': '', 'Type': 'Testcase', 'Description': 'Test 1'})
+            project.modules['TST'].add_req({'Req-Id': '', 'Type': 'Testcase', 'Description': 'Test 2'})
+            for i in range(3):
+                project.modules['SRS'].add_req({'Req-Id': '', 'Type': 'Requirement', 'Description': 'Req %d' % i,
+                                                'downward_links': 'verifies:TST_%d' % (i % 2 + 1)})
+            project.write_reqs()
+            for module in project.modules.values():
+                module.write_reqs()
+
+            def get_state(project):
+                nodes = {n: {k: v for k, v in d.items() if k != 'non_stored_fields'} for n, d in project.reqs.nodes.items()}
+                statuses = {n: {k: v for k, v in d.get('non_stored_fields', {}).items() if k != 'link_status_updated'}
+                            for n, d in project.reqs.nodes.items()}
+                orders = {m.module_path: m.ordered_req_names for m in project.get_module_tree()}
+                return nodes, statuses, sorted(project.reqs.edges(data=True)), orders
+
+            live = requirementmodule.requirement_module(repo_path + '/project')
+            live.update_link_status()
+
+            # Change, add and remove reqs on disk
+            srs_path = repo_path + '/project/SRS'
+            with open(srs_path + '/2.yaml', 'w') as req_file:
+                yaml.dump({'Req-Id': '2', 'Type': 'Requirement', 'Description': 'Changed', 'downward_links': ''}, req_file)
+            with open(srs_path + '/4.yaml', 'w') as req_file:
+                yaml.dump({'Req-Id': '4', 'Type': 'Requirement', 'Description': 'New',
+                           'downward_links': 'verifies:TST_1,verifies:SRS_1'}, req_file)
+            with open(srs_path + '/reqs.yaml', 'w') as reqs_file:
+                yaml.dump(['4', '2', '3'], reqs_file)
+            changed = live.reload_changed([srs_path + '/2.yaml', srs_path + '/4.yaml', srs_path + '/reqs.yaml'])
+            self.assertEqual(changed, {'P_SRS_1', 'P_SRS_2', 'P_SRS_4'})
+            self.assertEqual(list(live.query('module SRS')), ['P_SRS_4', 'P_SRS_2', 'P_SRS_3'])
+            fresh = requirementmodule.requirement_module(repo_path + '/project')
+            fresh.update_link_status()
+            self.assertEqual(get_state(live), get_state(fresh))
+
+            # A new module changes the config of the project
+            requirementmodule.init_module(repo_path + '/project', 'SYS', 'SYS', req_numbering='numbers')
+            with open(repo_path + '/project/SYS/1.yaml', 'w') as req_file:
+                yaml.dump({'Req-Id': '1', 'Type': 'Requirement', 'Description': 'System',
+                           'downward_links': 'refines:SRS_3'}, req_file)
+            with open(repo_path + '/project/SYS/reqs.yaml', 'w') as reqs_file:
+                yaml.dump(['1'], reqs_file)
+            live.reload_changed([repo_path + '/project/config.yaml'])
+            self.assertEqual(list(live.modules), ['SRS', 'TST', 'SYS'])
+            fresh = requirementmodule.requirement_module(repo_path + '/project')
+            fresh.update_link_status()
+            self.assertEqual(get_state(live), get_state(fresh))
+
+            # Test results imported again replace the ones imported before
+            def write_results(cases):
+                with open(repo_path + '/results.xml', 'w') as results_file:
+                    results_file.write('<?xml version="1.0"?>\n<testsuites><testsuite name="suite">%s'
+                                       '</testsuite></testsuites>' % cases)
+            write_results('<testcase name="Req 0"/><testcase name="git-reqs: P_TST_2 verifies P_SRS_3"/>')
+            with open(repo_path + '/project/TST/test_results.temp.yaml', 'w') as test_results_file:
+                yaml.safe_dump([repo_path + '/results.xml'], test_results_file)
+            live.reload_changed([repo_path + '/project/TST/test_results.temp.yaml'])
+            self.assertEqual(live.reqs.nodes['P_TST_2_result']['result'], 'Passed')
+            write_results('<testcase name="Req 1"><failure message="boom">trace</failure></testcase>')
+            live.reload_changed([repo_path + '/project/TST/test_results.temp.yaml'])
+            self.assertEqual(list(live.query('Type=Test-Result')), ['Req 1'])
+            fresh = requirementmodule.requirement_module(repo_path + '/project')
+            fresh.update_link_status()
+            self.assertEqual(get_state(live), get_state(fresh))
+
+            # Also when the module is read again
+            write_results('<testcase name="Req 2"/>')
+            live.reload_changed([repo_path + '/project/config.yaml'])
+            self.assertEqual(list(live.query('Type=Test-Result')), ['Req 2'])
+            fresh = requirementmodule.requirement_module(repo_path + '/project')
+            fresh.update_link_status()
+            self.assertEqual(get_state(live), get_state(fresh))
+
+    def test_import_test_results(self):
+        with temp_repo('test_junit', 'JU', req_numbering='numbers') as repo_path:
+            req_module = requirementmodule.requirement_module(repo_path + '/test_junit')
+            req_module.add_req({'Req-Id': '', 'Type': 'Requirement', 'Description': 'Covered by test_a and test_ab'})
+            req_module.add_req({'Req-Id': '', 'Type': 'Testcase', 'Description': 'Tagged test'})
+            req_module.add_req({'Req-Id': '', 'Type': 'Requirement', 'Description': 'Covered by test_b'})
+
+            with open(repo_path + '/results.xml', 'w') as results_file:
+                results_file.write('<?xml version="1.0"?>\n<testsuites><testsuite name="suite">'
+                                   '<testcase name="test_a"/>'
+                                   '<testcase name="test_ab"><failure message="boom">trace</failure></testcase>'
+                                   '<testcase name="test_b"><skipped/></testcase>'
+                                   '<testcase name="git-reqs: 2 verifies 1"/>'
+                                   '</testsuite></testsuites>')
+            req_module.import_test_results(repo_path + '/results.xml')
+
+            self.assertEqual(req_module.reqs.nodes['test_a']['result'], 'Passed')
+            self.assertEqual(req_module.reqs.nodes['test_ab']['result'], 'failure: boom')
+            self.assertEqual(req_module.reqs.nodes['test_b']['result'], 'skipped')
+            self.assertEqual(sorted(req_module.reqs.successors('JU_1')), ['test_a', 'test_ab'])
+            self.assertEqual(list(req_module.reqs.successors('JU_3')), ['test_b'])
+            self.assertEqual(list(req_module.reqs.successors('JU_2')), ['JU_2_result'])
+            self.assertEqual(req_module.reqs.nodes['JU_2_result']['result'], 'Passed')
+
+    def test_parallel_load(self):
+        with temp_repo() as module_path:
+            for path, prefix, modules in [('', 'ROOT', ['Sub']), ('/Sub', 'SUB', [])]:
+                if not os.path.exists(module_path + path):
+                    os.mkdir(module_path + path)
+                with open(module_path + path + '/config.yaml', 'w') as config_file:
+                    yaml.dump({'req_version': 0.3, 'module_prefix': prefix, 'modules': modules,
+                               'req_number_format': 'numbers'}, config_file)
+                req_ids = [str(i) for i in range(20)]
+                for req_id in req_ids:
+                    with open(module_path + path + '/' + req_id + '.yaml', 'w') as req_file:
+                        yaml.dump({'Req-Id': req_id, 'Type': 'Requirement', 'Description': prefix + ' desc ' + req_id,
+                                   'upward_links': 'refines:ROOT_%s' % req_id if prefix == 'SUB' else ''}, req_file)
+                with open(module_path + path + '/reqs.yaml', 'w') as reqs_file:
+                    yaml.dump(req_ids, reqs_file)
+
+            serial_module = requirementmodule.requirement_module(module_path, use_cache=False, workers=1)
+
+            threshold = requirementmodule.PARALLEL_PARSE_THRESHOLD
+            requirementmodule.PARALLEL_PARSE_THRESHOLD = 0
+            try:
+                parallel_module = requirementmodule.requirement_module(module_path, use_cache=False, workers=2)
+            finally:
+                requirementmodule.PARALLEL_PARSE_THRESHOLD = threshold
+
+            self.assertEqual(dict(parallel_module.reqs.nodes), dict(serial_module.reqs.nodes))
+            self.assertEqual(sorted(parallel_module.reqs.edges), sorted(serial_module.reqs.edges))
+            self.assertEqual(parallel_module.modules['Sub'].ordered_req_names, ['ROOT_SUB_%d' % i for i in range(20)])
+            self.assertTrue(('ROOT_5', 'ROOT_SUB_5') in parallel_module.reqs.edges)
+            # All modules share the same graph
+            self.assertTrue(parallel_module.modules['Sub'].reqs is parallel_module.reqs)
+
+    def test_snapshot_cache(self):
+        with temp_repo() as module_path:
+
+            reqs = {'1': {'Req-Id': '1', 'Type': 'Requirement', 'Description': 'Req desc 1'},
+                    '2': {'Req-Id': '2', 'Type': 'Requirement', 'Description': 'Req desc 2'}}
+            for req in reqs.values():
+                with open(module_path + '/' + req['Req-Id'] + '.yaml', 'w') as req_file:
+                    yaml.dump(req, req_file)
+            with open(module_path + '/reqs.yaml', 'w') as reqs_file:
+                yaml.dump(list(reqs.keys()), reqs_file)
+
+            # Make the files old enough to be trusted by the cache
+            old = time.time() - 60
+            for file_name in os.listdir(module_path):
+                os.utime(module_path + '/' + file_name, (old, old))
+
+            req_module = requirementmodule.requirement_module(module_path)
+            self.assertTrue(os.path.exists(module_path + '/.git-reqs-cache/snapshot.json'))
+            self.assertEqual(req_module.reqs.nodes['_2']['Description'], 'Req desc 2')
+
+            # Change one req, only that file shall be parsed again
+            reqs['2']['Description'] = 'Changed desc 2'
+            with open(module_path + '/2.yaml', 'w') as req_file:
+                yaml.dump(reqs['2'], req_file)
+            os.utime(module_path + '/2.yaml', (old + 1, old + 1))
+
+            parsed = []
+            cache = requirementmodule.snapshot_cache(module_path)
+            for file_name in ['reqs.yaml', '1.yaml', '2.yaml']:
+                cache.load(file_name, lambda f: parsed.append(f.name) or yaml.safe_load(f))
+            self.assertEqual(parsed, [module_path + '/2.yaml'])
+
+            req_module = requirementmodule.requirement_module(module_path)
+            self.assertEqual(req_module.reqs.nodes['_1']['Description'], 'Req desc 1')
+            self.assertEqual(req_module.reqs.nodes['_2']['Description'], 'Changed desc 2')
+
+            # A disabled cache reads everything from disk
+            req_module = requirementmodule.requirement_module(module_path, use_cache=False)
+            self.assertEqual(req_module.reqs.nodes['_2']['Description'], 'Changed desc 2')
+
+            # A damaged snapshot is ignored
+            with open(module_path + '/.git-reqs-cache/snapshot.json', 'w') as snapshot_file:
+                snapshot_file.write('not json')
+            req_module = requirementmodule.requirement_module(module_path)
+            self.assertEqual(req_module.reqs.nodes['_2']['Description'], 'Changed desc 2')
+
+    def test_convert_req_storage(self):
+        with temp_repo('test_storage', 'STORE', req_numbering='numbers') as repo_path:
+            git_repo = git.Repo(repo_path)
+            module_path = repo_path + '/test_storage'
+            req_module = requirementmodule.requirement_module(module_path)
+            for i in range(3):
+                req_module.add_req({'Req-Id': '', 'Type': 'Requirement', 'Description': 'Req desc %d' % i,
+                                    'upward_links': 'extern:Ext_%d' % i})
+            req_module.write_reqs()
+            # Delete one req
+            req_module.ordered_req_names.remove('STORE_2')
+            req_module.write_reqs()
+            git_repo.index.commit('Add reqs')
+
+            def read_files():
+                files = {}
+                for req_id in ['1', '2', '3']:
+                    with open(module_path + '/' + req_id + '.yaml', 'r') as req_file:
+                        files[req_id] = yaml.safe_load(req_file)
+                return files
+            stored = read_files()
+            self.assertEqual(stored['2']['Status'], 'deleted')
+
+            self.assertEqual(req_module.convert_req_storage('module_file'), {})
+            self.assertFalse(os.path.exists(module_path + '/1.yaml'))
+            with open(module_path + '/all-reqs.yaml', 'r') as module_file:
+                self.assertEqual(yaml.safe_load(module_file), stored)
+            staged = git_repo.git.diff('--cached', '--name-status').split('\n')
+            self.assertTrue('D\ttest_storage/1.yaml' in staged)
+            self.assertTrue('A\ttest_storage/all-reqs.yaml' in staged)
+
+            # Reqs are read from and written to the module file
+            req_module = requirementmodule.requirement_module(module_path)
+            self.assertEqual(req_module.ordered_req_names, ['STORE_1', 'STORE_3'])
+            self.assertEqual(req_module.reqs.nodes['STORE_3']['Description'], 'Req desc 2')
+            req_module.reqs.nodes['STORE_3']['Description'] = 'Changed desc 2'
+            req_module.write_reqs()
+            stored['3']['Description'] = 'Changed desc 2'
+            with open(module_path + '/all-reqs.yaml', 'r') as module_file:
+                self.assertEqual(yaml.safe_load(module_file), stored)
+
+            # And back again
+            req_module = requirementmodule.requirement_module(module_path)
+            self.assertEqual(req_module.convert_req_storage('files'), {})
+            self.assertFalse(os.path.exists(module_path + '/all-reqs.yaml'))
+            self.assertEqual(read_files(), stored)
+            req_module = requirementmodule.requirement_module(module_path)
+            self.assertEqual(req_module.ordered_req_names, ['STORE_1', 'STORE_3'])
+
+    def test_allocate_ids(self):
+        with temp_repo('test_numbers', 'NUM', req_numbering='numbers') as repo_path:
+            requirementmodule.init_module(repo_path, 'test_hashes', 'HASH', req_numbering='time_hash')
+
+            req_module = requirementmodule.requirement_module(repo_path + '/test_numbers')
+            req_module.add_req({'Req-Id': 'NUM_2', 'Type': 'Requirement', 'Description': 'Explicit id'})
+            self.assertEqual(req_module.allocate_req_names(3), ['NUM_1', 'NUM_3', 'NUM_4'])
+            self.assertEqual(req_module.add_req({'Req-Id': '', 'Description': 'Next'}), 'NUM_5')
+            req_module.write_reqs()
+            req_module = requirementmodule.requirement_module(repo_path + '/test_numbers')
+            self.assertEqual(list(req_module.used_ids), ['2', '1', '3', '4', '5'])
+            self.assertEqual(req_module.add_req({'Req-Id': '', 'Description': 'Next'}), 'NUM_6')
+
+            req_module = requirementmodule.requirement_module(repo_path + '/test_hashes')
+            names = req_module.allocate_req_names(1000)
+            self.assertEqual(len(set(names)), 1000)
+            self.assertEqual(len(req_module.used_ids), 1000)
+
 
 if __name__ == '__main__':
     unittest.main()